@@ -0,0 +1,260 @@
+"""
+Local, reproducible benchmark for mor_to_cow_script.py.
+
+Everything runs on local disk: an Iceberg JDBC catalog backed by SQLite and a file:// warehouse.
+The benchmark generates a synthetic OLake-style MOR table (keyed by _olake_id), runs the real
+compaction cycle from mor_to_cow_script.py against it and reports rows/sec, files rewritten and
+per-phase latency.
+
+Scenario per run:
+  1. Baseline: write --rows rows to the MOR table and run one cycle (creates the COW table).
+  2. Incremental (--iterations times): write --boundaries CDC batches, each with updates
+     (--update-ratio), soft deletes (--delete-ratio, _op_type = 'd') and new inserts, followed by a
+     TRUNCATE (except the last batch, which the cycle itself truncates), then run one cycle.
+
+Spark cannot write equality deletes, so in-batch re-updates are applied with a merge-on-read MERGE,
+which produces position delete files; the MOR table therefore carries delete files like OLake's.
+
+Example:
+    spark-submit mor_to_cow_benchmark.py --rows 1000000 --boundaries 3 --merge-mode pruned
+"""
+import argparse
+import importlib.util
+import json
+import os
+import shutil
+import time
+
+from pyspark.sql import SparkSession
+
+ICEBERG_RUNTIME = "org.apache.iceberg:iceberg-spark-runtime-3.5_2.12:1.7.1"
+SQLITE_JDBC = "org.xerial:sqlite-jdbc:3.45.1.0"
+
+BENCH_CATALOG = "bench"
+BENCH_DB = "olake_mor"
+BENCH_COW_DB = "olake_cow"
+BENCH_TABLE = "events"
+
+
+def load_compaction_module():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mor_to_cow_script.py")
+    spec = importlib.util.spec_from_file_location("mor_to_cow_script", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def build_local_spark_session(work_dir: str, jars: str = None) -> SparkSession:
+    warehouse = os.path.join(work_dir, "warehouse")
+    catalog_db = os.path.join(work_dir, "catalog.db")
+
+    builder = SparkSession.builder.appName("OLake MOR to COW Benchmark").master("local[*]")
+    if jars:
+        builder = builder.config("spark.jars", jars)
+    else:
+        builder = builder.config("spark.jars.packages", f"{ICEBERG_RUNTIME},{SQLITE_JDBC}")
+    builder = builder.config(
+        "spark.sql.extensions",
+        "org.apache.iceberg.spark.extensions.IcebergSparkSessionExtensions",
+    )
+    builder = builder.config("spark.sql.catalogImplementation", "in-memory")
+    builder = builder.config("spark.sql.defaultCatalog", BENCH_CATALOG)
+    builder = builder.config("spark.sql.execution.arrow.pyspark.enabled", "true")
+    builder = builder.config("spark.ui.showConsoleProgress", "false")
+    builder = builder.config(f"spark.sql.catalog.{BENCH_CATALOG}", "org.apache.iceberg.spark.SparkCatalog")
+    builder = builder.config(f"spark.sql.catalog.{BENCH_CATALOG}.catalog-impl", "org.apache.iceberg.jdbc.JdbcCatalog")
+    builder = builder.config(f"spark.sql.catalog.{BENCH_CATALOG}.uri", f"jdbc:sqlite:{catalog_db}")
+    builder = builder.config(f"spark.sql.catalog.{BENCH_CATALOG}.warehouse", f"file://{warehouse}")
+    return builder.getOrCreate()
+
+
+def create_mor_table(spark: SparkSession, mor_table_fqn: str):
+    spark.sql(f"CREATE NAMESPACE IF NOT EXISTS {BENCH_CATALOG}.{BENCH_DB}")
+    spark.sql(f"""
+        CREATE TABLE {mor_table_fqn} (
+            _olake_id STRING,
+            _olake_timestamp TIMESTAMP,
+            _op_type STRING,
+            id BIGINT,
+            name STRING,
+            amount DOUBLE,
+            updated_at TIMESTAMP
+        )
+        USING iceberg
+        TBLPROPERTIES (
+            'format-version'='2',
+            'write.delete.mode'='merge-on-read',
+            'write.update.mode'='merge-on-read',
+            'write.merge.mode'='merge-on-read'
+        )
+    """)
+
+
+def _rows_sql(id_range_sql: str, op_type: str, version: int, seed: int) -> str:
+    # Deterministic synthetic rows; _olake_id is a hash of the numeric id, as OLake ids are opaque strings.
+    # Every value is a function of (id, version, seed) only, so reruns write identical data regardless of
+    # wall-clock time or how Spark partitions the range; later versions get later timestamps.
+    ts = f"TIMESTAMP_SECONDS(1700000000 + {version} * 86400 + id % 86400)"
+    return f"""
+        SELECT
+            sha2(CAST(id AS STRING), 256) AS _olake_id,
+            {ts} AS _olake_timestamp,
+            '{op_type}' AS _op_type,
+            id,
+            concat('name_', CAST(id AS STRING), '_v{version}') AS name,
+            round(pmod(hash(id, {seed}), 100000) / 100.0, 2) AS amount,
+            {ts} AS updated_at
+        FROM ({id_range_sql}) AS ids
+    """
+
+
+def write_baseline(spark: SparkSession, mor_table_fqn: str, rows: int):
+    spark.sql(f"INSERT INTO {mor_table_fqn} {_rows_sql(f'SELECT id FROM range({rows})', 'c', 0, 0)}")
+
+
+def write_cdc_batch(
+    spark: SparkSession,
+    mor_table_fqn: str,
+    total_rows: int,
+    batch: int,
+    update_ratio: float,
+    delete_ratio: float,
+    insert_ratio: float,
+):
+    """
+    One OLake-style CDC batch: updates and soft deletes of existing keys plus new inserts,
+    then a MOR MERGE re-updating a slice of the batch (produces delete files).
+    Returns the number of rows written to MOR by the batch.
+    """
+    n_update = int(total_rows * update_ratio)
+    n_delete = int(total_rows * delete_ratio)
+    n_insert = int(total_rows * insert_ratio)
+    # Spread each batch over a different key window so boundaries touch different rows.
+    stride = max(1, total_rows // 7)
+    offset = (batch * stride) % max(1, total_rows)
+
+    updates = f"SELECT (id + {offset}) % {total_rows} AS id FROM range({n_update})"
+    deletes = f"SELECT ({offset} + {n_update} + id) % {total_rows} AS id FROM range({n_delete})"
+    inserts = f"SELECT {total_rows} + {batch} * {max(1, n_insert)} + id AS id FROM range({n_insert})"
+
+    spark.sql(f"""
+        INSERT INTO {mor_table_fqn}
+        {_rows_sql(updates, 'u', batch + 1, batch + 1)}
+        UNION ALL
+        {_rows_sql(deletes, 'd', batch + 1, batch + 101)}
+        UNION ALL
+        {_rows_sql(inserts, 'c', batch + 1, batch + 201)}
+    """)
+
+    re_updates = max(1, n_update // 10)
+    spark.sql(f"""
+        MERGE INTO {mor_table_fqn} AS t
+        USING ({_rows_sql(f"SELECT (id + {offset}) % {total_rows} AS id FROM range({re_updates})", 'u', batch + 1000, batch + 301)}) AS s
+        ON t._olake_id = s._olake_id
+        WHEN MATCHED THEN UPDATE SET *
+    """)
+    return n_update + n_delete + n_insert
+
+
+def run_timed_cycle(module, mor_table_fqn: str, label: str) -> dict:
+    # The benchmark writes and truncates MOR outside the module; drop its per-run metadata cache.
+    module.invalidate_table_cache()
+    start = time.monotonic()
+    status = module._run_cycle_with_metrics(mor_table_fqn)
+    elapsed = time.monotonic() - start
+    m = dict(module._last_table_metrics.get(mor_table_fqn) or {})
+    phases = m.get("phases") or {}
+    volume = m.get("volume") or {}
+    write_seconds = phases.get("merge", 0.0) + phases.get("create_baseline", 0.0)
+    rows_read = volume.get("delta_rows_read", 0)
+    return {
+        "label": label,
+        "status": status,
+        "wall_seconds": round(elapsed, 3),
+        "rows_read": rows_read,
+        "rows_per_sec": round(rows_read / write_seconds, 1) if write_seconds > 0 else None,
+        "cow_files_added": volume.get("cow_files_added", 0),
+        "cow_files_rewritten": volume.get("cow_files_removed", 0),
+        "cow_bytes_added": volume.get("cow_bytes_added", 0),
+        "phases": {k: round(v, 3) for k, v in phases.items()},
+    }
+
+
+def print_results(results: list):
+    print("---- Benchmark Results ----")
+    for r in results:
+        phases = " ".join(f"{k}={v:.2f}s" for k, v in r["phases"].items())
+        print(
+            f"  - {r['label']}: {r['status']} wall={r['wall_seconds']:.2f}s rows_read={r['rows_read']} "
+            f"rows/sec={r['rows_per_sec']} files_added={r['cow_files_added']} "
+            f"files_rewritten={r['cow_files_rewritten']} ({phases})"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local benchmark for MOR -> COW compaction (JDBC-on-SQLite catalog, file warehouse)")
+    parser.add_argument("--work-dir", default="/tmp/olake_mor_to_cow_bench", help="Scratch directory (recreated on every run)")
+    parser.add_argument("--output", default=None, help="Write results as JSON to this path (default: <work-dir>/results.json)")
+    parser.add_argument("--rows", type=int, default=100000, help="Rows in the baseline MOR table")
+    parser.add_argument("--update-ratio", type=float, default=0.05, help="Fraction of rows updated per CDC batch")
+    parser.add_argument("--delete-ratio", type=float, default=0.01, help="Fraction of rows soft-deleted per CDC batch")
+    parser.add_argument("--insert-ratio", type=float, default=0.02, help="New rows per CDC batch, as a fraction of --rows")
+    parser.add_argument("--boundaries", type=int, default=2, help="Truncate boundaries (CDC batches) pending per incremental cycle")
+    parser.add_argument("--iterations", type=int, default=3, help="Incremental cycles to run after the baseline")
+    parser.add_argument("--merge-mode", choices=["full", "pruned"], default="full", help="Passed through to the compaction script")
+    parser.add_argument("--cow-buckets", type=int, default=0, help="Passed through to the compaction script (0 disables bucketing)")
+    parser.add_argument("--profile", action="store_true", help="Write MERGE/CTAS profiles to <work-dir>/profiles")
+    parser.add_argument("--jars", default=None, help="Comma-separated local jars (Iceberg runtime + sqlite-jdbc) instead of resolving packages")
+    args = parser.parse_args()
+
+    if os.path.exists(args.work_dir):
+        shutil.rmtree(args.work_dir)
+    os.makedirs(args.work_dir)
+    metrics_dir = os.path.join(args.work_dir, "metrics")
+    os.makedirs(metrics_dir)
+
+    spark = build_local_spark_session(args.work_dir, jars=args.jars)
+
+    mod = load_compaction_module()
+    mod.spark = spark
+    mod.CATALOG = BENCH_CATALOG
+    mod.DB = BENCH_DB
+    mod.COW_DB = BENCH_COW_DB
+    mod.COW_BASE_LOCATION = f"file://{os.path.join(args.work_dir, 'warehouse', 'cow')}"
+    mod.METRICS_DIR = metrics_dir
+    mod.MERGE_MODE = args.merge_mode
+    mod.COW_BUCKETS = args.cow_buckets
+    if args.profile:
+        mod.PROFILE_DIR = os.path.join(args.work_dir, "profiles")
+        os.makedirs(mod.PROFILE_DIR)
+
+    mor_table = f"{BENCH_CATALOG}.{BENCH_DB}.{BENCH_TABLE}"
+    create_mor_table(spark, mor_table)
+    mod.ensure_namespace_exists(BENCH_CATALOG, BENCH_COW_DB)
+
+    results = []
+    write_baseline(spark, mor_table, args.rows)
+    results.append(run_timed_cycle(mod, mor_table, "baseline"))
+
+    batch = 0
+    for it in range(args.iterations):
+        for b in range(args.boundaries):
+            write_cdc_batch(spark, mor_table, args.rows, batch, args.update_ratio, args.delete_ratio, args.insert_ratio)
+            batch += 1
+            if b < args.boundaries - 1:
+                spark.sql(f"TRUNCATE TABLE {mor_table}")
+        results.append(run_timed_cycle(mod, mor_table, f"incremental-{it + 1}"))
+
+    print_results(results)
+    output = args.output or os.path.join(args.work_dir, "results.json")
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "config": vars(args),
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+    print(f"Results written to {output}")
+    spark.stop()
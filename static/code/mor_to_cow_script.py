@@ -1,9 +1,28 @@
 import argparse
+import datetime
+import decimal
+import hashlib
 import json
 import os
+import random
+import re
+import shlex
+import shutil
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import Optional, Tuple, Union, List
 
-from pyspark.sql import SparkSession
+from pyspark import StorageLevel
+from pyspark.sql import SparkSession, Window
+from pyspark.sql import functions as F
 from pyspark.sql.utils import AnalysisException
 
 # Spark session is created in __main__ after we parse destination config.
@@ -28,6 +47,165 @@ COW_BASE_LOCATION = "<YOUR_COW_BASE_LOCATION>"
 
 PRIMARY_KEY = "_olake_id"
 
+# Per-table run metrics (overridable via --metrics-dir). When set, each cycle appends a JSON line to
+# compaction_metrics.jsonl and the latest values per table are written to olake_compaction.prom
+# (Prometheus node_exporter textfile format).
+METRICS_DIR = None
+
+# Local checkpoint index (overridable via --checkpoint-index): path of an SQLite file recording, per COW
+# table, the last published WAP ID, the COW snapshot it produced, the MOR parent snapshot, row counts and
+# a timestamp. Resume then costs one lookup plus the COW head check; entries that do not match the COW
+# head (external commits, crashed publishes) fall back to scanning the COW snapshots.
+CHECKPOINT_INDEX_PATH = None
+
+# Per-write profiling (overridable via --profile-dir). When set, the jobs of every COW MERGE/overwrite and
+# baseline CTAS run under their own Spark job group; afterwards their stages (durations, shuffle read/write,
+# spill, task-time skew) and SQL executions (physical plan, operator metrics) are read from the Spark UI REST
+# API and written as one JSON file per write to this directory. Requires the Spark UI (spark.ui.enabled).
+PROFILE_DIR = None
+
+# Daemon mode (--daemon): seconds between polls of each MOR table's current snapshot id.
+POLL_INTERVAL_SECONDS = 30
+
+# Offline dependency bundle (overridable via --jars-bundle-dir / --maven-repo).
+# When set, Spark loads pre-resolved, checksummed jars from this directory via spark.jars
+# instead of resolving spark.jars.packages through Ivy at startup. Populate it once with --resolve-bundle.
+JARS_BUNDLE_DIR = None
+MAVEN_REPO = "https://repo1.maven.org/maven2"
+
+# Compaction mode (overridable via --mode):
+# - "cow":     keep a separate copy-on-write copy of every MOR table under COW_DB (default).
+# - "inplace": no second copy; rewrite the MOR table's own data files so its delete files are applied
+#              and dropped (rewrite_data_files + rewrite_position_delete_files). Delete-unaware engines
+#              can then read the original table, and cost scales with the files that carry deletes.
+# - "changelog": keep a COW copy like "cow", but never TRUNCATE the MOR table. Each run applies the net
+#              changes between the last checkpoint MOR snapshot and the current head (inserts, updates
+#              and deletes) with one MERGE; the checkpoint is published as WAP ID "changelog-<snapshot id>".
+#              The MOR table keeps its history, and the checkpoint snapshot must not be expired.
+COMPACTION_MODE = "cow"
+# In-place mode: rewrite a data file once at least this many delete files apply to it.
+INPLACE_DELETE_FILE_THRESHOLD = 1
+
+# How a delta is written into the COW table (overridable via --merge-strategy):
+# - "merge":     row-level MERGE (see MERGE_MODE).
+# - "overwrite": dynamic overwrite of the COW partitions touched by the delta (partitioned COW tables only).
+# - "rebuild":   full overwrite of the COW table (COW rows not in the delta + the delta).
+# - "auto":      pick per boundary from the delta's record count relative to the COW table's,
+#                both read from snapshot summaries (no scan).
+MERGE_STRATEGY = "merge"
+AUTO_OVERWRITE_MIN_RATIO = 0.1
+AUTO_REBUILD_MIN_RATIO = 0.5
+
+# Partition-scoped MERGE (overridable via --partition-scoped-merge). COW tables inherit the MOR
+# partition spec; when enabled, the MERGE target is also restricted to the partitions the delta touches.
+# Assumes a row's partition source columns do not change across updates (e.g. created date, tenant):
+# a key whose old version sits in a partition the delta does not touch would otherwise be inserted twice.
+PARTITION_SCOPED_MERGE = False
+# Above this many distinct values for a partition field, that field is not used to scope the MERGE.
+PARTITION_SCOPE_MAX_VALUES = 1000
+
+# Catch-up mode (overridable via --coalesce-boundaries): when several truncate boundaries are pending
+# (e.g. after failed or skipped runs), union their parent snapshots, keep the latest version per
+# PRIMARY_KEY and apply them in one MERGE published under the newest boundary's WAP ID.
+COALESCE_BOUNDARIES = False
+
+# Post-merge COW maintenance (enabled via --maintenance). Runs once per table after its cycle publishes;
+# each action only runs when its threshold is crossed (from snapshot summaries / metadata):
+# - rewrite_data_files:  total data files >= MAINTENANCE_MAX_DATA_FILES, or average data file size
+#                        < MAINTENANCE_MIN_AVG_FILE_SIZE_BYTES with at least MAINTENANCE_MIN_FILES_FOR_SIZE files.
+# - expire_snapshots:    snapshot count > MAINTENANCE_MAX_SNAPSHOTS; always keeps the latest published
+#                        WAP snapshot (resume checkpoint) and the newest MAINTENANCE_RETAIN_SNAPSHOTS.
+# - remove_orphan_files: at most once per MAINTENANCE_ORPHAN_INTERVAL_HOURS (tracked as a table property).
+MAINTENANCE_ENABLED = False
+MAINTENANCE_TARGET_FILE_SIZE_BYTES = 512 * 1024 * 1024
+MAINTENANCE_MAX_DATA_FILES = 1000
+MAINTENANCE_MIN_AVG_FILE_SIZE_BYTES = 64 * 1024 * 1024
+MAINTENANCE_MIN_FILES_FOR_SIZE = 10
+MAINTENANCE_MAX_SNAPSHOTS = 100
+MAINTENANCE_RETAIN_SNAPSHOTS = 10
+MAINTENANCE_ORPHAN_INTERVAL_HOURS = 24 * 7
+
+# Sorted, bloom-filtered COW layout (enabled via --sorted-layout): COW tables get a write sort order
+# on PRIMARY_KEY and a Parquet bloom filter on that column. The sort keeps per-file min/max key ranges
+# narrow so key predicates prune files; bloom filters only skip row groups inside files that are read.
+# Applied to new and existing COW tables.
+COW_SORTED_LAYOUT = False
+
+# Bucketed COW layout (overridable via --cow-buckets; 0 disables): COW tables get an extra partition
+# field bucket(COW_BUCKETS, PRIMARY_KEY), and each delta is first written to a staging table bucketed
+# the same way. The MERGE can then use a storage-partitioned join (SPJ) instead of shuffling both sides.
+# SPJ needs both sides to report the same partitioning, so it only applies when the COW spec is the
+# bucket field alone (an unpartitioned MOR table); otherwise the buckets still prune the COW scan.
+# Existing COW tables are re-bucketed (spec change + rewrite of all data files) when N changes.
+COW_BUCKETS = 0
+
+# Per-table Spark SQL tuning (enabled via --auto-tune). Before each table's write, the delta size (the
+# merged MOR snapshot) and the COW size are read from snapshot summaries and session configs are set
+# for that write only:
+# - AQE with partition coalescing and skew-join handling;
+# - shuffle partitions = (delta + COW bytes) / TUNE_TARGET_PARTITION_BYTES, clamped to
+#   [TUNE_MIN_SHUFFLE_PARTITIONS, TUNE_MAX_SHUFFLE_PARTITIONS], and that advisory partition size;
+# - for the overwrite/rebuild strategies, deltas up to TUNE_BROADCAST_MAX_BYTES are broadcast into the
+#   anti join against COW instead of shuffled. MERGEs are left alone: with both MATCHED and NOT MATCHED
+#   clauses Spark plans them as a full outer join, which cannot use a broadcast.
+# The chosen values are printed and recorded in the run metrics.
+AUTO_TUNE = False
+TUNE_TARGET_PARTITION_BYTES = 128 * 1024 * 1024
+TUNE_MIN_SHUFFLE_PARTITIONS = 8
+TUNE_MAX_SHUFFLE_PARTITIONS = 4000
+TUNE_BROADCAST_MAX_BYTES = 64 * 1024 * 1024
+
+# Commit retries (overridable via --retry-attempts / --retry-base-delay). Failed commits are classified by
+# error type (see classify_commit_error) and retried with exponential backoff and full jitter:
+# - TRUNCATE and MERGE/overwrite: retried on commit conflicts and transient catalog/storage errors;
+#   a failed commit stages nothing, so re-running that one statement is safe.
+# - publish: only the cherry-pick of the already staged WAP snapshot is retried (also when the commit
+#   state is unknown, as publishing is idempotent); the MERGE is never re-run for a publish failure.
+RETRY_MAX_ATTEMPTS = 4
+RETRY_BASE_DELAY_SECONDS = 1.0
+RETRY_MAX_DELAY_SECONDS = 30.0
+
+# Pre-publish audit (enabled via --audit). Between the staged WAP commit and the publish, each write is
+# checked against its delta and publishing is blocked on a mismatch (only the rejected staged snapshot is
+# expired, or the COW table dropped when it was a first baseline; the pending checkpoint marker is cleared):
+# - row counts from snapshot summaries: the staged commit added at least the delta's rows, and the COW
+#   table grew by no more than the delta's new keys (nor shrank by more than its deleted keys);
+# - an order-independent 64-bit hash aggregate (sum of xxhash64 over the delta's columns, PRIMARY_KEY
+#   included) and row count of the delta, computed in the pass that caches the write's source,
+#   must equal those of the staged COW rows for the delta's keys (read from the files the commit added).
+# Baselines are checked from summaries only (staged rows vs the MOR snapshot's record count).
+AUDIT_ENABLED = False
+
+# Number of tables compacted concurrently (overridable via --parallelism).
+# With more than one worker, each worker thread gets its own SparkSession (sharing the
+# SparkContext and catalog config) so session-level settings like spark.wap.id do not race,
+# and each table's jobs run in their own FAIR scheduler pool.
+PARALLELISM = 1
+
+# Metadata prefetch (overridable via --prefetch-parallelism; 0 disables): after listing the MOR tables,
+# load every table's catalog metadata concurrently (MOR/COW existence, schema and current snapshot id,
+# MOR snapshot index, COW resume checkpoint) into the per-run cache, so planning and the per-table cycles
+# start from memory instead of issuing blocking catalog round trips one table at a time.
+PREFETCH_PARALLELISM = 8
+
+# MERGE mode (overridable via --merge-mode):
+# - "full":   plain MERGE on the primary key; the whole COW table is a join candidate.
+# - "pruned": derive the delta's key set (or key range) first and add it to the MERGE condition
+#             as a target-only predicate, so Iceberg skips COW files whose PRIMARY_KEY min/max
+#             range excludes every delta key. Parquet bloom filters (when the files have them) only
+#             skip row groups inside files that are still opened; they do not prune files.
+MERGE_MODE = "full"
+# Above this many delta keys, pruned mode falls back from an IN-list to a BETWEEN range.
+PRUNED_MERGE_MAX_KEYS = 10000
+
+# Batch mode (--batch): compact every job record in destination_details.json (array format) and every
+# source namespace of each job. Jobs whose catalog config is identical share one SparkSession. With more
+# than one distinct config, each config runs in its own child process: jars (spark.jars / spark.jars.packages)
+# and AWS environment only take effect when a JVM is launched. Each (job, namespace) gets its own COW
+# namespace from this template ({namespace} and {job_id} are substituted), and its COW tables are stored
+# under COW_BASE_LOCATION/<catalog>/<COW namespace>/, so equally named tables never share a location.
+BATCH_COW_DB_TEMPLATE = "{namespace}_cow"
+
 
 def _recompute_derived_names():
     # No derived names needed for state-table anymore.
@@ -60,18 +238,79 @@ def load_destination_writer_config(destination_details_path: str, job_id: Option
         if record is None:
             raise ValueError(f"job_id {job_id} not found in destination_details.json")
 
+    return _writer_from_record(record)
+
+
+def _writer_from_record(record: dict) -> dict:
     dest = record.get("destination") or {}
     config_str = dest.get("config")
     if not config_str:
         raise ValueError("destination.config missing in destination_details.json")
 
-    inner = json.loads(config_str)
+    inner = json.loads(config_str) if isinstance(config_str, str) else config_str
     writer = inner.get("writer")
     if not isinstance(writer, dict):
         raise ValueError("destination.config JSON does not contain a 'writer' object")
     return writer
 
 
+def _record_source_namespaces(record: dict, writer: dict) -> List[str]:
+    """
+    Iceberg namespaces holding a job's MOR tables:
+    - an explicit "namespaces" list on the record, if present;
+    - otherwise one per selected stream namespace in streams_config, named <iceberg_db>_<namespace>
+      the way OLake names them (e.g. postgres_main + public -> postgres_main_public);
+    - otherwise writer.iceberg_db itself.
+    """
+    if isinstance(record.get("namespaces"), list):
+        return [str(ns) for ns in record["namespaces"]]
+
+    iceberg_db = writer.get("iceberg_db")
+    streams = record.get("streams_config") or {}
+    if isinstance(streams, str):
+        try:
+            streams = json.loads(streams) if streams else {}
+        except ValueError:
+            streams = {}
+    selected = streams.get("selected_streams") if isinstance(streams, dict) else None
+
+    namespaces = []
+    for ns in (selected or {}):
+        name = f"{iceberg_db}_{ns}" if iceberg_db else ns
+        name = re.sub(r"[^a-z0-9_]", "_", name.lower())
+        if name not in namespaces:
+            namespaces.append(name)
+    if not namespaces and iceberg_db:
+        namespaces.append(str(iceberg_db))
+    return namespaces
+
+
+def load_batch_jobs(destination_details_path: str) -> List[dict]:
+    """
+    All job records of an array-format destination_details.json, as
+    [{"job_id": ..., "writer": {...}, "namespaces": [...]}] in file order.
+    """
+    with open(destination_details_path, "r", encoding="utf-8") as f:
+        outer = json.load(f)
+    if not isinstance(outer, list) or not outer:
+        raise ValueError("--batch requires destination_details.json to be a non-empty JSON array of job records")
+
+    jobs = []
+    for i, record in enumerate(outer):
+        if not isinstance(record, dict):
+            raise ValueError(
+                f"destination_details.json record {i} must be a JSON object (job record), got {type(record).__name__}"
+            )
+        job_id = record.get("job_id", record.get("id"))
+        writer = _writer_from_record(record)
+        namespaces = _record_source_namespaces(record, writer)
+        if not namespaces:
+            print(f"[job {job_id}] No source namespaces found (set 'namespaces' on the record); skipping.")
+            continue
+        jobs.append({"job_id": job_id, "writer": writer, "namespaces": namespaces})
+    return jobs
+
+
 def _normalize_warehouse(catalog_type: str, warehouse_val: str) -> str:
     """
     - REST/Lakekeeper: warehouse can be a Lakekeeper 'warehouse name' (not a URI).
@@ -98,8 +337,8 @@ def _spark_packages_for(writer: dict, catalog_type: str) -> str:
     Base packages are required for Iceberg + S3. JDBC catalogs additionally need a DB driver.
     """
     pkgs = [
-        "org.apache.iceberg:iceberg-spark-runtime-3.5_2.12:1.5.2",
-        "org.apache.iceberg:iceberg-aws-bundle:1.5.2",
+        "org.apache.iceberg:iceberg-spark-runtime-3.5_2.12:1.7.1",
+        "org.apache.iceberg:iceberg-aws-bundle:1.7.1",
         "org.apache.hadoop:hadoop-aws:3.3.4",
         "com.amazonaws:aws-java-sdk-bundle:1.12.262",
     ]
@@ -110,7 +349,8 @@ def _spark_packages_for(writer: dict, catalog_type: str) -> str:
         if jdbc_url.startswith("jdbc:postgresql:"):
             pkgs.append("org.postgresql:postgresql:42.5.4")
         elif jdbc_url.startswith("jdbc:mysql:"):
-            pkgs.append("mysql:mysql-connector-java:8.0.33")
+            # mysql:mysql-connector-java:8.0.33 is only a relocation POM; the jar lives under com.mysql.
+            pkgs.append("com.mysql:mysql-connector-j:8.0.33")
 
     # de-dupe while preserving order
     seen = set()
@@ -122,7 +362,145 @@ def _spark_packages_for(writer: dict, catalog_type: str) -> str:
     return ",".join(out)
 
 
-def build_spark_session_from_writer(writer: dict) -> SparkSession:
+_BUNDLE_MANIFEST = "manifest.json"
+
+
+def _bundle_dir_for(writer: dict, catalog_type: str, bundle_root: str) -> str:
+    """
+    Bundles are keyed by catalog type plus a digest of the package list, so e.g. JDBC catalogs
+    with different drivers get separate bundles.
+    """
+    packages = _spark_packages_for(writer, catalog_type)
+    digest = hashlib.sha256(packages.encode("utf-8")).hexdigest()[:12]
+    return os.path.join(bundle_root, f"{catalog_type}-{digest}")
+
+
+def _maven_jar_url(coordinate: str, repo: str) -> Tuple[str, str]:
+    group, artifact, version = coordinate.split(":")
+    file_name = f"{artifact}-{version}.jar"
+    url = f"{repo.rstrip('/')}/{group.replace('.', '/')}/{artifact}/{version}/{file_name}"
+    return url, file_name
+
+
+def _file_digest(path: str, algorithm: str = "sha256") -> str:
+    h = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _sha256_file(path: str) -> str:
+    return _file_digest(path, "sha256")
+
+
+# Run in a fresh Python process so Spark launches a new JVM and resolves spark.jars.packages through Ivy
+# (inside an already running driver JVM, spark.jars.packages is ignored).
+_IVY_RESOLVE_SNIPPET = """
+import sys
+from pyspark.sql import SparkSession
+(
+    SparkSession.builder.master("local[1]")
+    .config("spark.jars.packages", sys.argv[1])
+    .config("spark.jars.ivy", sys.argv[2])
+    .config("spark.jars.repositories", sys.argv[3])
+    .getOrCreate()
+    .stop()
+)
+"""
+
+
+def _ivy_resolved_jars(ivy_dir: str) -> List[Tuple[str, str]]:
+    """[(group:artifact:version, jar path)] from an Ivy cache laid out as <org>/<module>/jars/<module>-<rev>.jar."""
+    cache = os.path.join(ivy_dir, "cache")
+    out = []
+    for org in sorted(os.listdir(cache)):
+        org_dir = os.path.join(cache, org)
+        if not os.path.isdir(org_dir):
+            continue
+        for module in sorted(os.listdir(org_dir)):
+            jars_dir = os.path.join(org_dir, module, "jars")
+            if not os.path.isdir(jars_dir):
+                continue
+            for name in sorted(os.listdir(jars_dir)):
+                if name.startswith(module + "-") and name.endswith(".jar"):
+                    version = name[len(module) + 1:-len(".jar")]
+                    out.append((f"{org}:{module}:{version}", os.path.join(jars_dir, name)))
+    return out
+
+
+def _maven_sha1(coordinate: str, repo: str) -> str:
+    url, _ = _maven_jar_url(coordinate, repo)
+    with urllib.request.urlopen(url + ".sha1", timeout=60) as resp:
+        # Published .sha1 files hold the hex digest, sometimes followed by the file name.
+        return resp.read().decode("utf-8").split()[0].strip().lower()
+
+
+def resolve_dependency_bundle(writer: dict, bundle_root: str, repo: str = MAVEN_REPO) -> str:
+    """
+    Resolve this writer's packages (with their transitive dependencies) once through Ivy, copy the
+    resolved jars into a local bundle directory, verify each against the .sha1 published next to it
+    in the Maven repository, and write a manifest with SHA-256 checksums for later local verification.
+    Needs network access once; later runs use load_dependency_bundle().
+    """
+    catalog_type = (writer.get("catalog_type") or "").lower()
+    bundle_dir = _bundle_dir_for(writer, catalog_type, bundle_root)
+    os.makedirs(bundle_dir, exist_ok=True)
+    ivy_dir = os.path.join(bundle_dir, "ivy")
+
+    packages = _spark_packages_for(writer, catalog_type)
+    print(f"Resolving {packages} through Ivy ...")
+    subprocess.run([sys.executable, "-c", _IVY_RESOLVE_SNIPPET, packages, ivy_dir, repo], check=True)
+
+    jars = []
+    for coordinate, path in _ivy_resolved_jars(ivy_dir):
+        published = _maven_sha1(coordinate, repo)
+        actual = _file_digest(path, "sha1")
+        if actual != published:
+            raise ValueError(f"{coordinate}: sha1 {actual} does not match the published {published} in {repo}")
+        file_name = os.path.basename(path)
+        dest = os.path.join(bundle_dir, file_name)
+        shutil.copyfile(path, dest + ".part")
+        os.replace(dest + ".part", dest)
+        jars.append({"coordinate": coordinate, "file": file_name, "sha1": published, "sha256": _sha256_file(dest)})
+    if not jars:
+        raise ValueError(f"Ivy resolved no jars for {packages}")
+    shutil.rmtree(ivy_dir, ignore_errors=True)
+
+    # Manifest is written last (atomically), so a bundle without one is treated as incomplete.
+    manifest_path = os.path.join(bundle_dir, _BUNDLE_MANIFEST)
+    with open(manifest_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"catalog_type": catalog_type, "jars": jars}, f, indent=2)
+    os.replace(manifest_path + ".tmp", manifest_path)
+    print(f"Dependency bundle ready: {bundle_dir}")
+    return bundle_dir
+
+
+def load_dependency_bundle(writer: dict, catalog_type: str, bundle_root: str) -> List[str]:
+    """
+    Return absolute jar paths from a previously resolved bundle after verifying their checksums.
+    No network access and no resolver are involved.
+    """
+    bundle_dir = _bundle_dir_for(writer, catalog_type, bundle_root)
+    manifest_path = os.path.join(bundle_dir, _BUNDLE_MANIFEST)
+    if not os.path.exists(manifest_path):
+        raise ValueError(
+            f"No dependency bundle for catalog_type={catalog_type} under {bundle_root}; "
+            f"run with --resolve-bundle first"
+        )
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+
+    paths = []
+    for jar in manifest.get("jars") or []:
+        path = os.path.abspath(os.path.join(bundle_dir, jar["file"]))
+        if not os.path.exists(path) or _sha256_file(path) != jar["sha256"]:
+            raise ValueError(f"Dependency bundle jar {path} is missing or fails its checksum; re-run --resolve-bundle")
+        paths.append(path)
+    return paths
+
+
+def build_spark_session_from_writer(writer: dict, fair_scheduler: bool = False) -> SparkSession:
     catalog_type = (writer.get("catalog_type") or "").lower()
     catalog_name = writer.get("catalog_name") or CATALOG
     warehouse_raw = writer.get("iceberg_s3_path") or ""
@@ -158,17 +536,26 @@ def build_spark_session_from_writer(writer: dict) -> SparkSession:
     elif isinstance(s3_endpoint, str) and s3_endpoint.startswith("https://"):
         ssl_enabled = ssl_enabled or "true"
 
-    # Maven packages (network is available per your note)
-    packages = _spark_packages_for(writer, catalog_type)
-
     builder = SparkSession.builder.appName("OLake MOR to COW Compaction")
-    builder = builder.config("spark.jars.packages", packages)
+    if JARS_BUNDLE_DIR:
+        # Pre-resolved local jars: no network and no Ivy resolution at startup.
+        jars = load_dependency_bundle(writer, catalog_type, JARS_BUNDLE_DIR)
+        builder = builder.config("spark.jars", ",".join(jars))
+    else:
+        # Maven packages (network is available per your note)
+        packages = _spark_packages_for(writer, catalog_type)
+        builder = builder.config("spark.jars.packages", packages)
     builder = builder.config(
         "spark.sql.extensions",
         "org.apache.iceberg.spark.extensions.IcebergSparkSessionExtensions",
     )
     builder = builder.config("spark.sql.catalogImplementation", "in-memory")
     builder = builder.config("spark.sql.defaultCatalog", catalog_name)
+    # Snapshot metadata is collected to the driver via Arrow (see _collect_snapshot_rows).
+    builder = builder.config("spark.sql.execution.arrow.pyspark.enabled", "true")
+    if fair_scheduler:
+        # Per-table pools are created on demand with default weights; see _run_table_in_worker.
+        builder = builder.config("spark.scheduler.mode", "FAIR")
 
     # Ensure AWS SDK-based clients (e.g., GlueCatalog, Iceberg S3FileIO) can see credentials.
     # This avoids requiring users to export env vars in the container.
@@ -281,6 +668,90 @@ def build_spark_session_from_writer(writer: dict) -> SparkSession:
 # ------------------------------------------------------------------------------
 # Helpers
 # ------------------------------------------------------------------------------
+_thread_state = threading.local()
+
+
+def _session() -> SparkSession:
+    """
+    Return the SparkSession for the current thread.
+    Worker threads use their own child session (see _run_table_in_worker); otherwise the global one.
+    """
+    return getattr(_thread_state, "spark", None) or spark
+
+
+@contextmanager
+def _session_conf(settings: dict):
+    """Temporarily set SQL configs on the current session, restoring the previous values on exit."""
+    session = _session()
+    previous = {k: session.conf.get(k, None) for k in settings}
+    for k, v in settings.items():
+        session.conf.set(k, v)
+    try:
+        yield
+    finally:
+        for k, v in previous.items():
+            if v is None:
+                session.conf.unset(k)
+            else:
+                session.conf.set(k, v)
+
+
+ERROR_CONFLICT = "conflict"
+ERROR_TRANSIENT = "transient"
+ERROR_UNKNOWN_STATE = "unknown_state"
+ERROR_FATAL = "fatal"
+
+_ERROR_MARKERS = (
+    (ERROR_UNKNOWN_STATE, ("commitstateunknownexception",)),
+    (ERROR_CONFLICT, (
+        "commitfailedexception",
+        "found conflicting",
+        "found new conflicting",
+    )),
+    (ERROR_TRANSIENT, (
+        "throttl",
+        "slowdown",
+        "slow down",
+        "too many requests",
+        "serviceunavailable",
+        "service unavailable",
+        "connection reset",
+        "timed out",
+        "sockettimeoutexception",
+    )),
+)
+
+
+def classify_commit_error(e: Exception) -> str:
+    """Classify an error raised by a commit from its (Java) exception text."""
+    msg = str(e).lower()
+    for kind, markers in _ERROR_MARKERS:
+        if any(m in msg for m in markers):
+            return kind
+    return ERROR_FATAL
+
+
+def with_retries(label: str, fn, retry_on: Tuple[str, ...] = (ERROR_CONFLICT, ERROR_TRANSIENT)):
+    """
+    Call fn(); on an error classified into retry_on, retry up to RETRY_MAX_ATTEMPTS attempts in total,
+    sleeping a random 0..min(RETRY_MAX_DELAY_SECONDS, RETRY_BASE_DELAY_SECONDS * 2^n) seconds in between.
+    Other errors, and the last failed attempt, are raised.
+    """
+    attempt = 1
+    while True:
+        try:
+            return fn()
+        except Exception as e:
+            kind = classify_commit_error(e)
+            if kind not in retry_on or attempt >= RETRY_MAX_ATTEMPTS:
+                raise
+            delay = random.uniform(0, min(RETRY_MAX_DELAY_SECONDS, RETRY_BASE_DELAY_SECONDS * 2 ** (attempt - 1)))
+            print(f"{label}: {kind} error on attempt {attempt}/{RETRY_MAX_ATTEMPTS}; retrying in {delay:.1f}s ({e})")
+            _add_volume("commit_retries", 1)
+            time.sleep(delay)
+            attempt += 1
+
+
 def split_fqn(table_fqn: str):
     parts = table_fqn.split(".")
     if len(parts) != 3:
@@ -295,24 +766,132 @@ def cow_table_and_location_for(mor_table_fqn: str):
     return cow_table_fqn, cow_location
 
 
-def table_exists(table_name: str) -> bool:
+# Per-run cache of catalog metadata: {table_fqn: {"exists": bool, "schema": StructType, "current_snapshot_id": int}}.
+# Entries are dropped by invalidate_table_cache() whenever this script commits to a table, and by
+# refresh_table_cache_if_moved() at the start of a MOR table's cycle when OLake committed since they were read.
+_table_meta_cache: dict = {}
+_table_meta_lock = threading.Lock()
+
+
+def _cached_table_meta(table_fqn: str, key: str, loader):
+    with _table_meta_lock:
+        entry = _table_meta_cache.get(table_fqn)
+        if entry is not None and key in entry:
+            return entry[key]
+    value = loader()
+    with _table_meta_lock:
+        _table_meta_cache.setdefault(table_fqn, {})[key] = value
+    return value
+
+
+def invalidate_table_cache(table_fqn: Optional[str] = None):
+    """Drop cached metadata for one table (or everything when table_fqn is None)."""
+    with _table_meta_lock:
+        if table_fqn is None:
+            _table_meta_cache.clear()
+        else:
+            _table_meta_cache.pop(table_fqn, None)
+
+
+def _load_table_schema(table_name: str):
+    """
+    Resolve the table through the catalog and return its schema, or None if it does not exist.
+    Only table metadata is loaded; no scan is planned and no data files are opened.
+    """
     try:
-        spark.read.format("iceberg").load(table_name).limit(1).collect()
-        return True
+        return _session().table(table_name).schema
     except AnalysisException:
-        return False
+        return None
+
+
+def table_schema(table_name: str):
+    return _cached_table_meta(table_name, "schema", lambda: _load_table_schema(table_name))
+
+
+def table_exists(table_name: str) -> bool:
+    return table_schema(table_name) is not None
+
+
+def _load_current_snapshot_id(table_name: str) -> Optional[int]:
+    if not table_exists(table_name):
+        return None
+    rows = _session().sql(f"""
+        SELECT CAST(snapshot_id AS STRING) AS snapshot_id
+        FROM {table_name}.refs
+        WHERE name = 'main'
+    """).collect()
+    return _to_snapshot_id(rows[0]["snapshot_id"]) if rows else None
+
+
+def current_snapshot_id(table_name: str) -> Optional[int]:
+    """Current snapshot id of the table's main branch (None if missing or empty)."""
+    return _cached_table_meta(table_name, "current_snapshot_id", lambda: _load_current_snapshot_id(table_name))
+
+
+def refresh_table_cache_if_moved(table_name: str):
+    """
+    Re-read the table's main head (one .refs query) and drop its cached metadata if the head moved
+    since it was cached, e.g. OLake committed after the prefetch. Unchanged tables keep their cache.
+    """
+    with _table_meta_lock:
+        entry = _table_meta_cache.get(table_name)
+        if entry is None or "current_snapshot_id" not in entry:
+            return
+        cached = entry["current_snapshot_id"]
+    head = _load_current_snapshot_id(table_name)
+    if head != cached:
+        invalidate_table_cache(table_name)
+        with _table_meta_lock:
+            _table_meta_cache.setdefault(table_name, {})["current_snapshot_id"] = head
+
+
+def current_snapshot_summary(table_name: str) -> dict:
+    """Summary of the table's current snapshot ({} if missing or empty)."""
+    def load():
+        head = current_snapshot_id(table_name)
+        snap = _fetch_snapshot_with_summary(table_name, head) if head is not None else None
+        return (snap or {}).get("summary") or {}
+
+    return _cached_table_meta(table_name, "current_summary", load)
+
+
+def table_partitioning(table_name: str) -> List[str]:
+    """
+    Partition transforms of the table's current spec, as shown by DESCRIBE TABLE
+    (e.g. ["region", "days(created_at)", "bucket(16, _olake_id)"]). Empty for unpartitioned tables.
+    """
+    def load():
+        rows = _session().sql(f"DESCRIBE TABLE {table_name}").collect()
+        transforms = []
+        in_partitioning = False
+        for r in rows:
+            name = (r["col_name"] or "").strip()
+            if name == "# Partitioning":
+                in_partitioning = True
+                continue
+            if not in_partitioning:
+                continue
+            if not name or name.startswith("#"):
+                break
+            if name.startswith("Part "):
+                transform = (r["data_type"] or "").replace("`", "").strip()
+                if transform and not transform.startswith("void("):
+                    transforms.append(transform)
+        return transforms
+
+    return _cached_table_meta(table_name, "partitioning", load)
 
 
 def ensure_namespace_exists(catalog: str, namespace: str):
     # Create destination namespace for COW tables/state if missing.
     # Iceberg SparkCatalog supports CREATE NAMESPACE for REST/Glue catalogs.
-    spark.sql(f"CREATE NAMESPACE IF NOT EXISTS {catalog}.{namespace}")
+    _session().sql(f"CREATE NAMESPACE IF NOT EXISTS {catalog}.{namespace}")
 
 
 def enable_wap_for_table(cow_table_fqn: str):
     """Enable WAP (Write-Audit-Publish) for the COW table if not already enabled."""
     try:
-        spark.sql(f"ALTER TABLE {cow_table_fqn} SET TBLPROPERTIES ('write.wap.enabled'='true')")
+        _session().sql(f"ALTER TABLE {cow_table_fqn} SET TBLPROPERTIES ('write.wap.enabled'='true')")
     except Exception:
         # WAP might already be enabled, ignore error
         pass
@@ -320,57 +899,217 @@ def enable_wap_for_table(cow_table_fqn: str):
 
 def get_wap_id_from_table(cow_table_fqn: str, catalog_name: str) -> Optional[str]:
     """
-    Get the latest published WAP ID from the COW table.
+    Get the latest WAP ID from the COW table.
     Returns the WAP ID (string) or None if no WAP ID exists.
-    
-    Queries the COW table's snapshot metadata to find WAP IDs stored in snapshot summaries.
+
+    Uses the checkpoint index when its entry matches the COW head; otherwise scans all of the COW
+    table's snapshots (newest first, staged ones included so a crashed publish is finalized on resume)
+    and refreshes the index entry.
     """
     if not table_exists(cow_table_fqn):
         return None
 
-    # Check snapshot metadata for WAP ID
+    head_id = current_snapshot_id(cow_table_fqn)
+    entry = read_checkpoint_index(cow_table_fqn)
+    if entry and entry["pending_wap_id"] is None and head_id is not None and entry["cow_snapshot_id"] == head_id:
+        return entry["wap_id"]
+
     try:
-        rows = spark.sql(f"""
-            SELECT summary
-            FROM {cow_table_fqn}.snapshots
-            WHERE summary IS NOT NULL
-            ORDER BY committed_at DESC
-            LIMIT 10
-        """).collect()
-        for r in rows:
-            d = r.asDict(recursive=True)
-            summary = d.get("summary") or {}
-            if isinstance(summary, dict):
-                # Look for wap_id in snapshot summary (check multiple key variations)
-                wap_id = summary.get("wap.id") or summary.get("wap_id") or summary.get("wap-id")
-                if wap_id:
-                    return str(wap_id)
+        for snap in _snapshots_newest_first(snapshot_index(cow_table_fqn)):
+            wap_id = _summary_wap_id(snap.get("summary"))
+            if wap_id:
+                if snap.get("snapshot_id") == head_id:
+                    # Published and still the head: safe to serve from the index next time.
+                    write_checkpoint_index(cow_table_fqn, wap_id, head_id)
+                return wap_id
     except Exception:
         pass
-    
+
     return None
 
 
+def _wap_id_published(cow_table_fqn: str, wap_id: str) -> bool:
+    """
+    True if main's lineage carries wap_id: the staged snapshot itself after a fast-forward (wap.id),
+    or the snapshot a cherry-pick created from it (published-wap-id).
+    """
+    head = current_snapshot_id(cow_table_fqn)
+    if head is None:
+        return False
+    return any(
+        _summary_wap_id(snap.get("summary")) == str(wap_id)
+        for snap in walk_lineage(snapshot_index(cow_table_fqn), head)
+    )
+
+
 def publish_wap_changes(cow_table_fqn: str, catalog_name: str, wap_id: str):
     """
     Publish WAP changes. Idempotent - can be called multiple times safely.
-    Catches duplicate WAP commit errors and cherry-pick validation errors (occurs when re-publishing already published WAP IDs).
+    Whether wap_id is already published is read from main's lineage, never inferred from an error.
+    Conflicts, transient errors and unknown commit states are retried (see with_retries); if they persist,
+    the staged snapshot stays for the next run. Any other rejection (a static overwrite that is not a
+    fast-forward of main, replaced partitions that changed meanwhile, ...) expires the snapshots staged
+    under wap_id, so no later run resumes from them, and raises.
     """
+    if _wap_id_published(cow_table_fqn, wap_id):
+        print(f"[{cow_table_fqn}] WAP ID {wap_id} already published (idempotent operation).")
+        return
     try:
-        spark.sql(f"CALL {catalog_name}.system.publish_changes('{cow_table_fqn}', '{wap_id}')")
+        # Retries repeat only the cherry-pick; the staged snapshot is already committed.
+        with_retries(
+            f"[{cow_table_fqn}] publish {wap_id}",
+            lambda: _session().sql(f"CALL {catalog_name}.system.publish_changes('{cow_table_fqn}', '{wap_id}')"),
+            retry_on=(ERROR_CONFLICT, ERROR_TRANSIENT, ERROR_UNKNOWN_STATE),
+        )
     except Exception as e:
-        error_msg = str(e).lower()
-        # DuplicateWAPCommitException: "Duplicate request to cherry pick wap id that was published already"
-        # Cherry-pick validation errors: "cannot cherry-pick" or "not append, dynamic overwrite, or fast-forward"
-        # Both indicate the WAP ID is already published, which is idempotent
-        if ("duplicate" in error_msg and "wap" in error_msg and "published already" in error_msg) or \
-           "cannot cherry-pick" in error_msg or \
-           "not append, dynamic overwrite, or fast-forward" in error_msg:
-            # Idempotent - already published, that's fine
+        invalidate_table_cache(cow_table_fqn)
+        if _wap_id_published(cow_table_fqn, wap_id):
+            # e.g. an unknown commit state whose commit did land.
             print(f"[{cow_table_fqn}] WAP ID {wap_id} already published (idempotent operation).")
-        else:
-            # Re-raise if it's a different error
+            return
+        if classify_commit_error(e) != ERROR_FATAL:
             raise
+        outcome = _discard_staged_snapshots(cow_table_fqn, _unpublished_wap_snapshot_ids(cow_table_fqn, wap_id))
+        raise RuntimeError(
+            f"[{cow_table_fqn}] Staged snapshot for WAP ID {wap_id} cannot be published onto main ({outcome}): {e}"
+        ) from e
+    invalidate_table_cache(cow_table_fqn)
+
+
+# ------------------------------------------------------------------------------
+# Checkpoint index (local SQLite sidecar)
+# ------------------------------------------------------------------------------
+_checkpoint_index_lock = threading.Lock()
+
+
+def _checkpoint_index_connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(CHECKPOINT_INDEX_PATH, timeout=30)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS checkpoints (
+            cow_table TEXT PRIMARY KEY,
+            wap_id TEXT,
+            cow_snapshot_id TEXT,
+            mor_parent_snapshot_id TEXT,
+            delta_records INTEGER,
+            cow_records INTEGER,
+            pending_wap_id TEXT,
+            updated_at REAL NOT NULL
+        )
+    """)
+    return conn
+
+
+def read_checkpoint_index(cow_table_fqn: str) -> Optional[dict]:
+    """The table's checkpoint index entry, or None (also when CHECKPOINT_INDEX_PATH is unset)."""
+    if not CHECKPOINT_INDEX_PATH:
+        return None
+    with _checkpoint_index_lock:
+        conn = _checkpoint_index_connect()
+        try:
+            conn.row_factory = sqlite3.Row
+            row = conn.execute("SELECT * FROM checkpoints WHERE cow_table = ?", (cow_table_fqn,)).fetchone()
+        finally:
+            conn.close()
+    if row is None:
+        return None
+    entry = dict(row)
+    entry["cow_snapshot_id"] = _to_snapshot_id(entry["cow_snapshot_id"])
+    entry["mor_parent_snapshot_id"] = _to_snapshot_id(entry["mor_parent_snapshot_id"])
+    return entry
+
+
+def write_checkpoint_index(
+    cow_table_fqn: str,
+    wap_id: str,
+    cow_snapshot_id: Optional[int],
+    mor_parent_snapshot_id: Optional[int] = None,
+    delta_records: Optional[int] = None,
+    cow_records: Optional[int] = None,
+):
+    """Replace the table's entry with a published checkpoint (one SQLite transaction)."""
+    if not CHECKPOINT_INDEX_PATH:
+        return
+    with _checkpoint_index_lock:
+        conn = _checkpoint_index_connect()
+        try:
+            with conn:
+                conn.execute(
+                    """
+                    INSERT OR REPLACE INTO checkpoints (
+                        cow_table, wap_id, cow_snapshot_id, mor_parent_snapshot_id,
+                        delta_records, cow_records, pending_wap_id, updated_at
+                    ) VALUES (?, ?, ?, ?, ?, ?, NULL, ?)
+                    """,
+                    (
+                        cow_table_fqn,
+                        str(wap_id),
+                        None if cow_snapshot_id is None else str(cow_snapshot_id),
+                        None if mor_parent_snapshot_id is None else str(mor_parent_snapshot_id),
+                        delta_records,
+                        cow_records,
+                        time.time(),
+                    ),
+                )
+        finally:
+            conn.close()
+
+
+def mark_checkpoint_pending(cow_table_fqn: str, wap_id: Union[int, str]):
+    """
+    Flag that a commit under wap_id is about to be staged. Until record_checkpoint clears it,
+    reads fall back to the snapshot scan, which also sees the staged (unpublished) snapshot.
+    """
+    if not CHECKPOINT_INDEX_PATH:
+        return
+    with _checkpoint_index_lock:
+        conn = _checkpoint_index_connect()
+        try:
+            with conn:
+                conn.execute(
+                    "INSERT OR IGNORE INTO checkpoints (cow_table, updated_at) VALUES (?, ?)",
+                    (cow_table_fqn, time.time()),
+                )
+                conn.execute(
+                    "UPDATE checkpoints SET pending_wap_id = ?, updated_at = ? WHERE cow_table = ?",
+                    (str(wap_id), time.time(), cow_table_fqn),
+                )
+        finally:
+            conn.close()
+
+
+def clear_checkpoint_pending(cow_table_fqn: str):
+    """Drop the pending marker after a staged commit was rejected; the last published checkpoint stays."""
+    if not CHECKPOINT_INDEX_PATH:
+        return
+    with _checkpoint_index_lock:
+        conn = _checkpoint_index_connect()
+        try:
+            with conn:
+                conn.execute(
+                    "UPDATE checkpoints SET pending_wap_id = NULL, updated_at = ? WHERE cow_table = ?",
+                    (time.time(), cow_table_fqn),
+                )
+        finally:
+            conn.close()
+
+
+def record_checkpoint(
+    cow_table_fqn: str,
+    wap_id: Union[int, str],
+    mor_parent_snapshot_id: Optional[int],
+    delta_records: Optional[int],
+):
+    """After a publish: store the new checkpoint with the COW head it produced."""
+    if not CHECKPOINT_INDEX_PATH:
+        return
+    write_checkpoint_index(
+        cow_table_fqn,
+        str(wap_id),
+        current_snapshot_id(cow_table_fqn),
+        mor_parent_snapshot_id=mor_parent_snapshot_id,
+        delta_records=delta_records,
+        cow_records=_summary_int(current_snapshot_summary(cow_table_fqn), "total-records"),
+    )
 
 
 def extract_truncate_id_from_wap_id(wap_id: str) -> Optional[int]:
@@ -381,44 +1120,193 @@ def extract_truncate_id_from_wap_id(wap_id: str) -> Optional[int]:
         return None
 
 
+CHANGELOG_WAP_PREFIX = "changelog-"
+
+
+def changelog_wap_id(mor_snapshot_id: int) -> str:
+    return f"{CHANGELOG_WAP_PREFIX}{mor_snapshot_id}"
+
+
+def extract_changelog_id_from_wap_id(wap_id: str) -> Optional[int]:
+    """MOR snapshot id from a changelog-mode WAP ID ("changelog-<snapshot id>"), else None."""
+    if not wap_id or not str(wap_id).startswith(CHANGELOG_WAP_PREFIX):
+        return None
+    return _to_snapshot_id(str(wap_id)[len(CHANGELOG_WAP_PREFIX):])
+
+
+def checkpoint_from_wap_id(wap_id: Optional[str]) -> Optional[int]:
+    """MOR snapshot id the COW table is in sync with: the changelog checkpoint or the truncate boundary."""
+    if not wap_id:
+        return None
+    if str(wap_id).startswith(CHANGELOG_WAP_PREFIX):
+        return extract_changelog_id_from_wap_id(wap_id)
+    return extract_truncate_id_from_wap_id(wap_id)
+
+
 # ------------------------------------------------------------------------------
 # Iceberg snapshot helpers
 # ------------------------------------------------------------------------------
-def get_latest_snapshot_and_parent_id(table_fqn: str):
+_SNAPSHOT_COLUMNS = (
+    "CAST(snapshot_id AS STRING) AS snapshot_id, "
+    "CAST(parent_id AS STRING) AS parent_id, "
+    "committed_at, operation, summary"
+)
+
+
+def _to_snapshot_id(v) -> Optional[int]:
+    if v is None:
+        return None
+    try:
+        return int(v)
+    except Exception:
+        # pandas represents missing values as NaN/NaT
+        return None
+
+
+def _to_timestamp(v):
+    # pandas represents missing timestamps as NaT, which is not None and never equals itself.
+    if v is None or v != v:
+        return None
+    return v
+
+
+def _to_summary(v) -> dict:
+    if v is None:
+        return {}
+    if isinstance(v, dict):
+        return v
+    try:
+        # Arrow map values may come back as a list of (key, value) pairs
+        return dict(v)
+    except Exception:
+        return {}
+
+
+def _collect_snapshot_rows(table_fqn: str, where: str = "") -> List[dict]:
     """
-    Return the most recent TRUNCATE-like snapshot (snapshot_id, parent_id).
-    To be robust against a small race where new OLake writes are committed
-    immediately after our TRUNCATE, we look at the latest few snapshots and
-    pick the first one that matches the truncate boundary signature.
+    Read snapshot rows from the `.snapshots` metadata table in a single Spark job.
+
+    Rows are collected through Arrow (toPandas) instead of Row.asDict(recursive=True).
+    Snapshot ids are cast to strings in SQL so nullable 64-bit ids never go through float64.
     """
-    rows = spark.sql(f"""
-        SELECT snapshot_id, parent_id, committed_at, operation, summary
-        FROM {table_fqn}.snapshots
-        ORDER BY committed_at DESC
-        LIMIT 10
-    """).collect()
-    if not rows:
-        return None, None
+    df = _session().sql(f"SELECT {_SNAPSHOT_COLUMNS} FROM {table_fqn}.snapshots {where}")
+    try:
+        records = df.toPandas().to_dict("records")
+    except ImportError:
+        # pandas/pyarrow not installed on the driver; fall back to plain collect.
+        records = [r.asDict(recursive=True) for r in df.collect()]
 
     snaps = []
-    by_id = {}
-    for r in rows:
-        d = r.asDict(recursive=True)
-        snap = {
-            "snapshot_id": d.get("snapshot_id"),
-            "parent_id": d.get("parent_id"),
-            "committed_at": d.get("committed_at"),
+    for d in records:
+        snaps.append({
+            "snapshot_id": _to_snapshot_id(d.get("snapshot_id")),
+            "parent_id": _to_snapshot_id(d.get("parent_id")),
+            "committed_at": _to_timestamp(d.get("committed_at")),
             "operation": d.get("operation"),
-            "summary": d.get("summary"),
-        }
-        snaps.append(snap)
+            "summary": _to_summary(d.get("summary")),
+        })
+    return snaps
+
+
+def build_snapshot_index(table_fqn: str) -> dict:
+    """
+    Read the table's `.snapshots` metadata table once and return {snapshot_id: snapshot}.
+    Each snapshot dict carries its parent_id, so lineage walks are pure in-memory lookups.
+    """
+    index = {}
+    for snap in _collect_snapshot_rows(table_fqn):
         sid = snap.get("snapshot_id")
         if sid is not None:
-            by_id[sid] = snap
+            index[sid] = snap
+    return index
+
+
+def snapshot_index(table_fqn: str) -> dict:
+    """Cached build_snapshot_index(); dropped with the rest of the table's cached metadata on commit."""
+    return _cached_table_meta(table_fqn, "snapshot_index", lambda: build_snapshot_index(table_fqn))
+
+
+def _committed_at_key(snap: dict):
+    """Sort key by commit time; missing timestamps (None, or pandas NaT which != itself) sort first."""
+    ts = snap.get("committed_at")
+    valid = ts is not None and ts == ts
+    return (valid, ts if valid else 0)
+
+
+def _snapshots_newest_first(index: dict) -> List[dict]:
+    return sorted(index.values(), key=_committed_at_key, reverse=True)
+
+
+def walk_lineage(index: dict, head_snapshot_id: int, stop_at_snapshot_id: Optional[int] = None) -> List[dict]:
+    """
+    Walk parent pointers from head back to (but not including) stop_at_snapshot_id.
+    Returns snapshots in chronological order (oldest -> newest).
+    """
+    lineage: List[dict] = []
+    cur_id = head_snapshot_id
+    seen = set()
+    while cur_id is not None and cur_id not in seen:
+        seen.add(cur_id)
+        snap = index.get(cur_id)
+        if snap is None:
+            break
+        lineage.append(snap)
+
+        parent_id = snap.get("parent_id")
+        # Stop once we've reached the snapshot whose parent is the checkpoint; this ensures we only
+        # reprocess snapshots strictly after the checkpoint.
+        if stop_at_snapshot_id is not None and parent_id == stop_at_snapshot_id:
+            break
+        cur_id = parent_id
+
+    lineage.reverse()
+    return lineage
+
+
+def pending_snapshots_since(index: dict, head_snapshot_id: Optional[int], checkpoint_id: int) -> Optional[List[dict]]:
+    """
+    Snapshots committed after checkpoint_id up to head (chronological order).
+    Returns None when the checkpoint is not an ancestor of head (e.g. expired history),
+    in which case callers must assume there is pending work.
+    """
+    if head_snapshot_id is None:
+        return None
+    if head_snapshot_id == checkpoint_id:
+        return []
+    lineage = walk_lineage(index, head_snapshot_id, stop_at_snapshot_id=checkpoint_id)
+    if not lineage or lineage[0].get("parent_id") != checkpoint_id:
+        return None
+    return lineage
+
+
+def _has_new_data(snaps: List[dict]) -> bool:
+    for snap in snaps:
+        summary = snap.get("summary") or {}
+        if (_summary_int(summary, "added-records") or 0) > 0:
+            return True
+        if (_summary_int(summary, "added-data-files") or 0) > 0:
+            return True
+        if _added_delete_files(summary) > 0:
+            return True
+    return False
+
+
+def get_latest_snapshot_and_parent_id(table_fqn: str, index: Optional[dict] = None):
+    """
+    Return the most recent TRUNCATE-like snapshot (snapshot_id, parent_id).
+    To be robust against a small race where new OLake writes are committed
+    immediately after our TRUNCATE, we look at the latest few snapshots and
+    pick the first one that matches the truncate boundary signature.
+    """
+    if index is None:
+        index = snapshot_index(table_fqn)
+    snaps = _snapshots_newest_first(index)[:10]
+    if not snaps:
+        return None, None
 
     # Among these most recent snapshots, find the newest one that looks like a truncate.
     for snap in snaps:
-        parent = by_id.get(snap.get("parent_id"))
+        parent = index.get(snap.get("parent_id"))
         if _is_truncate_boundary_snapshot(snap, parent):
             return snap.get("snapshot_id"), snap.get("parent_id")
 
@@ -543,97 +1431,1092 @@ def _is_truncate_boundary_snapshot(snap: dict, parent: Optional[dict]) -> bool:
 
 
 # ------------------------------------------------------------------------------
-# Merge + schema alignment
+# Run metrics
 # ------------------------------------------------------------------------------
-def align_cow_schema(cow_table_fqn: str, mor_df, cow_df):
-    mor_schema = {f.name: f.dataType for f in mor_df.schema.fields}
-    cow_schema = {f.name: f.dataType for f in cow_df.schema.fields}
+METRICS_JSONL_FILE = "compaction_metrics.jsonl"
+METRICS_PROM_FILE = "olake_compaction.prom"
 
-    for col, dtype in mor_schema.items():
-        if col not in cow_schema:
-            print(f"Adding new column '{col}' with type '{dtype.simpleString()}' to COW table")
-            spark.sql(f"""
-                ALTER TABLE {cow_table_fqn}
-                ADD COLUMN {col} {dtype.simpleString()}
-            """)
+_metrics_lock = threading.Lock()
+# Latest finished cycle per table, rendered into the Prometheus textfile.
+_last_table_metrics: dict = {}
 
-    for col, mor_type in mor_schema.items():
-        if col in cow_schema:
-            cow_type = cow_schema[col]
+
+def _current_metrics() -> Optional[dict]:
+    return getattr(_thread_state, "metrics", None)
+
+
+@contextmanager
+def _phase(name: str):
+    """Accumulate wall-clock seconds for a phase of the current table's cycle."""
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        m = _current_metrics()
+        if m is not None:
+            m["phases"][name] = m["phases"].get(name, 0.0) + (time.monotonic() - start)
+
+
+def _record_decision(key: str, value):
+    """Record a per-table choice (strategy, tuning value, ...) in the current cycle's metrics."""
+    m = _current_metrics()
+    if m is not None:
+        m["decisions"][key] = value
+
+
+def _add_volume(key: str, value: Optional[int]):
+    m = _current_metrics()
+    if m is not None and value is not None:
+        m["volume"][key] = m["volume"].get(key, 0) + int(value)
+
+
+def _record_delta_volume(delta_snap: Optional[dict]):
+    """
+    Rows/files read from MOR: totals of the snapshot that gets merged. Rows read include the
+    equality/position delete rows, which a MOR scan reads alongside the data rows.
+    """
+    summary = (delta_snap or {}).get("summary") or {}
+    data_rows = _summary_int(summary, "total-records")
+    delete_rows = None
+    for key in ("total-equality-deletes", "total-position-deletes"):
+        v = _summary_int(summary, key)
+        if v is not None:
+            delete_rows = (delete_rows or 0) + v
+    if data_rows is not None or delete_rows is not None:
+        _add_volume("delta_rows_read", (data_rows or 0) + (delete_rows or 0))
+    _add_volume("delta_delete_rows_read", delete_rows)
+    _add_volume("delta_data_files_read", _summary_int(summary, "total-data-files"))
+    _add_volume("delta_delete_files_read", _total_delete_files(summary))
+
+
+def _pending_delta_summary(pending: List[dict]) -> dict:
+    """Sum what the pending snapshots added into a totals-shaped summary for _record_delta_volume()."""
+    keys = {
+        "added-records": "total-records",
+        "added-equality-deletes": "total-equality-deletes",
+        "added-position-deletes": "total-position-deletes",
+        "added-data-files": "total-data-files",
+        "added-delete-files": "total-delete-files",
+        "added-files-size": "total-files-size",
+    }
+    totals = {}
+    for snap in pending:
+        summary = snap.get("summary") or {}
+        for added_key, total_key in keys.items():
+            v = _summary_int(summary, added_key)
+            if v is not None:
+                totals[total_key] = totals.get(total_key, 0) + v
+    return {"summary": {k: str(v) for k, v in totals.items()}}
+
+
+def _record_commit_volume(cow_table_fqn: str):
+    """Rows/files added and removed by the COW commit that was just published (from its snapshot summary)."""
+    if METRICS_DIR is None:
+        return
+    head = current_snapshot_id(cow_table_fqn)
+    snap = _fetch_snapshot_with_summary(cow_table_fqn, head) if head is not None else None
+    summary = (snap or {}).get("summary") or {}
+    _add_volume("cow_rows_added", _summary_int(summary, "added-records"))
+    _add_volume("cow_rows_removed", _summary_int(summary, "deleted-records"))
+    _add_volume("cow_files_added", _summary_int(summary, "added-data-files"))
+    _add_volume("cow_files_removed", _removed_data_files(summary))
+    _add_volume("cow_bytes_added", _summary_int(summary, "added-files-size"))
+    _add_volume("cow_bytes_removed", _summary_int(summary, "removed-files-size"))
+
+
+def _escape_label(v: str) -> str:
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _write_prometheus_textfile(path: str, table_metrics: dict):
+    lines = []
+
+    def family(name: str, help_text: str, samples: List[Tuple[dict, float]]):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        for labels, value in samples:
+            label_str = ",".join(f'{k}="{_escape_label(v)}"' for k, v in labels.items())
+            lines.append(f"{name}{{{label_str}}} {value}")
+
+    tables = sorted(table_metrics.values(), key=lambda m: m["table"])
+    family(
+        "olake_compaction_last_run_timestamp_seconds",
+        "Unix time the table's last compaction cycle finished.",
+        [({"table": m["table"]}, m["finished_at"]) for m in tables],
+    )
+    family(
+        "olake_compaction_last_success",
+        "1 if the table's last compaction cycle succeeded or was skipped, else 0.",
+        [({"table": m["table"]}, 0 if m["status"] == "failed" else 1) for m in tables],
+    )
+    family(
+        "olake_compaction_last_duration_seconds",
+        "Wall-clock seconds of the table's last compaction cycle.",
+        [({"table": m["table"]}, round(m["duration_seconds"], 3)) for m in tables],
+    )
+    family(
+        "olake_compaction_last_phase_seconds",
+        "Wall-clock seconds per phase in the table's last compaction cycle.",
+        [({"table": m["table"], "phase": k}, round(v, 3)) for m in tables for k, v in sorted(m["phases"].items())],
+    )
+    family(
+        "olake_compaction_last_volume",
+        "Rows/files/bytes read, added and removed in the table's last compaction cycle.",
+        [({"table": m["table"], "metric": k}, v) for m in tables for k, v in sorted(m["volume"].items())],
+    )
+
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    # Atomic replace so the node_exporter never reads a half-written file.
+    os.replace(tmp, path)
+
+
+def _run_cycle_with_metrics(mor_table_fqn: str) -> str:
+    """Run one compaction cycle, timing its phases; emit metrics when METRICS_DIR is set."""
+    m = {"table": mor_table_fqn, "phases": {}, "volume": {}, "decisions": {}, "started_at": time.time()}
+    _thread_state.metrics = m
+    status, error = "failed", None
+    try:
+        # Metadata may have been prefetched long before this table's turn.
+        refresh_table_cache_if_moved(mor_table_fqn)
+        if COMPACTION_MODE == "inplace":
+            status = run_inplace_cycle_for_table(mor_table_fqn)
+        elif COMPACTION_MODE == "changelog":
+            status = run_changelog_cycle_for_table(mor_table_fqn)
+        else:
+            status = run_compaction_cycle_for_table(mor_table_fqn)
+        return status
+    except Exception as e:
+        error = str(e)
+        raise
+    finally:
+        _thread_state.metrics = None
+        m["finished_at"] = time.time()
+        m["duration_seconds"] = m["finished_at"] - m["started_at"]
+        m["status"] = status
+        m["error"] = error
+        phases = " ".join(f"{k}={v:.1f}s" for k, v in m["phases"].items())
+        print(f"[{mor_table_fqn}] {status} in {m['duration_seconds']:.1f}s ({phases})")
+        if METRICS_DIR is not None:
+            with _metrics_lock:
+                _last_table_metrics[mor_table_fqn] = m
+                with open(os.path.join(METRICS_DIR, METRICS_JSONL_FILE), "a", encoding="utf-8") as f:
+                    f.write(json.dumps(m, sort_keys=True) + "\n")
+
+
+def write_run_metrics():
+    """Render the latest per-table metrics as a Prometheus textfile (no-op without METRICS_DIR)."""
+    if METRICS_DIR is None:
+        return
+    with _metrics_lock:
+        _write_prometheus_textfile(os.path.join(METRICS_DIR, METRICS_PROM_FILE), dict(_last_table_metrics))
+
+
+# ------------------------------------------------------------------------------
+# Profiling
+# ------------------------------------------------------------------------------
+def _spark_ui_get(path: str):
+    sc = _session().sparkContext
+    url = f"{sc.uiWebUrl}/api/v1/applications/{sc.applicationId}{path}"
+    with urllib.request.urlopen(url, timeout=30) as resp:
+        return json.loads(resp.read().decode("utf-8"))
+
+
+def _stage_profile(stage_id: int) -> List[dict]:
+    """Per-attempt metrics of one stage, with task-time skew (max / median executor run time)."""
+    attempts = []
+    for st in _spark_ui_get(f"/stages/{stage_id}"):
+        attempt = st.get("attemptId", 0)
+        entry = {
+            "stage_id": stage_id,
+            "attempt_id": attempt,
+            "name": st.get("name"),
+            "status": st.get("status"),
+            "num_tasks": st.get("numTasks"),
+            "submission_time": st.get("submissionTime"),
+            "completion_time": st.get("completionTime"),
+            "executor_run_time_ms": st.get("executorRunTime"),
+            "input_bytes": st.get("inputBytes"),
+            "output_bytes": st.get("outputBytes"),
+            "shuffle_read_bytes": st.get("shuffleReadBytes"),
+            "shuffle_write_bytes": st.get("shuffleWriteBytes"),
+            "memory_spilled_bytes": st.get("memoryBytesSpilled"),
+            "disk_spilled_bytes": st.get("diskBytesSpilled"),
+        }
+        try:
+            summary = _spark_ui_get(f"/stages/{stage_id}/{attempt}/taskSummary?quantiles=0.5,1.0")
+            median, longest = summary.get("executorRunTime") or [None, None]
+            entry["task_run_time_ms_median"] = median
+            entry["task_run_time_ms_max"] = longest
+            entry["task_skew"] = round(longest / median, 2) if median else None
+        except Exception:
+            pass
+        attempts.append(entry)
+    return attempts
+
+
+def _collect_job_group_profile(group_id: str) -> dict:
+    sc = _session().sparkContext
+    tracker = sc.statusTracker()
+    job_ids = sorted(tracker.getJobIdsForGroup(group_id))
+    stage_ids = set()
+    for job_id in job_ids:
+        info = tracker.getJobInfo(job_id)
+        if info is not None:
+            stage_ids.update(info.stageIds)
+
+    stages = []
+    for stage_id in sorted(stage_ids):
+        stages.extend(_stage_profile(stage_id))
+
+    executions = []
+    for ex in _spark_ui_get("/sql?details=true&planDescription=true&offset=0&length=100000"):
+        ex_jobs = set(ex.get("successJobIds") or []) | set(ex.get("failedJobIds") or []) | set(ex.get("runningJobIds") or [])
+        if ex_jobs & set(job_ids):
+            executions.append({
+                "id": ex.get("id"),
+                "status": ex.get("status"),
+                "description": ex.get("description"),
+                "duration_ms": ex.get("duration"),
+                "physical_plan": ex.get("planDescription"),
+                "nodes": ex.get("nodes"),
+            })
+
+    def total(key: str) -> int:
+        return sum(int(st.get(key) or 0) for st in stages)
+
+    skews = [st["task_skew"] for st in stages if st.get("task_skew") is not None]
+    return {
+        "job_ids": job_ids,
+        "totals": {
+            "stages": len(stages),
+            "shuffle_read_bytes": total("shuffle_read_bytes"),
+            "shuffle_write_bytes": total("shuffle_write_bytes"),
+            "memory_spilled_bytes": total("memory_spilled_bytes"),
+            "disk_spilled_bytes": total("disk_spilled_bytes"),
+            "max_task_skew": max(skews) if skews else None,
+        },
+        "stages": stages,
+        "sql_executions": executions,
+    }
+
+
+@contextmanager
+def profile_spark_jobs(table_fqn: str, label: str):
+    """
+    Run the block under its own Spark job group and, when PROFILE_DIR is set, write the group's
+    stage and SQL execution metrics to PROFILE_DIR. Profiling failures are reported, never raised.
+    """
+    if not PROFILE_DIR:
+        yield
+        return
+
+    sc = _session().sparkContext
+    started_at = time.time()
+    group_id = f"{_temp_view_name('olake_', table_fqn)}_{label}_{int(started_at * 1000)}"
+    previous_group = sc.getLocalProperty("spark.jobGroup.id")
+    previous_description = sc.getLocalProperty("spark.job.description")
+    # Job groups are thread-local properties, so concurrent workers are profiled separately.
+    sc.setLocalProperty("spark.jobGroup.id", group_id)
+    sc.setLocalProperty("spark.job.description", f"OLake {label} {table_fqn}")
+    try:
+        yield
+    finally:
+        sc.setLocalProperty("spark.jobGroup.id", previous_group)
+        sc.setLocalProperty("spark.job.description", previous_description)
+        try:
+            profile = _collect_job_group_profile(group_id)
+            profile.update({
+                "table": table_fqn,
+                "label": label,
+                "started_at": started_at,
+                "duration_seconds": time.time() - started_at,
+            })
+            path = os.path.join(PROFILE_DIR, f"{group_id}.json")
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(profile, f, indent=2, default=str)
+            t = profile["totals"]
+            print(
+                f"[{table_fqn}] Profile {label}: stages={t['stages']} shuffle_read={t['shuffle_read_bytes']} "
+                f"shuffle_write={t['shuffle_write_bytes']} spill={t['memory_spilled_bytes']}/{t['disk_spilled_bytes']} "
+                f"max_skew={t['max_task_skew']} -> {path}"
+            )
+            _record_decision(f"profile_{label}", path)
+        except Exception as e:
+            print(f"[{table_fqn}] Could not collect {label} profile: {e}")
+
+
+# ------------------------------------------------------------------------------
+# Merge + schema alignment
+# ------------------------------------------------------------------------------
+def align_cow_schema(cow_table_fqn: str, mor_struct, cow_struct):
+    mor_schema = {f.name: f.dataType for f in mor_struct.fields}
+    cow_schema = {f.name: f.dataType for f in cow_struct.fields}
+    altered = False
+
+    for col, dtype in mor_schema.items():
+        if col not in cow_schema:
+            print(f"Adding new column '{col}' with type '{dtype.simpleString()}' to COW table")
+            _session().sql(f"""
+                ALTER TABLE {cow_table_fqn}
+                ADD COLUMN {col} {dtype.simpleString()}
+            """)
+            altered = True
+
+    for col, mor_type in mor_schema.items():
+        if col in cow_schema:
+            cow_type = cow_schema[col]
             if mor_type != cow_type:
                 print(
                     f"Updating column '{col}' type from '{cow_type.simpleString()}' "
                     f"to '{mor_type.simpleString()}' in COW table"
                 )
-                spark.sql(f"""
+                _session().sql(f"""
                     ALTER TABLE {cow_table_fqn}
                     ALTER COLUMN {col} TYPE {mor_type.simpleString()}
                 """)
+                altered = True
+
+    if altered:
+        invalidate_table_cache(cow_table_fqn)
+
+
+def _sql_literal(v) -> str:
+    if isinstance(v, bool):
+        return "true" if v else "false"
+    if isinstance(v, (int, float, decimal.Decimal)):
+        return str(v)
+    if isinstance(v, datetime.datetime):
+        return f"TIMESTAMP '{v.isoformat(sep=' ')}'"
+    if isinstance(v, datetime.date):
+        return f"DATE '{v.isoformat()}'"
+    escaped = str(v).replace("\\", "\\\\").replace("'", "\\'")
+    return f"'{escaped}'"
+
+
+def _file_list_sql(paths: List[str]) -> str:
+    return ", ".join(_sql_literal(p) for p in paths)
+
+
+def _hash_aggregate_sql(columns: List[str]) -> str:
+    """Row count and order-independent hash aggregate (sum of per-row xxhash64, as a string) over columns."""
+    cols = ", ".join(f"`{c}`" for c in columns)
+    return (
+        f"COUNT(*) AS rows, "
+        f"CAST(COALESCE(SUM(CAST(xxhash64({cols}) AS DECIMAL(38, 0))), 0) AS STRING) AS row_hash"
+    )
+
+
+def _delta_profile(source_sql: str, hash_columns: Optional[List[str]] = None) -> dict:
+    """
+    One pass over the delta: distinct keys with their min/max, plus (when hash_columns is given)
+    the row count and hash aggregate used by the pre-publish audit.
+    """
+    select = f"COUNT(DISTINCT {PRIMARY_KEY}) AS n, MIN({PRIMARY_KEY}) AS lo, MAX({PRIMARY_KEY}) AS hi"
+    if hash_columns:
+        select += ", " + _hash_aggregate_sql(hash_columns)
+    stats = _session().sql(f"SELECT {select} FROM ({source_sql}) AS delta").collect()[0]
+    profile = {"keys": int(stats["n"] or 0), "lo": stats["lo"], "hi": stats["hi"]}
+    if hash_columns:
+        profile["rows"] = int(stats["rows"] or 0)
+        profile["row_hash"] = stats["row_hash"]
+    return profile
+
+
+def _delta_key_predicate(source_sql: str, profile: Optional[dict] = None) -> Optional[str]:
+    """
+    Build a target-only pruning predicate covering every PRIMARY_KEY in the delta.
+    - Small deltas: `target.<pk> IN (...)` (file pruning by min/max stats; bloom filters
+      additionally skip row groups in the files that are read).
+    - Larger deltas: `target.<pk> BETWEEN <min> AND <max>` (min/max stats only).
+    Returns None for an empty delta.
+    """
+    profile = profile or _delta_profile(source_sql)
+    n, lo, hi = profile["keys"], profile["lo"], profile["hi"]
+    if n == 0 or lo is None:
+        return None
+
+    if n <= PRUNED_MERGE_MAX_KEYS:
+        rows = _session().sql(f"""
+            SELECT DISTINCT {PRIMARY_KEY} AS k
+            FROM ({source_sql}) AS delta
+            WHERE {PRIMARY_KEY} IS NOT NULL
+        """).collect()
+        keys = ", ".join(_sql_literal(r["k"]) for r in rows)
+        return f"target.{PRIMARY_KEY} IN ({keys})"
+
+    return f"target.{PRIMARY_KEY} BETWEEN {_sql_literal(lo)} AND {_sql_literal(hi)}"
+
+
+def choose_merge_strategy(cow_table_fqn: str, delta_snap: Optional[dict]) -> Tuple[str, str]:
+    """
+    Pick how to write a delta into the COW table. Returns (strategy, reason).
+    With MERGE_STRATEGY="auto", decides from snapshot summaries only:
+    delta total-records (the merged MOR snapshot) relative to the COW table's total-records.
+    """
+    if MERGE_STRATEGY != "auto":
+        return MERGE_STRATEGY, "configured"
+
+    delta_records = _summary_int((delta_snap or {}).get("summary"), "total-records")
+    cow_records = _summary_int(current_snapshot_summary(cow_table_fqn), "total-records")
+    if delta_records is None or not cow_records:
+        return "merge", "record counts unavailable"
+
+    ratio = delta_records / cow_records
+    reason = f"delta/cow records = {delta_records}/{cow_records} = {ratio:.3f}"
+    if ratio >= AUTO_REBUILD_MIN_RATIO:
+        return "rebuild", reason
+    if ratio >= AUTO_OVERWRITE_MIN_RATIO:
+        if table_partitioning(cow_table_fqn):
+            return "overwrite", reason
+        return "rebuild", reason + " (COW table unpartitioned)"
+    return "merge", reason
+
+
+def tune_spark_for_delta(cow_table_fqn: str, delta_snap: Optional[dict], broadcast_delta: bool = False) -> dict:
+    """
+    Session SQL configs for writing this delta into this COW table, sized from snapshot summaries
+    (total-files-size of the delta snapshot and of the COW head). Empty when AUTO_TUNE is off.
+    broadcast_delta raises the broadcast thresholds for small deltas; only pass it for writes that join
+    the delta with a join type that can broadcast it (the overwrite's anti/semi joins), not for MERGE.
+    """
+    if not AUTO_TUNE:
+        return {}
+
+    settings = {
+        "spark.sql.adaptive.enabled": "true",
+        "spark.sql.adaptive.coalescePartitions.enabled": "true",
+        "spark.sql.adaptive.skewJoin.enabled": "true",
+    }
+    delta_bytes = _summary_int((delta_snap or {}).get("summary"), "total-files-size")
+    cow_bytes = _summary_int(current_snapshot_summary(cow_table_fqn), "total-files-size") or 0
+    if delta_bytes is not None:
+        partitions = -(-(delta_bytes + cow_bytes) // TUNE_TARGET_PARTITION_BYTES)
+        partitions = max(TUNE_MIN_SHUFFLE_PARTITIONS, min(TUNE_MAX_SHUFFLE_PARTITIONS, partitions))
+        settings["spark.sql.shuffle.partitions"] = str(partitions)
+        settings["spark.sql.adaptive.advisoryPartitionSizeInBytes"] = str(TUNE_TARGET_PARTITION_BYTES)
+        if broadcast_delta and delta_bytes <= TUNE_BROADCAST_MAX_BYTES:
+            settings["spark.sql.autoBroadcastJoinThreshold"] = str(TUNE_BROADCAST_MAX_BYTES)
+            settings["spark.sql.adaptive.autoBroadcastJoinThreshold"] = str(TUNE_BROADCAST_MAX_BYTES)
+
+    print(
+        f"[{cow_table_fqn}] Spark tuning (delta_bytes={delta_bytes}, cow_bytes={cow_bytes}): "
+        + " ".join(f"{k.replace('spark.sql.', '')}={v}" for k, v in settings.items())
+    )
+    _record_decision("spark_conf", settings)
+    return settings
+
+
+# Single-argument time transforms, as DESCRIBE may print them -> Iceberg `system` function name.
+_TIME_TRANSFORMS = {
+    "years": "years", "year": "years",
+    "months": "months", "month": "months",
+    "days": "days", "day": "days",
+    "hours": "hours", "hour": "hours",
+}
+
+
+def _partition_sql_expr(transform: str, alias: str, catalog_name: str) -> str:
+    """
+    Turn a DESCRIBE TABLE partition transform into a SQL expression over `alias`:
+    identity (`col`), bucket(N, col), truncate(W, col) and the time transforms (days(col), ...).
+    Iceberg exposes its partition transforms as functions in the catalog's `system` namespace.
+    """
+    m = re.match(r"^(\w+)\((.*)\)$", transform.strip())
+    if not m:
+        return f"{alias}.{transform.strip()}"
+    fn, args = m.group(1).lower(), [a.strip() for a in m.group(2).split(",")]
+    if fn in ("bucket", "truncate"):
+        if len(args) != 2:
+            raise ValueError(f"Unsupported partition transform: {transform}")
+        width, column = args
+        if not width.isdigit():
+            # Tolerate the (column, width) argument order some engines print.
+            width, column = column, width
+        if not width.isdigit():
+            raise ValueError(f"Unsupported partition transform: {transform}")
+        return f"{catalog_name}.system.{fn}({width}, {alias}.{column})"
+    if fn in _TIME_TRANSFORMS and len(args) == 1:
+        return f"{catalog_name}.system.{_TIME_TRANSFORMS[fn]}({alias}.{args[0]})"
+    raise ValueError(f"Unsupported partition transform: {transform}")
+
+
+def _cow_insert_columns(cow_table_fqn: str, source_schema) -> str:
+    """COW column list for INSERT ... SELECT from the delta; columns the delta lacks become NULL."""
+    source_cols = {f.name for f in source_schema.fields}
+    cols = []
+    for f in table_schema(cow_table_fqn).fields:
+        if f.name in source_cols:
+            cols.append(f"source.{f.name}")
+        else:
+            cols.append(f"CAST(NULL AS {f.dataType.simpleString()}) AS {f.name}")
+    return ", ".join(cols)
+
+
+def _overwrite_cow_from_delta(cow_table_fqn: str, source_sql: str, source_schema, partitioned: bool):
+    """
+    Overwrite COW data with (existing COW rows whose key is not in the delta) + (delta rows).
+    - partitioned=True: dynamic partition overwrite, restricted to the partitions touched by the delta:
+      partitions of the delta rows plus partitions currently holding the delta's keys (keys can move).
+    - partitioned=False: full-table overwrite (rebuild).
+    Both commit a single snapshot, so WAP staging and publish_wap_changes behave as for MERGE.
+    """
+    catalog_name, _, _ = split_fqn(cow_table_fqn)
+    cow_cols = [f.name for f in table_schema(cow_table_fqn).fields]
+    target_cols = ", ".join(f"target.{c}" for c in cow_cols)
+    source_cols = _cow_insert_columns(cow_table_fqn, source_schema)
+
+    ctes = [f"source AS ({source_sql})"]
+    target_filter = ""
+    if partitioned:
+        transforms = table_partitioning(cow_table_fqn)
+        part_cols = [f"p{i}" for i in range(len(transforms))]
+
+        def parts(alias: str) -> str:
+            return ", ".join(
+                f"{_partition_sql_expr(t, alias, catalog_name)} AS {c}" for t, c in zip(transforms, part_cols)
+            )
+
+        ctes.append(f"""touched AS (
+                SELECT DISTINCT {parts("source")} FROM source
+                UNION
+                SELECT DISTINCT {parts("target")}
+                FROM {cow_table_fqn} AS target
+                LEFT SEMI JOIN source ON target.{PRIMARY_KEY} = source.{PRIMARY_KEY}
+            )""")
+        match = " AND ".join(
+            f"{_partition_sql_expr(t, 'target', catalog_name)} <=> touched.{c}" for t, c in zip(transforms, part_cols)
+        )
+        target_filter = f"LEFT SEMI JOIN touched ON {match}"
+
+    overwrite_mode = "dynamic" if partitioned else "static"
+    with _session_conf({"spark.sql.sources.partitionOverwriteMode": overwrite_mode}):
+        _session().sql(f"""
+            INSERT OVERWRITE {cow_table_fqn}
+            WITH {", ".join(ctes)}
+            SELECT {target_cols}
+            FROM {cow_table_fqn} AS target
+            {target_filter}
+            LEFT ANTI JOIN source ON target.{PRIMARY_KEY} = source.{PRIMARY_KEY}
+            UNION ALL
+            SELECT {source_cols}
+            FROM source
+        """)
+
+
+def sync_cow_partitioning(mor_table_fqn: str, cow_table_fqn: str):
+    """Add MOR partition fields the COW spec lacks (metadata-only; existing files keep their old spec)."""
+    cow_transforms = table_partitioning(cow_table_fqn)
+    missing = [t for t in table_partitioning(mor_table_fqn) if t not in cow_transforms]
+    if COW_BUCKETS:
+        # The key bucket is owned by ensure_cow_bucketing; a MOR bucket on the key with another N is not copied.
+        missing = [t for t in missing if not _BUCKET_TRANSFORM_RE.match(t)]
+    for transform in missing:
+        print(f"[{cow_table_fqn}] Adding partition field {transform} from MOR spec")
+        _session().sql(f"ALTER TABLE {cow_table_fqn} ADD PARTITION FIELD {transform}")
+    if missing:
+        invalidate_table_cache(cow_table_fqn)
+
+
+_BUCKET_TRANSFORM_RE = re.compile(r"^bucket\((\d+),\s*" + re.escape(PRIMARY_KEY) + r"\)$")
+
+# Spark 3.5 / Iceberg settings for storage-partitioned joins on bucketed Iceberg tables.
+_SPJ_CONF = {
+    "spark.sql.sources.v2.bucketing.enabled": "true",
+    "spark.sql.sources.v2.bucketing.pushPartValues.enabled": "true",
+    "spark.sql.sources.v2.bucketing.partiallyClusteredDistribution.enabled": "true",
+    "spark.sql.requireAllClusterKeysForCoPartition": "false",
+    "spark.sql.iceberg.planning.preserve-data-grouping": "true",
+}
+
+
+def _bucket_transform() -> str:
+    return f"bucket({COW_BUCKETS}, {PRIMARY_KEY})"
+
+
+def _cow_bucket_count(cow_table_fqn: str) -> Optional[int]:
+    """N of the COW table's bucket(N, PRIMARY_KEY) partition field, or None if it has none."""
+    for transform in table_partitioning(cow_table_fqn):
+        m = _BUCKET_TRANSFORM_RE.match(transform)
+        if m:
+            return int(m.group(1))
+    return None
+
+
+def cow_partition_transforms(mor_table_fqn: str) -> List[str]:
+    """Partition transforms for a new COW table: the MOR spec, plus the key bucket when COW_BUCKETS is set."""
+    transforms = table_partitioning(mor_table_fqn)
+    if COW_BUCKETS:
+        transforms = [t for t in transforms if not _BUCKET_TRANSFORM_RE.match(t)] + [_bucket_transform()]
+    return transforms
+
+
+def ensure_cow_bucketing(cow_table_fqn: str):
+    """
+    With COW_BUCKETS, make the COW table bucketed by PRIMARY_KEY into exactly COW_BUCKETS buckets.
+    Adding or replacing the field is a metadata change; existing files are then rewritten under the
+    new spec so every file is bucketed alike (required for storage-partitioned joins).
+    The rewrite commits directly to main before the delta is staged, so the staged WAP snapshot
+    still fast-forwards on publish.
+    """
+    if not COW_BUCKETS:
+        return
+    current = _cow_bucket_count(cow_table_fqn)
+    if current == COW_BUCKETS:
+        return
+
+    catalog_name, _, _ = split_fqn(cow_table_fqn)
+    if current is None:
+        print(f"[{cow_table_fqn}] Adding partition field {_bucket_transform()}")
+        _session().sql(f"ALTER TABLE {cow_table_fqn} ADD PARTITION FIELD {_bucket_transform()}")
+    else:
+        print(f"[{cow_table_fqn}] Re-bucketing {PRIMARY_KEY}: {current} -> {COW_BUCKETS} buckets")
+        _session().sql(f"""
+            ALTER TABLE {cow_table_fqn}
+            REPLACE PARTITION FIELD bucket({current}, {PRIMARY_KEY}) WITH {_bucket_transform()}
+        """)
+    invalidate_table_cache(cow_table_fqn)
+    with _phase("rebucket"):
+        _session().sql(f"""
+            CALL {catalog_name}.system.rewrite_data_files(
+                table => '{cow_table_fqn}',
+                options => map('rewrite-all', 'true')
+            )
+        """).collect()
+    invalidate_table_cache(cow_table_fqn)
+
+
+def _stage_bucketed_delta(cow_table_fqn: str, source_sql: str) -> str:
+    """
+    Write the delta to a staging Iceberg table bucketed like the COW table and return its name.
+    The staging table has no WAP property, so the session's spark.wap.id does not apply to it.
+    """
+    catalog_name, cow_db, cow_table = split_fqn(cow_table_fqn)
+    staging_fqn = f"{catalog_name}.{cow_db}.{cow_table}__delta"
+    _session().sql(f"""
+        CREATE OR REPLACE TABLE {staging_fqn}
+        USING iceberg
+        PARTITIONED BY ({_bucket_transform()})
+        LOCATION '{COW_BASE_LOCATION}/{cow_table}__delta'
+        AS {source_sql}
+    """)
+    return staging_fqn
+
+
+def _touched_partition_predicate(cow_table_fqn: str, source_sql: str) -> Optional[str]:
+    """
+    Target-only predicate restricting the MERGE to the COW partitions the delta touches,
+    one `<transform>(target.col) IN (...)` conjunct per partition field. Fields with more than
+    PARTITION_SCOPE_MAX_VALUES distinct values are left unconstrained. None if nothing can be scoped.
+    """
+    catalog_name, _, _ = split_fqn(cow_table_fqn)
+    transforms = table_partitioning(cow_table_fqn)
+    if not transforms:
+        return None
+
+    exprs = ", ".join(
+        f"{_partition_sql_expr(t, 'source', catalog_name)} AS p{i}" for i, t in enumerate(transforms)
+    )
+    rows = _session().sql(f"SELECT DISTINCT {exprs} FROM ({source_sql}) AS source").collect()
+    if not rows:
+        return None
+
+    conjuncts = []
+    for i, transform in enumerate(transforms):
+        values = {r[f"p{i}"] for r in rows}
+        if len(values) > PARTITION_SCOPE_MAX_VALUES:
+            continue
+        target_expr = _partition_sql_expr(transform, "target", catalog_name)
+        terms = []
+        non_null = [v for v in values if v is not None]
+        if non_null:
+            terms.append(f"{target_expr} IN ({', '.join(_sql_literal(v) for v in non_null)})")
+        if len(non_null) != len(values):
+            terms.append(f"{target_expr} IS NULL")
+        conjuncts.append("(" + " OR ".join(terms) + ")")
+    _record_decision("touched_partitions", len(rows))
+    return " AND ".join(conjuncts) if conjuncts else None
+
+
+def _audit_columns(source_schema) -> List[str]:
+    return [f.name for f in source_schema.fields if f.name != _CDC_DELETE_COLUMN]
+
+
+def _staged_snapshot(cow_table_fqn: str, wap_id: str) -> Optional[dict]:
+    """Newest snapshot staged under wap_id (not yet on main)."""
+    rows = _collect_snapshot_rows(cow_table_fqn, where=f"WHERE summary['wap.id'] = {_sql_literal(wap_id)}")
+    rows.sort(key=_committed_at_key)
+    return rows[-1] if rows else None
+
+
+def _staged_added_data_files(cow_table_fqn: str, staged_id: int) -> List[str]:
+    """Data files the staged snapshot itself added (from its manifests)."""
+    rows = _session().sql(f"""
+        SELECT data_file.file_path AS file_path
+        FROM {cow_table_fqn}.entries VERSION AS OF {int(staged_id)}
+        WHERE status = 1 AND data_file.content = 0 AND snapshot_id = {int(staged_id)}
+    """).collect()
+    return [r["file_path"] for r in rows]
+
+
+def _unpublished_wap_snapshot_ids(cow_table_fqn: str, wap_id: str) -> List[int]:
+    """Snapshots staged under wap_id that are not on main's lineage."""
+    index = build_snapshot_index(cow_table_fqn)
+    head = current_snapshot_id(cow_table_fqn)
+    on_main = {snap["snapshot_id"] for snap in walk_lineage(index, head)} if head is not None else set()
+    return [
+        sid for sid, snap in index.items()
+        if sid not in on_main and (snap.get("summary") or {}).get("wap.id") == str(wap_id)
+    ]
+
+
+def _discard_staged_snapshots(cow_table_fqn: str, snapshot_ids: List[int]) -> str:
+    """
+    Remove rejected staged snapshots so no later run publishes or resumes from them, clear the pending
+    checkpoint marker, and describe what was done. Only these snapshots are expired (older_than at the
+    epoch disables age-based expiry, and retain_last keeps main's head). When they are all the table
+    has (a rejected first baseline), the table is dropped instead, so the next run recreates it.
+    """
+    catalog_name, _, _ = split_fqn(cow_table_fqn)
+    others = [sid for sid in build_snapshot_index(cow_table_fqn) if sid not in snapshot_ids]
+    if not snapshot_ids:
+        outcome = "nothing staged"
+    elif not others:
+        _session().sql(f"DROP TABLE IF EXISTS {cow_table_fqn} PURGE")
+        outcome = "COW table dropped"
+    else:
+        _session().sql(f"""
+            CALL {catalog_name}.system.expire_snapshots(
+                table => '{cow_table_fqn}',
+                older_than => TIMESTAMP_MILLIS(0),
+                retain_last => 1,
+                snapshot_ids => array({", ".join(str(int(sid)) for sid in snapshot_ids)})
+            )
+        """).collect()
+        outcome = f"staged snapshot(s) {', '.join(str(sid) for sid in snapshot_ids)} expired"
+    clear_checkpoint_pending(cow_table_fqn)
+    invalidate_table_cache(cow_table_fqn)
+    return outcome
+
+
+def _reject_staged_snapshot(cow_table_fqn: str, wap_id: str, staged: dict, problems: List[str]):
+    """
+    Fail the table without publishing the staged snapshot. publish_changes applies the first snapshot
+    staged under a WAP ID, so the rejected one must not stay behind for the retry (see _discard_staged_snapshots).
+    """
+    staged_id = staged["snapshot_id"]
+    outcome = _discard_staged_snapshots(cow_table_fqn, [staged_id])
+    _record_decision("audit", "failed")
+    raise RuntimeError(
+        f"Audit failed for {cow_table_fqn} (WAP ID {wap_id}); snapshot {staged_id} not published ({outcome}): "
+        + "; ".join(problems)
+    )
+
+
+def audit_staged_commit(
+    cow_table_fqn: str,
+    source_sql: str,
+    source_schema,
+    profile: Optional[dict] = None,
+    deleted_keys_sql: Optional[str] = None,
+):
+    """
+    Audit the commit staged under the session's WAP ID against the delta it was written from
+    (source_sql: upserted rows; deleted_keys_sql: keys that must be gone). No-op unless AUDIT_ENABLED.
+    Callers pass the delta's profile (count and hash) taken over the cached write source; the COW side
+    only reads the data files the staged snapshot added, where every written row lands.
+    """
+    wap_id = _session().conf.get("spark.wap.id", None)
+    if not AUDIT_ENABLED or not wap_id:
+        return
+    with _phase("audit"):
+        staged = _staged_snapshot(cow_table_fqn, wap_id)
+        if staged is None:
+            raise RuntimeError(f"Audit: no snapshot staged under WAP ID {wap_id} in {cow_table_fqn}")
+        columns = _audit_columns(source_schema)
+        if profile is None or "row_hash" not in profile:
+            profile = _delta_profile(source_sql, columns)
+
+        problems = []
+        deleted = 0
+        if deleted_keys_sql:
+            deleted = int(_session().sql(f"SELECT COUNT(*) AS c FROM ({deleted_keys_sql}) AS d").collect()[0]["c"])
+
+        # Row counts from snapshot summaries.
+        summary = staged.get("summary")
+        added = _summary_int(summary, "added-records")
+        if added is not None and added < profile["rows"]:
+            problems.append(f"staged commit added {added} rows for a delta of {profile['rows']}")
+        parent = _fetch_snapshot_with_summary(cow_table_fqn, staged["parent_id"]) if staged.get("parent_id") else None
+        total = _summary_int(summary, "total-records")
+        parent_total = _summary_int((parent or {}).get("summary"), "total-records")
+        if total is not None and parent_total is not None:
+            growth = total - parent_total
+            if growth > profile["keys"] or growth < -deleted:
+                problems.append(
+                    f"COW records changed by {growth} for {profile['keys']} delta keys and {deleted} deleted keys"
+                )
+
+        # Hash aggregate of the staged rows for the delta's keys, read from the files the commit added.
+        added_files = _staged_added_data_files(cow_table_fqn, staged["snapshot_id"])
+        in_added = f"_file IN ({_file_list_sql(added_files)})" if added_files else "FALSE"
+        staged_rows = f"SELECT * FROM {cow_table_fqn} VERSION AS OF {staged['snapshot_id']} WHERE {in_added}"
+        staged_stats = _session().sql(f"""
+            SELECT {_hash_aggregate_sql(columns)}
+            FROM ({staged_rows}) AS target
+            LEFT SEMI JOIN (SELECT {PRIMARY_KEY} FROM ({source_sql}) AS s) AS delta
+                ON target.{PRIMARY_KEY} = delta.{PRIMARY_KEY}
+        """).collect()[0]
+        if int(staged_stats["rows"] or 0) != profile["rows"] or staged_stats["row_hash"] != profile["row_hash"]:
+            problems.append(
+                f"staged rows/hash for delta keys {staged_stats['rows']}/{staged_stats['row_hash']} "
+                f"!= delta {profile['rows']}/{profile['row_hash']}"
+            )
+
+        if deleted_keys_sql and deleted:
+            # Untouched files are covered by the record-count bound above.
+            remaining = _session().sql(f"""
+                SELECT COUNT(*) AS c
+                FROM ({staged_rows}) AS target
+                LEFT SEMI JOIN ({deleted_keys_sql}) AS d ON target.{PRIMARY_KEY} = d.{PRIMARY_KEY}
+            """).collect()[0]["c"]
+            if int(remaining):
+                problems.append(f"{remaining} deleted keys still present")
+
+    if problems:
+        _reject_staged_snapshot(cow_table_fqn, wap_id, staged, problems)
+    _record_decision("audit", "passed")
 
 
-def merge_snapshot_into_cow(mor_table_fqn: str, cow_table_fqn: str, snapshot_id: int):
-    mor_df = (
-        spark.read.format("iceberg")
+def audit_staged_baseline(cow_table_fqn: str, mor_snap: Optional[dict]):
+    """
+    Summary-only audit of a staged baseline: it may not hold more rows than the MOR snapshot's data files,
+    and exactly as many when that snapshot has no delete files.
+    """
+    wap_id = _session().conf.get("spark.wap.id", None)
+    if not AUDIT_ENABLED or not wap_id or mor_snap is None:
+        return
+    with _phase("audit"):
+        staged = _staged_snapshot(cow_table_fqn, wap_id)
+        if staged is None:
+            raise RuntimeError(f"Audit: no snapshot staged under WAP ID {wap_id} in {cow_table_fqn}")
+        mor_summary = mor_snap.get("summary")
+        mor_total = _summary_int(mor_summary, "total-records")
+        staged_total = _summary_int(staged.get("summary"), "total-records")
+        problems = []
+        if mor_total is not None and staged_total is not None:
+            if staged_total > mor_total or (_total_delete_files(mor_summary) == 0 and staged_total != mor_total):
+                problems.append(f"baseline has {staged_total} rows; MOR snapshot data files hold {mor_total}")
+    if problems:
+        _reject_staged_snapshot(cow_table_fqn, wap_id, staged, problems)
+    _record_decision("audit", "passed")
+
+
+def merge_snapshot_into_cow(
+    mor_table_fqn: str,
+    cow_table_fqn: str,
+    snapshot_id: int,
+    delta_snap: Optional[dict] = None,
+):
+    # Schemas come from table metadata only (time-travel resolution for MOR, cached schema for COW).
+    mor_schema = (
+        _session().read.format("iceberg")
         .option("snapshot-id", snapshot_id)
         .load(mor_table_fqn)
+        .schema
+    )
+    merge_source_into_cow(
+        mor_table_fqn,
+        cow_table_fqn,
+        source_sql=f"SELECT * FROM {mor_table_fqn} VERSION AS OF {snapshot_id}",
+        source_schema=mor_schema,
+        delta_snap=delta_snap,
+        label=f"snapshot {snapshot_id}",
     )
-    cow_df = spark.read.format("iceberg").load(cow_table_fqn)
 
-    align_cow_schema(cow_table_fqn, mor_df, cow_df)
 
-    spark.sql(f"""
-        MERGE INTO {cow_table_fqn} AS target
-        USING (
-            SELECT *
-            FROM {mor_table_fqn}
-            VERSION AS OF {snapshot_id}
-        ) AS source
-        ON target.{PRIMARY_KEY} = source.{PRIMARY_KEY}
+def merge_source_into_cow(
+    mor_table_fqn: str,
+    cow_table_fqn: str,
+    source_sql: str,
+    source_schema,
+    delta_snap: Optional[dict] = None,
+    label: str = "delta",
+):
+    """
+    Write a delta (any SQL query over MOR data, one row per PRIMARY_KEY) into the COW table,
+    using the configured/auto-selected strategy. Commits exactly one snapshot.
+    """
+    cow_schema = table_schema(cow_table_fqn)
+
+    with _phase("schema_align"):
+        align_cow_schema(cow_table_fqn, source_schema, cow_schema)
+        sync_cow_partitioning(mor_table_fqn, cow_table_fqn)
+        ensure_cow_bucketing(cow_table_fqn)
+        ensure_cow_layout(cow_table_fqn)
+
+    strategy, reason = choose_merge_strategy(cow_table_fqn, delta_snap)
+    if strategy == "overwrite" and not table_partitioning(cow_table_fqn):
+        strategy, reason = "rebuild", reason + "; COW table unpartitioned"
+    print(f"[{cow_table_fqn}] Merge strategy for {label}: {strategy} ({reason})")
+    _record_decision("merge_strategy", strategy)
+    tuned_conf = tune_spark_for_delta(cow_table_fqn, delta_snap, broadcast_delta=strategy in ("overwrite", "rebuild"))
+
+    delta_df = delta_view = None
+    profile = None
+    if AUDIT_ENABLED or MERGE_MODE == "pruned":
+        # Profile, key pruning, write and audit all read the delta: compute it from MOR once, and take
+        # its key stats and (with the audit on) row count and hash aggregate in the pass that caches it.
+        delta_df = _session().sql(source_sql).persist(StorageLevel.MEMORY_AND_DISK)
+        delta_view = _temp_view_name("olake_delta_", cow_table_fqn)
+        delta_df.createOrReplaceTempView(delta_view)
+        source_sql = f"SELECT * FROM {delta_view}"
+        with _phase("delta_profile"):
+            profile = _delta_profile(source_sql, _audit_columns(source_schema) if AUDIT_ENABLED else None)
+
+    staging_fqn = None
+    try:
+        if strategy in ("overwrite", "rebuild"):
+            with _phase(strategy), _session_conf(tuned_conf), profile_spark_jobs(cow_table_fqn, strategy):
+                with_retries(
+                    f"[{cow_table_fqn}] {strategy}",
+                    lambda: _overwrite_cow_from_delta(
+                        cow_table_fqn, source_sql, source_schema, partitioned=strategy == "overwrite"
+                    ),
+                )
+            invalidate_table_cache(cow_table_fqn)
+            if strategy == "rebuild":
+                _check_rebuild_fast_forwards(cow_table_fqn)
+            audit_staged_commit(cow_table_fqn, source_sql, source_schema, profile=profile)
+            return
 
-        WHEN MATCHED THEN
-            UPDATE SET *
+        merge_conf = dict(tuned_conf)
+        if COW_BUCKETS:
+            with _phase("stage_delta"):
+                staging_fqn = _stage_bucketed_delta(cow_table_fqn, source_sql)
+            source_sql = f"SELECT * FROM {staging_fqn}"
+            merge_conf.update(_SPJ_CONF)
+            _record_decision("storage_partitioned_join", table_partitioning(cow_table_fqn) == [_bucket_transform()])
+
+        # Target-only conjuncts in the ON clause are pushed into the COW scan by Iceberg.
+        conditions = [f"target.{PRIMARY_KEY} = source.{PRIMARY_KEY}"]
+        if MERGE_MODE == "pruned":
+            # An empty delta still runs the (now trivial) MERGE so the WAP commit is staged as usual.
+            with _phase("key_pruning"):
+                conditions.append(_delta_key_predicate(source_sql, profile) or "FALSE")
+        if PARTITION_SCOPED_MERGE:
+            with _phase("partition_scoping"):
+                partition_predicate = _touched_partition_predicate(cow_table_fqn, source_sql)
+            if partition_predicate:
+                conditions.append(partition_predicate)
+
+        with _phase("merge"), _session_conf(merge_conf), profile_spark_jobs(cow_table_fqn, "merge"):
+            merge_sql = f"""
+                MERGE INTO {cow_table_fqn} AS target
+                USING (
+                    {source_sql}
+                ) AS source
+                ON {" AND ".join(conditions)}
+
+                WHEN MATCHED THEN
+                    UPDATE SET *
+
+                WHEN NOT MATCHED THEN
+                    INSERT *
+            """
+            with_retries(f"[{cow_table_fqn}] merge", lambda: _session().sql(merge_sql))
+        invalidate_table_cache(cow_table_fqn)
+        audit_staged_commit(cow_table_fqn, source_sql, source_schema, profile=profile)
+    finally:
+        if staging_fqn:
+            _session().sql(f"DROP TABLE IF EXISTS {staging_fqn} PURGE")
+        if delta_view:
+            _session().catalog.dropTempView(delta_view)
+            delta_df.unpersist()
+
+
+def _check_rebuild_fast_forwards(cow_table_fqn: str):
+    """
+    A rebuild stages a static (full-table) overwrite, which can only be published as a fast-forward:
+    its parent must still be the current main snapshot.
+    """
+    wap_id = _session().conf.get("spark.wap.id", None)
+    if not wap_id:
+        return
+    staged = _staged_snapshot(cow_table_fqn, wap_id)
+    head = current_snapshot_id(cow_table_fqn)
+    if staged is not None and staged.get("parent_id") != head:
+        outcome = _discard_staged_snapshots(cow_table_fqn, [staged["snapshot_id"]])
+        raise RuntimeError(
+            f"[{cow_table_fqn}] Rebuild staged under WAP ID {wap_id} is based on snapshot {staged.get('parent_id')}, "
+            f"but main is at {head}; it cannot be published ({outcome})"
+        )
 
-        WHEN NOT MATCHED THEN
-            INSERT *
-    """)
 
 def _cow_has_any_snapshots(cow_table_fqn: str) -> bool:
+    """
+    True if the COW table has any snapshot, staged ones included, from the cached metadata:
+    the main head, or else the snapshot index (a staged baseline has no main head yet).
+    """
     if not table_exists(cow_table_fqn):
         return False
-    try:
-        cnt = spark.sql(f"SELECT COUNT(*) AS c FROM {cow_table_fqn}.snapshots").collect()[0]["c"]
-        return int(cnt) > 0
-    except Exception:
-        # If metadata table isn't accessible for some reason, assume it has snapshots.
+    if current_snapshot_id(cow_table_fqn) is not None:
         return True
+    return bool(snapshot_index(cow_table_fqn))
 
 
 def _fetch_snapshot_with_summary(table_fqn: str, snapshot_id: int) -> Optional[dict]:
     """
     Fetch a single snapshot (and its summary) by snapshot_id.
+    Prefer build_snapshot_index() when more than one snapshot is needed.
     """
-    rows = spark.sql(f"""
-        SELECT snapshot_id, parent_id, committed_at, operation, summary
-        FROM {table_fqn}.snapshots
-        WHERE snapshot_id = {snapshot_id}
-    """).collect()
+    rows = _collect_snapshot_rows(table_fqn, where=f"WHERE snapshot_id = {int(snapshot_id)}")
     if not rows:
         return None
-    d = rows[0].asDict(recursive=True)
-    return {
-        "snapshot_id": d.get("snapshot_id"),
-        "parent_id": d.get("parent_id"),
-        "committed_at": d.get("committed_at"),
-        "operation": d.get("operation"),
-        "summary": d.get("summary"),
-    }
+    return rows[0]
 
 
 def _set_wap_id(wap_id: Optional[Union[int, str]]):
+    # spark.wap.id is session-scoped; _session() keeps it isolated per worker thread.
     if wap_id is None:
-        spark.sql("SET spark.wap.id=")
+        _session().sql("SET spark.wap.id=")
     else:
-        spark.sql(f"SET spark.wap.id={wap_id}")
+        _session().sql(f"SET spark.wap.id={wap_id}")
+
+
+@contextmanager
+def _staged_under_wap_id(wap_id: Union[int, str]):
+    """
+    Stage the block's writes under wap_id. spark.wap.id is unset on exit, also when the block raises
+    (audit rejection, rejected publish, exhausted retries), so the next table's writes are never staged under it.
+    """
+    _set_wap_id(wap_id)
+    try:
+        yield
+    finally:
+        _set_wap_id(None)
+
+
+_BLOOM_FILTER_PROPERTY = f"write.parquet.bloom-filter-enabled.column.{PRIMARY_KEY}"
+
+
+def ensure_cow_layout(cow_table_fqn: str):
+    """With COW_SORTED_LAYOUT, make sure the COW table has the key sort order and bloom filter enabled."""
+    if not COW_SORTED_LAYOUT:
+        return
+    props = table_properties(cow_table_fqn)
+    changed = False
+    if props.get(_BLOOM_FILTER_PROPERTY) != "true":
+        _session().sql(f"ALTER TABLE {cow_table_fqn} SET TBLPROPERTIES ('{_BLOOM_FILTER_PROPERTY}'='true')")
+        changed = True
+    # Iceberg reports the table's write order as the reserved `sort-order` property.
+    if PRIMARY_KEY not in (props.get("sort-order") or ""):
+        _session().sql(f"ALTER TABLE {cow_table_fqn} WRITE ORDERED BY {PRIMARY_KEY}")
+        changed = True
+    if changed:
+        print(f"[{cow_table_fqn}] Applied sorted layout on {PRIMARY_KEY} (write order + Parquet bloom filter).")
+        invalidate_table_cache(cow_table_fqn)
 
 
 def _ensure_cow_table_from_snapshot(
@@ -645,13 +2528,46 @@ def _ensure_cow_table_from_snapshot(
     """
     Create the COW table if missing by CTAS from a MOR snapshot.
     This also anchors the initial schema for later schema alignment.
+    The COW table inherits the MOR table's partition spec (plus the key bucket, see COW_BUCKETS).
+    A table left without any snapshot (a run that stopped between CREATE and INSERT) gets its baseline
+    inserted now; one with a staged baseline is left for the caller to publish.
     """
     if table_exists(cow_table_fqn):
         enable_wap_for_table(cow_table_fqn)
+        if not _cow_has_any_snapshots(cow_table_fqn):
+            print(f"[{cow_table_fqn}] COW table exists without snapshots; loading baseline from {snapshot_id_for_schema}")
+            ensure_cow_layout(cow_table_fqn)
+            _insert_cow_baseline(mor_table_fqn, cow_table_fqn, snapshot_id_for_schema)
+        return
+    transforms = cow_partition_transforms(mor_table_fqn)
+    partitioned_by = f"PARTITIONED BY ({', '.join(transforms)})" if transforms else ""
+
+    if COW_SORTED_LAYOUT:
+        # The write order cannot be declared in CTAS: create the empty table, set the order,
+        # then load the baseline with INSERT (staged under the caller's WAP id like the CTAS would be).
+        mor_schema = (
+            _session().read.format("iceberg")
+            .option("snapshot-id", snapshot_id_for_schema)
+            .load(mor_table_fqn)
+            .schema
+        )
+        columns = ", ".join(f"`{f.name}` {f.dataType.simpleString()}" for f in mor_schema.fields)
+        _session().sql(f"""
+            CREATE TABLE {cow_table_fqn} ({columns})
+            USING iceberg
+            {partitioned_by}
+            LOCATION '{cow_location}'
+            TBLPROPERTIES ('write.wap.enabled'='true', '{_BLOOM_FILTER_PROPERTY}'='true')
+        """)
+        _session().sql(f"ALTER TABLE {cow_table_fqn} WRITE ORDERED BY {PRIMARY_KEY}")
+        invalidate_table_cache(cow_table_fqn)
+        _insert_cow_baseline(mor_table_fqn, cow_table_fqn, snapshot_id_for_schema)
         return
-    spark.sql(f"""
+
+    _session().sql(f"""
         CREATE TABLE {cow_table_fqn}
         USING iceberg
+        {partitioned_by}
         LOCATION '{cow_location}'
         TBLPROPERTIES ('write.wap.enabled'='true')
         AS
@@ -659,15 +2575,28 @@ def _ensure_cow_table_from_snapshot(
         FROM {mor_table_fqn}
         VERSION AS OF {snapshot_id_for_schema}
     """)
+    invalidate_table_cache(cow_table_fqn)
     enable_wap_for_table(cow_table_fqn)
 
 
+def _insert_cow_baseline(mor_table_fqn: str, cow_table_fqn: str, snapshot_id: int):
+    """Load a MOR snapshot into an existing, empty COW table (staged under the session's WAP ID)."""
+    _session().sql(f"""
+        INSERT INTO {cow_table_fqn}
+        SELECT *
+        FROM {mor_table_fqn}
+        VERSION AS OF {snapshot_id}
+    """)
+    invalidate_table_cache(cow_table_fqn)
+
+
 def _apply_truncate_boundary(
     mor_table_fqn: str,
     cow_table_fqn: str,
     cow_location: str,
     catalog_name: str,
     boundary_snap: dict,
+    parent_snap: Optional[dict] = None,
 ):
     """
     For a truncate boundary snapshot t:
@@ -685,94 +2614,436 @@ def _apply_truncate_boundary(
 
     if not table_exists(cow_table_fqn) or not _cow_has_any_snapshots(cow_table_fqn):
         print(f"[{mor_table_fqn}] COW table missing/empty; creating baseline from snapshot {h_id} ...")
-        _set_wap_id(t_id)
-        _ensure_cow_table_from_snapshot(mor_table_fqn, cow_table_fqn, cow_location, int(h_id))
-        publish_wap_changes(cow_table_fqn, catalog_name, str(t_id))
-        _set_wap_id(None)
+        mark_checkpoint_pending(cow_table_fqn, t_id)
+        with _staged_under_wap_id(t_id):
+            tuned_conf = tune_spark_for_delta(cow_table_fqn, parent_snap)
+            with _phase("create_baseline"), _session_conf(tuned_conf), profile_spark_jobs(cow_table_fqn, "ctas"):
+                _ensure_cow_table_from_snapshot(mor_table_fqn, cow_table_fqn, cow_location, int(h_id))
+            audit_staged_baseline(cow_table_fqn, parent_snap)
+            with _phase("publish"):
+                publish_wap_changes(cow_table_fqn, catalog_name, str(t_id))
+        record_checkpoint(cow_table_fqn, t_id, _to_snapshot_id(h_id), _summary_int((parent_snap or {}).get("summary"), "total-records"))
+        _record_commit_volume(cow_table_fqn)
         print(f"[{mor_table_fqn}] Published WAP changes with truncate {t_id}.")
         return
 
     print(f"[{mor_table_fqn}] Compacting snapshot {h_id} into existing COW ...")
-    _set_wap_id(t_id)
-    merge_snapshot_into_cow(mor_table_fqn, cow_table_fqn, int(h_id))
-    publish_wap_changes(cow_table_fqn, catalog_name, str(t_id))
-    _set_wap_id(None)
+    mark_checkpoint_pending(cow_table_fqn, t_id)
+    with _staged_under_wap_id(t_id):
+        merge_snapshot_into_cow(mor_table_fqn, cow_table_fqn, int(h_id), delta_snap=parent_snap)
+        with _phase("publish"):
+            publish_wap_changes(cow_table_fqn, catalog_name, str(t_id))
+    record_checkpoint(cow_table_fqn, t_id, _to_snapshot_id(h_id), _summary_int((parent_snap or {}).get("summary"), "total-records"))
+    _record_commit_volume(cow_table_fqn)
     print(f"[{mor_table_fqn}] Published WAP changes with truncate {t_id}.")
 
 
-def run_compaction_cycle_for_table(mor_table_fqn: str):
-    cow_table_fqn, cow_location = cow_table_and_location_for(mor_table_fqn)
-    catalog_name, _, _ = split_fqn(mor_table_fqn)
+def _coalesced_delta_view(mor_table_fqn: str, parent_ids: List[int]) -> Tuple[str, object]:
+    """
+    Register a temp view holding the union of the given MOR snapshots (oldest -> newest) with only
+    the latest version of each PRIMARY_KEY kept. Returns (view name, schema).
+    Snapshots with different schemas are unioned by name; missing columns become NULL.
+    """
+    union_df = None
+    for order, sid in enumerate(parent_ids):
+        df = (
+            _session().read.format("iceberg")
+            .option("snapshot-id", sid)
+            .load(mor_table_fqn)
+            .withColumn("__olake_batch", F.lit(order))
+        )
+        union_df = df if union_df is None else union_df.unionByName(df, allowMissingColumns=True)
 
-    # Step 1: Resume checkpoint from COW's last WAP id; re-publish it (idempotent) to finalize any half-done runs.
-    if table_exists(cow_table_fqn):
-        enable_wap_for_table(cow_table_fqn)
+    latest_first = Window.partitionBy(PRIMARY_KEY).orderBy(F.col("__olake_batch").desc())
+    latest = (
+        union_df.withColumn("__olake_rn", F.row_number().over(latest_first))
+        .filter(F.col("__olake_rn") == 1)
+        .drop("__olake_rn", "__olake_batch")
+    )
+    view = "olake_coalesced_" + re.sub(r"[^A-Za-z0-9_]", "_", mor_table_fqn)
+    latest.createOrReplaceTempView(view)
+    return view, latest.schema
 
-    wap_id = get_wap_id_from_table(cow_table_fqn, catalog_name)
-    last_success_t = None
-
-    if wap_id:
-        print(f"[{mor_table_fqn}] Found existing WAP ID: {wap_id}. Re-publishing (idempotent)...")
-        publish_wap_changes(cow_table_fqn, catalog_name, wap_id)
-        last_success_t = extract_truncate_id_from_wap_id(wap_id)
-        if last_success_t is not None:
-            print(f"[{mor_table_fqn}] Last successful truncate checkpoint: {last_success_t}")
-        else:
-            print(f"[{mor_table_fqn}] Warning: Could not parse WAP ID {wap_id} as truncate snapshot id. Starting from beginning.")
-    else:
-        print(f"[{mor_table_fqn}] No WAP ID found; starting from earliest MOR history.")
 
-    # Step 2/3: Truncate MOR to create the boundary for this run.
-    spark.sql(f"TRUNCATE TABLE {mor_table_fqn}")
+def _apply_coalesced_boundaries(
+    mor_table_fqn: str,
+    cow_table_fqn: str,
+    catalog_name: str,
+    boundaries: List[Tuple[dict, Optional[dict]]],
+):
+    """
+    Catch-up for several pending boundaries [(t, h)] (chronological): one MERGE of the union of all
+    parent snapshots h (latest version per key), committed and published with WAP ID = newest t.
+    Older boundaries need no commit of their own: the checkpoint moves straight to the newest one,
+    so every boundary's parent must be resolved (raises ValueError otherwise).
+    """
+    newest_t = boundaries[-1][0].get("snapshot_id")
+    unresolved = [t.get("snapshot_id") for t, p in boundaries if p is None or p.get("snapshot_id") is None]
+    if unresolved:
+        raise ValueError(f"Cannot coalesce boundaries {unresolved} of {mor_table_fqn}: parent snapshot not found")
+    parents = [p for _, p in boundaries]
+    parent_ids = [int(p["snapshot_id"]) for p in parents]
+    print(
+        f"[{mor_table_fqn}] Coalescing {len(boundaries)} boundaries into one MERGE "
+        f"(parents={parent_ids}); publishing under truncate {newest_t}."
+    )
+    _record_decision("coalesced_boundaries", len(boundaries))
 
-    head_snapshot_id, _ = get_latest_snapshot_and_parent_id(mor_table_fqn)
-    if head_snapshot_id is None:
-        print(f"[{mor_table_fqn}] No snapshots found; nothing to do.")
-        return
+    total_records = sum(_summary_int(p.get("summary"), "total-records") or 0 for p in parents)
+    total_bytes = sum(_summary_int(p.get("summary"), "total-files-size") or 0 for p in parents)
+    view, schema = _coalesced_delta_view(mor_table_fqn, parent_ids)
+    try:
+        mark_checkpoint_pending(cow_table_fqn, newest_t)
+        with _staged_under_wap_id(newest_t):
+            merge_source_into_cow(
+                mor_table_fqn,
+                cow_table_fqn,
+                source_sql=f"SELECT * FROM {view}",
+                source_schema=schema,
+                delta_snap={"summary": {"total-records": str(total_records), "total-files-size": str(total_bytes)}},
+                label=f"{len(parent_ids)} coalesced snapshots",
+            )
+            with _phase("publish"):
+                publish_wap_changes(cow_table_fqn, catalog_name, str(newest_t))
+    finally:
+        _session().catalog.dropTempView(view)
+    record_checkpoint(cow_table_fqn, newest_t, parent_ids[-1], total_records)
+    _record_commit_volume(cow_table_fqn)
+    print(f"[{mor_table_fqn}] Published WAP changes with truncate {newest_t}.")
 
-    # Build lineage from the new truncate snapshot back to (but not including) last_success_t.
-    by_id: dict = {}
-    lineage: List[dict] = []
 
-    # Optionally fetch the checkpoint snapshot so we know its summary when detecting truncates.
-    if last_success_t is not None:
-        chk = _fetch_snapshot_with_summary(mor_table_fqn, int(last_success_t))
-        if chk is not None:
-            by_id[chk["snapshot_id"]] = chk
+# ------------------------------------------------------------------------------
+# COW maintenance
+# ------------------------------------------------------------------------------
+_ORPHAN_CLEANUP_PROPERTY = "olake.maintenance.last-orphan-cleanup-ms"
 
-    cur_id = head_snapshot_id
-    seen = set()
-    while cur_id is not None and cur_id not in seen:
-        seen.add(cur_id)
-        snap = _fetch_snapshot_with_summary(mor_table_fqn, int(cur_id))
-        if snap is None:
-            break
-        by_id[snap["snapshot_id"]] = snap
-        lineage.append(snap)
 
-        parent_id = snap.get("parent_id")
-        # Stop once we've reached the snapshot whose parent is the checkpoint; this ensures we only
-        # reprocess snapshots strictly after last_success_t.
-        if last_success_t is not None and parent_id == last_success_t:
-            break
-        cur_id = parent_id
+def _summary_wap_id(summary: Optional[dict]) -> Optional[str]:
+    """WAP ID a snapshot was staged under, or published from when a cherry-pick created it."""
+    summary = summary or {}
+    wap_id = summary.get("wap.id") or summary.get("wap_id") or summary.get("wap-id") or summary.get("published-wap-id")
+    return str(wap_id) if wap_id else None
 
-    if not lineage:
-        print(f"[{mor_table_fqn}] No snapshots to scan between checkpoint and current truncate; nothing to do.")
-        return
 
-    # Process in chronological order (oldest -> newest).
-    lineage.reverse()
+def _latest_published_wap_snapshot(index: dict, head_id: Optional[int]) -> Optional[dict]:
+    """Newest snapshot on the main lineage carrying a WAP ID (the published resume checkpoint)."""
+    if head_id is None:
+        return None
+    for snap in reversed(walk_lineage(index, head_id)):
+        if _summary_wap_id(snap.get("summary")):
+            return snap
+    return None
 
-    any_boundary = False
-    for snap in lineage:
-        parent = by_id.get(snap.get("parent_id"))
-        is_boundary = _is_truncate_boundary_snapshot(snap, parent)
-        if not is_boundary:
-            continue
 
-        any_boundary = True
-        t_id = snap.get("snapshot_id")
+def table_properties(table_fqn: str) -> dict:
+    def load():
+        rows = _session().sql(f"SHOW TBLPROPERTIES {table_fqn}").collect()
+        return {r["key"]: r["value"] for r in rows}
+
+    return _cached_table_meta(table_fqn, "properties", load)
+
+
+def _maybe_rewrite_cow_data_files(cow_table_fqn: str, catalog_name: str):
+    summary = current_snapshot_summary(cow_table_fqn)
+    files = _summary_int(summary, "total-data-files")
+    size = _summary_int(summary, "total-files-size")
+    if not files:
+        return
+    avg = size / files if size is not None else None
+    too_many = files >= MAINTENANCE_MAX_DATA_FILES
+    too_small = avg is not None and files >= MAINTENANCE_MIN_FILES_FOR_SIZE and avg < MAINTENANCE_MIN_AVG_FILE_SIZE_BYTES
+    if not (too_many or too_small):
+        return
+
+    print(f"[{cow_table_fqn}] Maintenance: rewriting data files (files={files}, avg_bytes={int(avg or 0)}) ...")
+    # With the sorted layout, rewrite with the table's sort order so files keep tight key ranges.
+    strategy = "strategy => 'sort'," if COW_SORTED_LAYOUT else ""
+    with _phase("maintenance_rewrite"):
+        _session().sql(f"""
+            CALL {catalog_name}.system.rewrite_data_files(
+                table => '{cow_table_fqn}',
+                {strategy}
+                options => map('target-file-size-bytes', '{MAINTENANCE_TARGET_FILE_SIZE_BYTES}')
+            )
+        """).collect()
+    invalidate_table_cache(cow_table_fqn)
+    _record_decision("maintenance_rewrite_data_files", True)
+
+
+def _maybe_expire_cow_snapshots(cow_table_fqn: str, catalog_name: str):
+    index = snapshot_index(cow_table_fqn)
+    if len(index) <= MAINTENANCE_MAX_SNAPSHOTS:
+        return
+
+    checkpoint = _latest_published_wap_snapshot(index, current_snapshot_id(cow_table_fqn))
+    if checkpoint is None or checkpoint.get("committed_at") is None:
+        print(f"[{cow_table_fqn}] Maintenance: no published WAP snapshot found; not expiring snapshots.")
+        return
+
+    # Only snapshots strictly older than the published checkpoint are candidates, so it always survives.
+    # Read the commit time as epoch millis in Spark: a timestamp string would be re-parsed in the session time zone.
+    older_than_ms = _session().sql(f"""
+        SELECT unix_millis(committed_at) AS ms FROM {cow_table_fqn}.snapshots
+        WHERE snapshot_id = {int(checkpoint["snapshot_id"])}
+    """).collect()[0]["ms"]
+    print(
+        f"[{cow_table_fqn}] Maintenance: expiring snapshots older than {checkpoint['committed_at']} "
+        f"({len(index)} snapshots) ..."
+    )
+    with _phase("maintenance_expire"):
+        _session().sql(f"""
+            CALL {catalog_name}.system.expire_snapshots(
+                table => '{cow_table_fqn}',
+                older_than => TIMESTAMP_MILLIS({int(older_than_ms)}),
+                retain_last => {MAINTENANCE_RETAIN_SNAPSHOTS}
+            )
+        """).collect()
+    invalidate_table_cache(cow_table_fqn)
+    _record_decision("maintenance_expire_snapshots", True)
+
+
+def _maybe_remove_cow_orphan_files(cow_table_fqn: str, catalog_name: str):
+    now_ms = int(time.time() * 1000)
+    try:
+        last_ms = int(table_properties(cow_table_fqn).get(_ORPHAN_CLEANUP_PROPERTY) or 0)
+    except ValueError:
+        last_ms = 0
+    if now_ms - last_ms < MAINTENANCE_ORPHAN_INTERVAL_HOURS * 3600 * 1000:
+        return
+
+    print(f"[{cow_table_fqn}] Maintenance: removing orphan files ...")
+    with _phase("maintenance_orphans"):
+        # Default older_than (3 days) protects files of in-flight writes.
+        _session().sql(f"CALL {catalog_name}.system.remove_orphan_files(table => '{cow_table_fqn}')").collect()
+        _session().sql(f"""
+            ALTER TABLE {cow_table_fqn}
+            SET TBLPROPERTIES ('{_ORPHAN_CLEANUP_PROPERTY}'='{now_ms}')
+        """)
+    invalidate_table_cache(cow_table_fqn)
+    _record_decision("maintenance_remove_orphan_files", True)
+
+
+def maybe_run_cow_maintenance(cow_table_fqn: str):
+    """Threshold-driven maintenance for a COW table; call after the cycle has published (WAP id unset)."""
+    if not MAINTENANCE_ENABLED or not table_exists(cow_table_fqn):
+        return
+    catalog_name, _, _ = split_fqn(cow_table_fqn)
+    head_before = current_snapshot_id(cow_table_fqn)
+    _maybe_rewrite_cow_data_files(cow_table_fqn, catalog_name)
+    _maybe_expire_cow_snapshots(cow_table_fqn, catalog_name)
+    _maybe_remove_cow_orphan_files(cow_table_fqn, catalog_name)
+
+    # Maintenance commits carry no WAP ID: move a checkpoint entry that matched the old head to the new one.
+    entry = read_checkpoint_index(cow_table_fqn)
+    if entry and entry["pending_wap_id"] is None and entry["cow_snapshot_id"] == head_before:
+        invalidate_table_cache(cow_table_fqn)
+        head_after = current_snapshot_id(cow_table_fqn)
+        if head_after != head_before:
+            write_checkpoint_index(
+                cow_table_fqn,
+                entry["wap_id"],
+                head_after,
+                mor_parent_snapshot_id=entry["mor_parent_snapshot_id"],
+                delta_records=entry["delta_records"],
+                cow_records=entry["cow_records"],
+            )
+
+
+CYCLE_COMPACTED = "compacted"
+CYCLE_SKIPPED = "skipped"
+
+
+def _mor_is_idle(mor_table_fqn: str, last_success_t: Optional[int]) -> bool:
+    """
+    Pre-check from snapshot metadata only: True when OLake committed nothing since the last
+    published checkpoint (no added records, data files or delete files), so TRUNCATE and MERGE can be skipped.
+    """
+    head_id = current_snapshot_id(mor_table_fqn)
+    if head_id is None:
+        return True
+    if last_success_t is None:
+        return False
+    if head_id == last_success_t:
+        return True
+    pending = pending_snapshots_since(snapshot_index(mor_table_fqn), head_id, last_success_t)
+    if pending is None:
+        return False
+    return not _has_new_data(pending)
+
+
+def estimate_pending_work(mor_table_fqn: str) -> dict:
+    """
+    Estimate the work the next cycle will do for a MOR table, from snapshot summaries only
+    (nothing is truncated or scanned). Sums what OLake committed since the last published checkpoint,
+    or over the whole head lineage when there is no usable checkpoint.
+    """
+    cow_table_fqn, _ = cow_table_and_location_for(mor_table_fqn)
+    catalog_name, _, _ = split_fqn(mor_table_fqn)
+
+    wap_id = get_wap_id_from_table(cow_table_fqn, catalog_name)
+    checkpoint = checkpoint_from_wap_id(wap_id)
+    head_id = current_snapshot_id(mor_table_fqn)
+    index = snapshot_index(mor_table_fqn)
+
+    pending = None
+    if checkpoint is not None:
+        pending = pending_snapshots_since(index, head_id, checkpoint)
+    if pending is None:
+        pending = walk_lineage(index, head_id) if head_id is not None else []
+
+    est = {
+        "table": mor_table_fqn,
+        "checkpoint": checkpoint,
+        "head_snapshot_id": head_id,
+        "snapshots": len(pending),
+        "added_records": 0,
+        "added_data_files": 0,
+        "added_delete_files": 0,
+        "added_delete_records": 0,
+        "added_bytes": 0,
+    }
+    for snap in pending:
+        summary = snap.get("summary") or {}
+        est["added_records"] += _summary_int(summary, "added-records") or 0
+        est["added_data_files"] += _summary_int(summary, "added-data-files") or 0
+        est["added_delete_files"] += _added_delete_files(summary)
+        est["added_delete_records"] += (_summary_int(summary, "added-equality-deletes") or 0) + (
+            _summary_int(summary, "added-position-deletes") or 0
+        )
+        est["added_bytes"] += _summary_int(summary, "added-files-size") or 0
+    return est
+
+
+def _work_score(est: Optional[dict]) -> Tuple[int, int]:
+    # Bytes first (closest to I/O cost), records as tie-breaker.
+    if est is None:
+        return (-1, -1)
+    return (est["added_bytes"], est["added_records"] + est["added_delete_records"])
+
+
+def plan_tables(mor_tables: List[str]) -> List[Tuple[str, Optional[dict]]]:
+    """
+    Estimate pending work for every table and return [(table, estimate)] largest-first.
+    Tables whose estimate failed come first, since their size is unknown.
+    """
+    planned = []
+    for mor_table in mor_tables:
+        try:
+            est = estimate_pending_work(mor_table)
+        except Exception as e:
+            print(f"[{mor_table}] Could not estimate pending work: {e}")
+            est = None
+        planned.append((mor_table, est))
+
+    planned.sort(key=lambda p: (p[1] is not None, tuple(-v for v in _work_score(p[1]))))
+    return planned
+
+
+def print_plan(planned: List[Tuple[str, Optional[dict]]]):
+    print("---- Compaction Plan (largest first) ----")
+    for mor_table, est in planned:
+        if est is None:
+            print(f"  - {mor_table}: estimate unavailable")
+            continue
+        print(
+            f"  - {mor_table}: snapshots={est['snapshots']} records={est['added_records']} "
+            f"data_files={est['added_data_files']} delete_files={est['added_delete_files']} "
+            f"delete_records={est['added_delete_records']} bytes={est['added_bytes']} "
+            f"(checkpoint={est['checkpoint']}, head={est['head_snapshot_id']})"
+        )
+
+
+def run_compaction_cycle_for_table(mor_table_fqn: str) -> str:
+    """
+    Run one compaction cycle for a MOR table.
+    Returns CYCLE_SKIPPED when the table had no new data since the last checkpoint, else CYCLE_COMPACTED.
+    """
+    cow_table_fqn, cow_location = cow_table_and_location_for(mor_table_fqn)
+    catalog_name, _, _ = split_fqn(mor_table_fqn)
+
+    # Step 1: Resume checkpoint from COW's last WAP id; re-publish it (idempotent) to finalize any half-done runs.
+    with _phase("resume"):
+        if table_exists(cow_table_fqn):
+            enable_wap_for_table(cow_table_fqn)
+
+        wap_id = get_wap_id_from_table(cow_table_fqn, catalog_name)
+        last_success_t = None
+
+        if wap_id:
+            print(f"[{mor_table_fqn}] Found existing WAP ID: {wap_id}. Re-publishing (idempotent)...")
+            publish_wap_changes(cow_table_fqn, catalog_name, wap_id)
+            last_success_t = extract_truncate_id_from_wap_id(wap_id)
+            if last_success_t is not None:
+                print(f"[{mor_table_fqn}] Last successful truncate checkpoint: {last_success_t}")
+            else:
+                print(f"[{mor_table_fqn}] Warning: Could not parse WAP ID {wap_id} as truncate snapshot id. Starting from beginning.")
+        else:
+            print(f"[{mor_table_fqn}] No WAP ID found; starting from earliest MOR history.")
+
+    # Fast path: nothing written since the checkpoint -> no TRUNCATE (no empty snapshot), no MERGE.
+    with _phase("idle_check"):
+        idle = _mor_is_idle(mor_table_fqn, last_success_t)
+    if idle:
+        print(f"[{mor_table_fqn}] No new data since checkpoint {last_success_t}; skipping.")
+        return CYCLE_SKIPPED
+
+    # Step 2/3: Truncate MOR to create the boundary for this run.
+    with _phase("truncate"):
+        # OLake keeps committing to the MOR table; a TRUNCATE that loses the race is simply retried.
+        with_retries(f"[{mor_table_fqn}] truncate", lambda: _session().sql(f"TRUNCATE TABLE {mor_table_fqn}"))
+        invalidate_table_cache(mor_table_fqn)
+
+    # Read snapshot metadata once; boundary detection and the lineage walk run over this index.
+    with _phase("lineage"):
+        by_id = snapshot_index(mor_table_fqn)
+        head_snapshot_id, _ = get_latest_snapshot_and_parent_id(mor_table_fqn, index=by_id)
+    if head_snapshot_id is None:
+        print(f"[{mor_table_fqn}] No snapshots found; nothing to do.")
+        return CYCLE_COMPACTED
+
+    # Build lineage from the new truncate snapshot back to (but not including) last_success_t.
+    lineage = walk_lineage(by_id, head_snapshot_id, stop_at_snapshot_id=last_success_t)
+
+    if not lineage:
+        print(f"[{mor_table_fqn}] No snapshots to scan between checkpoint and current truncate; nothing to do.")
+        return CYCLE_COMPACTED
+
+    boundaries = []
+    for snap in lineage:
+        parent = by_id.get(snap.get("parent_id"))
+        if _is_truncate_boundary_snapshot(snap, parent):
+            boundaries.append((snap, parent))
+    any_boundary = bool(boundaries)
+
+    unresolved = [snap.get("snapshot_id") for snap, parent in boundaries if parent is None]
+    if COALESCE_BOUNDARIES and len(boundaries) > 1 and unresolved:
+        # Coalescing would skip their parents while moving the checkpoint past them; one by one,
+        # the run stops at the first boundary whose parent cannot be read.
+        print(
+            f"[{mor_table_fqn}] Parent snapshots of boundaries {unresolved} are not in the MOR history; "
+            "applying boundaries one by one instead of coalescing."
+        )
+    elif COALESCE_BOUNDARIES and len(boundaries) > 1:
+        # The first boundary creates the COW baseline if needed; the rest go through one MERGE.
+        if not table_exists(cow_table_fqn) or not _cow_has_any_snapshots(cow_table_fqn):
+            snap, parent = boundaries.pop(0)
+            _record_delta_volume(parent)
+            _apply_truncate_boundary(
+                mor_table_fqn=mor_table_fqn,
+                cow_table_fqn=cow_table_fqn,
+                cow_location=cow_location,
+                catalog_name=catalog_name,
+                boundary_snap=snap,
+                parent_snap=parent,
+            )
+        if len(boundaries) > 1:
+            for _, parent in boundaries:
+                _record_delta_volume(parent)
+            _apply_coalesced_boundaries(mor_table_fqn, cow_table_fqn, catalog_name, boundaries)
+            boundaries = []
+
+    for snap, parent in boundaries:
+        _record_delta_volume(parent)
 
         _apply_truncate_boundary(
             mor_table_fqn=mor_table_fqn,
@@ -780,6 +3051,7 @@ def run_compaction_cycle_for_table(mor_table_fqn: str):
             cow_location=cow_location,
             catalog_name=catalog_name,
             boundary_snap=snap,
+            parent_snap=parent,
         )
 
     if not any_boundary:
@@ -788,23 +3060,561 @@ def run_compaction_cycle_for_table(mor_table_fqn: str):
         head_snap = by_id.get(head_snapshot_id)
         if head_snap is None:
             print(f"[{mor_table_fqn}] Head snapshot {head_snapshot_id} not found; nothing to do.")
-            return
+            return CYCLE_COMPACTED
 
         print(
             f"[{mor_table_fqn}] Warning: no truncate boundaries detected by signature; "
             f"processing head snapshot {head_snapshot_id} once as boundary."
         )
+        head_parent = by_id.get(head_snap.get("parent_id"))
+        _record_delta_volume(head_parent)
         _apply_truncate_boundary(
             mor_table_fqn=mor_table_fqn,
             cow_table_fqn=cow_table_fqn,
             cow_location=cow_location,
             catalog_name=catalog_name,
             boundary_snap=head_snap,
+            parent_snap=head_parent,
+        )
+
+    maybe_run_cow_maintenance(cow_table_fqn)
+    return CYCLE_COMPACTED
+
+
+def _remaining_start_delete_files(mor_table_fqn: str, start_snapshot_id: int) -> int:
+    """Delete files live at start_snapshot_id that are still live at the table's current snapshot (manifests only)."""
+    live = "status < 2 AND data_file.content > 0"
+    return int(_session().sql(f"""
+        SELECT COUNT(*) AS c
+        FROM (
+            SELECT DISTINCT data_file.file_path AS file_path
+            FROM {mor_table_fqn}.entries VERSION AS OF {int(start_snapshot_id)}
+            WHERE {live}
+        ) AS s
+        JOIN (
+            SELECT DISTINCT data_file.file_path AS file_path
+            FROM {mor_table_fqn}.entries
+            WHERE {live}
+        ) AS e
+        ON s.file_path = e.file_path
+    """).collect()[0]["c"])
+
+
+def run_inplace_cycle_for_table(mor_table_fqn: str) -> str:
+    """
+    In-place mode: resolve the MOR table's delete files into its own data files.
+    - rewrite_data_files with delete-file-threshold rewrites only data files that have deletes
+      applied to them (equality and position), writing the surviving rows to new files;
+      remove-dangling-deletes (Iceberg 1.7+) then drops delete files that no longer apply to any data file.
+    - rewrite_position_delete_files then compacts the position deletes that are left.
+    Skips the table when its current snapshot reports no live delete files. Delete files OLake commits
+    during the rewrite are left for the next cycle. With INPLACE_DELETE_FILE_THRESHOLD = 1, every delete
+    file that was live when the rewrite started must be gone afterwards, else the table is reported as
+    failed; with a higher threshold, data files below it keep their deletes, so leftovers are only counted.
+    """
+    catalog_name, _, _ = split_fqn(mor_table_fqn)
+
+    with _phase("idle_check"):
+        head = current_snapshot_id(mor_table_fqn)
+        snap = _fetch_snapshot_with_summary(mor_table_fqn, head) if head is not None else None
+        delete_files = _total_delete_files((snap or {}).get("summary"))
+    if head is None or delete_files == 0:
+        print(f"[{mor_table_fqn}] No delete files; skipping.")
+        return CYCLE_SKIPPED
+    start_snapshot_id = head
+
+    print(f"[{mor_table_fqn}] Applying {delete_files if delete_files is not None else 'unknown'} delete file(s) in place ...")
+    with _phase("rewrite_data_files"):
+        # use-starting-sequence-number keeps equality deletes OLake commits meanwhile applicable to the new files.
+        rows = _session().sql(f"""
+            CALL {catalog_name}.system.rewrite_data_files(
+                table => '{mor_table_fqn}',
+                options => map(
+                    'delete-file-threshold', '{INPLACE_DELETE_FILE_THRESHOLD}',
+                    'use-starting-sequence-number', 'true',
+                    'remove-dangling-deletes', 'true'
+                )
+            )
+        """).collect()
+    if rows:
+        d = rows[0].asDict(recursive=True)
+        _add_volume("mor_files_rewritten", d.get("rewritten_data_files_count"))
+        _add_volume("mor_files_added", d.get("added_data_files_count"))
+        _add_volume("mor_bytes_rewritten", d.get("rewritten_bytes_count"))
+
+    with _phase("rewrite_position_delete_files"):
+        rows = _session().sql(f"""
+            CALL {catalog_name}.system.rewrite_position_delete_files(
+                table => '{mor_table_fqn}',
+                options => map('rewrite-all', 'true')
+            )
+        """).collect()
+    if rows:
+        d = rows[0].asDict(recursive=True)
+        _add_volume("mor_delete_files_rewritten", d.get("rewritten_delete_files_count"))
+    invalidate_table_cache(mor_table_fqn)
+
+    remaining = _remaining_start_delete_files(mor_table_fqn, start_snapshot_id)
+    _add_volume("mor_delete_files_remaining", remaining)
+    if remaining and INPLACE_DELETE_FILE_THRESHOLD <= 1:
+        raise RuntimeError(
+            f"{remaining} delete file(s) live at snapshot {start_snapshot_id} are still referenced after the "
+            f"in-place rewrite of {mor_table_fqn}; the table is not fully compacted"
+        )
+    if remaining:
+        print(
+            f"[{mor_table_fqn}] {remaining} delete file(s) kept for data files below the threshold "
+            f"of {INPLACE_DELETE_FILE_THRESHOLD} delete files."
         )
+    else:
+        print(f"[{mor_table_fqn}] All delete files live at snapshot {start_snapshot_id} applied in place.")
+    return CYCLE_COMPACTED
+
+
+# ------------------------------------------------------------------------------
+# Changelog mode (no TRUNCATE)
+# ------------------------------------------------------------------------------
+_CDC_DELETE_COLUMN = "_olake_cdc_delete"
+_CHANGELOG_META_COLUMNS = ("_change_type", "_change_ordinal", "_commit_snapshot_id")
+
+
+def _temp_view_name(prefix: str, table_fqn: str) -> str:
+    return prefix + re.sub(r"[^A-Za-z0-9_]", "_", table_fqn)
+
+
+def _pending_adds_delete_files(snaps: List[dict]) -> bool:
+    return any(_added_delete_files(snap.get("summary")) > 0 for snap in snaps)
+
+
+def _pending_may_remove_rows(snaps: List[dict]) -> bool:
+    """True unless the summaries prove no row was deleted (no delete files, removed files or deleted records)."""
+    for snap in snaps:
+        summary = snap.get("summary")
+        if _added_delete_files(summary) > 0:
+            return True
+        if (_removed_data_files(summary) or 0) > 0 or (_summary_int(summary, "deleted-records") or 0) > 0:
+            return True
+    return False
+
+
+def _changelog_view_changes(mor_table_fqn: str, start_snapshot_id: int, end_snapshot_id: int):
+    """
+    Net changes in (start, end] via Iceberg's create_changelog_view with net_changes. Net changes are
+    computed over whole rows, so an update shows up as a DELETE of the old row and an INSERT of the new one;
+    deleted keys are the DELETEd keys without an INSERT. No identifier columns are passed: with them,
+    Iceberg computes update images, which it rejects together with net_changes.
+    Returns (view name, upserted rows, deleted keys). Iceberg changelog scans do not support delete
+    files, so this is only used when no pending snapshot added any.
+    """
+    catalog_name, _, _ = split_fqn(mor_table_fqn)
+    view = _temp_view_name("olake_changelog_", mor_table_fqn)
+    _session().sql(f"""
+        CALL {catalog_name}.system.create_changelog_view(
+            table => '{mor_table_fqn}',
+            changelog_view => '{view}',
+            options => map('start-snapshot-id', '{start_snapshot_id}', 'end-snapshot-id', '{end_snapshot_id}'),
+            net_changes => true
+        )
+    """)
+    changes = _session().table(view)
+    upserts = changes.filter("_change_type = 'INSERT'").drop(*_CHANGELOG_META_COLUMNS)
+    deleted = (
+        changes.filter("_change_type = 'DELETE'")
+        .select(PRIMARY_KEY)
+        .join(upserts.select(PRIMARY_KEY), PRIMARY_KEY, "left_anti")
+    )
+    return view, upserts, deleted
+
+
+def _pending_added_files(mor_table_fqn: str, end_snapshot_id: int, pending: List[dict]) -> dict:
+    """
+    Files the pending snapshots added, from manifest metadata only: {"data": live data files at `end`,
+    "equality": equality-delete files, "position": {snapshot id: position-delete files it added}}.
+    Delete files are taken from all_entries, so ones a later pending snapshot already removed still count.
+    """
+    ids = ", ".join(str(int(snap["snapshot_id"])) for snap in pending)
+    data = _session().sql(f"""
+        SELECT DISTINCT data_file.file_path AS file_path
+        FROM {mor_table_fqn}.entries VERSION AS OF {end_snapshot_id}
+        WHERE status < 2 AND data_file.content = 0 AND snapshot_id IN ({ids})
+    """).collect()
+    deletes = _session().sql(f"""
+        SELECT DISTINCT CAST(snapshot_id AS STRING) AS snapshot_id, data_file.content AS content,
+            data_file.file_path AS file_path
+        FROM {mor_table_fqn}.all_entries
+        WHERE status = 1 AND data_file.content > 0 AND snapshot_id IN ({ids})
+    """).collect()
+    position: dict = {}
+    for r in deletes:
+        if r["content"] == 1:
+            position.setdefault(_to_snapshot_id(r["snapshot_id"]), []).append(r["file_path"])
+    return {
+        "data": [r["file_path"] for r in data],
+        "position": position,
+        "equality": sorted({r["file_path"] for r in deletes if r["content"] == 2}),
+    }
+
+
+# Iceberg FileIO schemes read through Hadoop FileSystem with the session's fs.s3a settings (see _normalize_warehouse).
+_HADOOP_SCHEME_ALIASES = {"s3": "s3a", "s3n": "s3a"}
+_HADOOP_SCHEMES = ("s3a", "file", "hdfs", "gs", "abfs", "abfss", "wasb", "wasbs")
+
+
+def _hadoop_path(path: str) -> str:
+    """Map an Iceberg file path onto a Hadoop FileSystem scheme this session can read; raises ValueError otherwise."""
+    scheme, sep, rest = path.partition("://")
+    if not sep:
+        return path
+    scheme = _HADOOP_SCHEME_ALIASES.get(scheme.lower(), scheme.lower())
+    if scheme not in _HADOOP_SCHEMES:
+        raise ValueError(f"Cannot read {path} through Hadoop FileSystem: unsupported scheme '{scheme}'")
+    return f"{scheme}://{rest}"
+
+
+def _read_equality_delete_keys(mor_table_fqn: str, files: List[str]):
+    """
+    PRIMARY_KEY of every row in the given equality-delete files. Iceberg exposes no metadata table for
+    their contents, so the Parquet files are read directly through Hadoop FileSystem (s3:// mapped to s3a://,
+    using the session's fs.s3a settings rather than the catalog's FileIO credentials).
+    """
+    paths = [_hadoop_path(f) for f in files]
+    try:
+        # Listing and schema inference open the files here, so missing access fails now rather than mid-MERGE.
+        eq = _session().read.parquet(*paths)
+    except Exception as e:
+        raise RuntimeError(
+            f"Could not read the equality-delete files of {mor_table_fqn} through Hadoop FileSystem "
+            f"(e.g. {paths[0]}); the Spark session needs fs.s3a access to the table's storage: {e}"
+        ) from e
+    if PRIMARY_KEY not in eq.columns:
+        raise ValueError(
+            f"Equality-delete files of {mor_table_fqn} are not keyed by {PRIMARY_KEY}; cannot derive deleted keys"
+        )
+    return eq.select(PRIMARY_KEY)
+
+
+def _position_deletes_sql(mor_table_fqn: str, position_files: dict) -> str:
+    """
+    (file_path, pos) of the rows the given position-delete files delete, read through the position_deletes
+    metadata table (the catalog's FileIO). Each file is read at the snapshot that added it, where it is live.
+    """
+    return " UNION ALL ".join(
+        f"""
+        SELECT file_path, pos
+        FROM {mor_table_fqn}.position_deletes VERSION AS OF {int(sid)}
+        WHERE delete_file_path IN ({_file_list_sql(paths)})
+        """
+        for sid, paths in sorted(position_files.items())
+    )
+
+
+def _pending_removed_data_files(mor_table_fqn: str, pending: List[dict]) -> List[str]:
+    """Data files removed by pending snapshots other than compaction rewrites ('replace' keeps every row)."""
+    ids = [
+        int(snap["snapshot_id"])
+        for snap in pending
+        if (snap.get("operation") or "").lower() != "replace" and (_removed_data_files(snap.get("summary")) or 0) > 0
+    ]
+    if not ids:
+        return []
+    rows = _session().sql(f"""
+        SELECT DISTINCT data_file.file_path AS file_path
+        FROM {mor_table_fqn}.all_entries
+        WHERE status = 2 AND data_file.content = 0 AND snapshot_id IN ({", ".join(str(i) for i in ids)})
+    """).collect()
+    return [r["file_path"] for r in rows]
+
+
+def _snapshot_diff_changes(
+    mor_table_fqn: str,
+    start_snapshot_id: int,
+    end_snapshot_id: int,
+    pending: List[dict],
+    with_deletes: bool,
+):
+    """
+    Net changes in (start, end] for histories with delete files, reading only what the pending snapshots
+    added (file lists come from manifests; the scans carry literal `_file IN (...)` filters):
+    - upserts: live rows at `end` in data files added by pending snapshots (every insert or update lands
+      in a new file; files rewritten by compaction only add redundant upserts);
+    - deleted keys, when with_deletes: keys in the added equality-delete files (see _read_equality_delete_keys),
+      keys of the rows the added position-delete files point at (via the position_deletes metadata table),
+      and keys of data files removed outright, minus the upserted keys.
+      A key that is still live at `end` sits in an added file, so it is an upsert rather than a delete.
+    Returns (upserted rows, deleted keys or None).
+    """
+    files = _pending_added_files(mor_table_fqn, end_snapshot_id, pending)
+    added_filter = f"_file IN ({_file_list_sql(files['data'])})" if files["data"] else "FALSE"
+    upserts = _session().sql(f"SELECT * FROM {mor_table_fqn} VERSION AS OF {end_snapshot_id} WHERE {added_filter}")
+
+    if not with_deletes:
+        return upserts, None
+
+    candidates = []
+    if files["equality"]:
+        candidates.append(_read_equality_delete_keys(mor_table_fqn, files["equality"]))
+    if files["position"]:
+        pos_sql = _position_deletes_sql(mor_table_fqn, files["position"])
+        targets = [r["file_path"] for r in _session().sql(f"SELECT DISTINCT file_path FROM ({pos_sql}) AS d").collect()]
+        if targets:
+            # Rows in files that only exist within the window were never visible at `start`; they drop out here.
+            candidates.append(_session().sql(f"""
+                SELECT t.{PRIMARY_KEY}
+                FROM (
+                    SELECT {PRIMARY_KEY}, _file, _pos FROM {mor_table_fqn} VERSION AS OF {start_snapshot_id}
+                    WHERE _file IN ({_file_list_sql(targets)})
+                ) AS t
+                JOIN ({pos_sql}) AS d ON t._file = d.file_path AND t._pos = d.pos
+            """))
+    removed = _pending_removed_data_files(mor_table_fqn, pending)
+    if removed:
+        candidates.append(_session().sql(f"""
+            SELECT {PRIMARY_KEY} FROM {mor_table_fqn} VERSION AS OF {start_snapshot_id}
+            WHERE _file IN ({_file_list_sql(removed)})
+        """))
+    if not candidates:
+        return upserts, None
+
+    keys = candidates[0]
+    for c in candidates[1:]:
+        keys = keys.unionByName(c)
+    deleted = keys.distinct().join(upserts.select(PRIMARY_KEY), PRIMARY_KEY, "left_anti")
+    return upserts, deleted
+
+
+def _merge_changes_into_cow(
+    mor_table_fqn: str,
+    cow_table_fqn: str,
+    upserts,
+    deleted_keys,
+    delta_snap: Optional[dict],
+):
+    """
+    Apply upserted rows and deleted keys to the COW table in one MERGE (one staged snapshot).
+    Deleted keys travel in the same source with _olake_cdc_delete = true and their other columns NULL.
+    """
+    source = upserts.withColumn(_CDC_DELETE_COLUMN, F.lit(False))
+    if deleted_keys is not None:
+        source = source.unionByName(deleted_keys.withColumn(_CDC_DELETE_COLUMN, F.lit(True)), allowMissingColumns=True)
+    # The change set is read by key pruning, the MERGE and the audit; compute it from MOR only once.
+    source = source.persist(StorageLevel.MEMORY_AND_DISK)
+    view = _temp_view_name("olake_changes_", mor_table_fqn)
+    source.createOrReplaceTempView(view)
+    try:
+        with _phase("schema_align"):
+            align_cow_schema(cow_table_fqn, upserts.schema, table_schema(cow_table_fqn))
+            sync_cow_partitioning(mor_table_fqn, cow_table_fqn)
+            ensure_cow_bucketing(cow_table_fqn)
+            ensure_cow_layout(cow_table_fqn)
+
+        conditions = [f"target.{PRIMARY_KEY} = source.{PRIMARY_KEY}"]
+        if MERGE_MODE == "pruned":
+            with _phase("key_pruning"):
+                conditions.append(_delta_key_predicate(f"SELECT * FROM {view}") or "FALSE")
+        upsert_sql = f"SELECT * FROM {view} WHERE NOT {_CDC_DELETE_COLUMN}"
+        deleted_keys_sql = f"SELECT {PRIMARY_KEY} FROM {view} WHERE {_CDC_DELETE_COLUMN}"
+        profile = None
+        if AUDIT_ENABLED:
+            with _phase("delta_profile"):
+                profile = _delta_profile(upsert_sql, _audit_columns(upserts.schema))
+
+        cols = [f.name for f in upserts.schema.fields]
+        assignments = ", ".join(f"`{c}` = source.`{c}`" for c in cols)
+        insert_cols = ", ".join(f"`{c}`" for c in cols)
+        insert_values = ", ".join(f"source.`{c}`" for c in cols)
+        merge_sql = f"""
+            MERGE INTO {cow_table_fqn} AS target
+            USING {view} AS source
+            ON {" AND ".join(conditions)}
+
+            WHEN MATCHED AND source.{_CDC_DELETE_COLUMN} THEN
+                DELETE
+
+            WHEN MATCHED THEN
+                UPDATE SET {assignments}
+
+            WHEN NOT MATCHED AND NOT source.{_CDC_DELETE_COLUMN} THEN
+                INSERT ({insert_cols}) VALUES ({insert_values})
+        """
+        tuned_conf = tune_spark_for_delta(cow_table_fqn, delta_snap)
+        with _phase("merge"), _session_conf(tuned_conf), profile_spark_jobs(cow_table_fqn, "merge"):
+            with_retries(f"[{cow_table_fqn}] merge", lambda: _session().sql(merge_sql))
+        invalidate_table_cache(cow_table_fqn)
+        audit_staged_commit(
+            cow_table_fqn,
+            upsert_sql,
+            upserts.schema,
+            profile=profile,
+            deleted_keys_sql=deleted_keys_sql if deleted_keys is not None else None,
+        )
+    finally:
+        _session().catalog.dropTempView(view)
+        source.unpersist()
+
+
+def run_changelog_cycle_for_table(mor_table_fqn: str) -> str:
+    """
+    Changelog mode: bring the COW table from the checkpoint MOR snapshot to the current MOR head
+    without truncating the MOR table.
+    - No checkpoint yet: CTAS baseline from the head snapshot.
+    - Otherwise: net changes since the checkpoint via create_changelog_view when the pending snapshots
+      add no delete files, else from the data and delete files those snapshots added (see _snapshot_diff_changes);
+      applied with one MERGE and published under WAP ID "changelog-<head>".
+    """
+    cow_table_fqn, cow_location = cow_table_and_location_for(mor_table_fqn)
+    catalog_name, _, _ = split_fqn(mor_table_fqn)
+
+    with _phase("resume"):
+        wap_id = get_wap_id_from_table(cow_table_fqn, catalog_name)
+        checkpoint = extract_changelog_id_from_wap_id(wap_id) if wap_id else None
+        if wap_id and checkpoint is None:
+            raise ValueError(
+                f"COW table {cow_table_fqn} carries WAP ID {wap_id} from --mode cow; "
+                "use a separate --cow-db for changelog mode"
+            )
+        if wap_id:
+            # Finalize a half-done run (idempotent).
+            publish_wap_changes(cow_table_fqn, catalog_name, wap_id)
+            print(f"[{mor_table_fqn}] Last changelog checkpoint: {checkpoint}")
+
+    with _phase("idle_check"):
+        idle = checkpoint is not None and _mor_is_idle(mor_table_fqn, checkpoint)
+        head_id = current_snapshot_id(mor_table_fqn)
+    if idle or head_id is None:
+        print(f"[{mor_table_fqn}] No new data since checkpoint {checkpoint}; skipping.")
+        return CYCLE_SKIPPED
+
+    new_wap_id = changelog_wap_id(head_id)
+    index = snapshot_index(mor_table_fqn)
+
+    if checkpoint is None or not _cow_has_any_snapshots(cow_table_fqn):
+        head_snap = index.get(head_id)
+        _record_delta_volume(head_snap)
+        print(f"[{mor_table_fqn}] Creating COW baseline from snapshot {head_id} ...")
+        mark_checkpoint_pending(cow_table_fqn, new_wap_id)
+        with _staged_under_wap_id(new_wap_id):
+            tuned_conf = tune_spark_for_delta(cow_table_fqn, head_snap)
+            with _phase("create_baseline"), _session_conf(tuned_conf), profile_spark_jobs(cow_table_fqn, "ctas"):
+                _ensure_cow_table_from_snapshot(mor_table_fqn, cow_table_fqn, cow_location, head_id)
+            audit_staged_baseline(cow_table_fqn, head_snap)
+            with _phase("publish"):
+                publish_wap_changes(cow_table_fqn, catalog_name, new_wap_id)
+        record_checkpoint(cow_table_fqn, new_wap_id, head_id, _summary_int((head_snap or {}).get("summary"), "total-records"))
+        _record_commit_volume(cow_table_fqn)
+        print(f"[{mor_table_fqn}] Published WAP changes with {new_wap_id}.")
+        maybe_run_cow_maintenance(cow_table_fqn)
+        return CYCLE_COMPACTED
+
+    pending = pending_snapshots_since(index, head_id, checkpoint)
+    if pending is None:
+        raise ValueError(
+            f"Checkpoint snapshot {checkpoint} is not an ancestor of MOR head {head_id} "
+            f"(history rewritten or expired); drop {cow_table_fqn} to rebuild it"
+        )
+    delta_snap = _pending_delta_summary(pending)
+    _record_delta_volume(delta_snap)
+    print(f"[{mor_table_fqn}] Applying {len(pending)} snapshot(s) after {checkpoint} up to {head_id} ...")
+
+    changelog_view = None
+    try:
+        upserts = deleted = None
+        if not _pending_adds_delete_files(pending):
+            try:
+                with _phase("changelog"):
+                    changelog_view, upserts, deleted = _changelog_view_changes(mor_table_fqn, checkpoint, head_id)
+            except Exception as e:
+                print(f"[{mor_table_fqn}] create_changelog_view failed; using snapshot diff instead: {e}")
+        engine = "changelog_view" if changelog_view else "snapshot_diff"
+        if changelog_view is None:
+            upserts, deleted = _snapshot_diff_changes(
+                mor_table_fqn, checkpoint, head_id, pending, with_deletes=_pending_may_remove_rows(pending)
+            )
+        print(f"[{mor_table_fqn}] Changes read via {engine}.")
+        _record_decision("changelog_engine", engine)
+
+        mark_checkpoint_pending(cow_table_fqn, new_wap_id)
+        with _staged_under_wap_id(new_wap_id):
+            _merge_changes_into_cow(mor_table_fqn, cow_table_fqn, upserts, deleted, delta_snap)
+            with _phase("publish"):
+                publish_wap_changes(cow_table_fqn, catalog_name, new_wap_id)
+    finally:
+        if changelog_view:
+            _session().catalog.dropTempView(changelog_view)
+    record_checkpoint(cow_table_fqn, new_wap_id, head_id, _summary_int(delta_snap["summary"], "total-records"))
+    _record_commit_volume(cow_table_fqn)
+    print(f"[{mor_table_fqn}] Published WAP changes with {new_wap_id}.")
+    maybe_run_cow_maintenance(cow_table_fqn)
+    return CYCLE_COMPACTED
+
+
+def _fair_pool_name(mor_table_fqn: str) -> str:
+    return "olake_" + re.sub(r"[^A-Za-z0-9_]", "_", mor_table_fqn)
+
+
+def _run_table_in_worker(mor_table_fqn: str) -> str:
+    """
+    Run one table's compaction cycle from a worker thread.
+    - Lazily creates one child SparkSession per worker thread (separate SQL conf, so
+      spark.wap.id does not leak between tables; shared SparkContext and catalog config).
+    - Submits the table's jobs into its own FAIR scheduler pool.
+    """
+    if getattr(_thread_state, "spark", None) is None:
+        _thread_state.spark = spark.newSession()
+    sc = spark.sparkContext
+    sc.setLocalProperty("spark.scheduler.pool", _fair_pool_name(mor_table_fqn))
+    try:
+        return _run_cycle_with_metrics(mor_table_fqn)
+    finally:
+        _set_wap_id(None)
+        sc.setLocalProperty("spark.scheduler.pool", None)
+
+
+def compact_tables(mor_tables: List[str], parallelism: int = 1):
+    """
+    Run compaction cycles for the given MOR tables.
+    Returns (successes, skipped, failures) where failures is a list of (table, error message).
+    """
+    successes = []
+    skipped = []
+    failures = []
+
+    def record(mor_table: str, status: str):
+        if status == CYCLE_SKIPPED:
+            skipped.append(mor_table)
+        else:
+            successes.append(mor_table)
+
+    if parallelism <= 1:
+        for mor_table in mor_tables:
+            try:
+                record(mor_table, _run_cycle_with_metrics(mor_table))
+            except Exception as e:
+                failures.append((mor_table, str(e)))
+                print(f"[{mor_table}] FAILED: {e}")
+        write_run_metrics()
+        return successes, skipped, failures
+
+    with ThreadPoolExecutor(max_workers=parallelism, thread_name_prefix="olake-compaction") as pool:
+        futures = {pool.submit(_run_table_in_worker, t): t for t in mor_tables}
+        for fut in as_completed(futures):
+            mor_table = futures[fut]
+            try:
+                record(mor_table, fut.result())
+            except Exception as e:
+                failures.append((mor_table, str(e)))
+                print(f"[{mor_table}] FAILED: {e}")
+
+    # Keep the summary in input order regardless of completion order.
+    order = {t: i for i, t in enumerate(mor_tables)}
+    successes.sort(key=lambda t: order[t])
+    skipped.sort(key=lambda t: order[t])
+    failures.sort(key=lambda f: order[f[0]])
+    write_run_metrics()
+    return successes, skipped, failures
 
 
 def list_tables_in_db(catalog: str, db: str):
-    rows = spark.sql(f"SHOW TABLES IN {catalog}.{db}").collect()
+    rows = _session().sql(f"SHOW TABLES IN {catalog}.{db}").collect()
     table_names = []
     for r in rows:
         d = r.asDict(recursive=True)
@@ -816,6 +3626,281 @@ def list_tables_in_db(catalog: str, db: str):
     return table_names
 
 
+def list_mor_tables(catalog: str, db: str) -> List[str]:
+    # Always compact all MOR tables in the source namespace/database.
+    return [
+        f"{catalog}.{db}.{t}"
+        for t in list_tables_in_db(catalog, db)
+        if not t.endswith("_cow")
+    ]
+
+
+def print_summary(successes: List[str], skipped: List[str], failures: List[Tuple[str, str]]):
+    print("---- Compaction Summary ----")
+    print(f"Successful tables: {len(successes)}")
+    for t in successes:
+        print(f"  - {t}")
+    print(f"Skipped tables (no new data): {len(skipped)}")
+    for t in skipped:
+        print(f"  - {t}")
+    print(f"Failed tables: {len(failures)}")
+    for t, err in failures:
+        print(f"  - {t}: {err}")
+
+
+def _published_checkpoint(mor_table_fqn: str) -> Optional[int]:
+    cow_table_fqn, _ = cow_table_and_location_for(mor_table_fqn)
+    catalog_name, _, _ = split_fqn(mor_table_fqn)
+    wap_id = get_wap_id_from_table(cow_table_fqn, catalog_name)
+    return checkpoint_from_wap_id(wap_id)
+
+
+def _settled_head(mor_table_fqn: str) -> Optional[int]:
+    """Head snapshot id that needs no further work after a successful cycle."""
+    if COMPACTION_MODE == "inplace":
+        # Our own rewrite is the new head.
+        invalidate_table_cache(mor_table_fqn)
+        return current_snapshot_id(mor_table_fqn)
+    return _published_checkpoint(mor_table_fqn)
+
+
+def _prefetch_one(mor_table_fqn: str):
+    current_snapshot_id(mor_table_fqn)
+    snapshot_index(mor_table_fqn)
+    if COMPACTION_MODE != "inplace":
+        cow_table_fqn, _ = cow_table_and_location_for(mor_table_fqn)
+        catalog_name, _, _ = split_fqn(mor_table_fqn)
+        current_snapshot_id(cow_table_fqn)
+        get_wap_id_from_table(cow_table_fqn, catalog_name)
+
+
+def prefetch_table_metadata(mor_tables: List[str], parallelism: Optional[int] = None):
+    """
+    Warm the metadata cache for all tables with at most `parallelism` concurrent catalog requests.
+    Best effort: a table whose prefetch fails simply loads its metadata again during its cycle.
+    """
+    parallelism = PREFETCH_PARALLELISM if parallelism is None else parallelism
+    if parallelism <= 0 or not mor_tables:
+        return
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=min(parallelism, len(mor_tables)), thread_name_prefix="olake-prefetch") as pool:
+        futures = {pool.submit(_prefetch_one, t): t for t in mor_tables}
+        for fut in as_completed(futures):
+            try:
+                fut.result()
+            except Exception as e:
+                print(f"[{futures[fut]}] Metadata prefetch failed (loaded on demand instead): {e}")
+    print(f"Prefetched metadata for {len(mor_tables)} table(s) in {time.monotonic() - start:.1f}s (parallelism={parallelism}).")
+
+
+def order_tables(mor_tables: List[str]) -> List[str]:
+    # Largest-first scheduling relies on COW checkpoints, so it does not apply to in-place mode.
+    if COMPACTION_MODE == "inplace":
+        return list(mor_tables)
+    return [t for t, _ in plan_tables(mor_tables)]
+
+
+def run_daemon(catalog: str, db: str, poll_interval: float, parallelism: int = 1):
+    """
+    Keep the current SparkSession warm and compact tables as soon as their MOR head moves.
+
+    Every poll re-lists the namespace (so new tables are picked up) and reads each MOR table's
+    current snapshot id from metadata. A table is run only when its head is not one we already know
+    needs no work: the published checkpoint (or, in-place, our rewrite) after a compaction, or the
+    observed head after a skip.
+    Stops after the current poll on SIGTERM/SIGINT.
+    """
+    stop = threading.Event()
+
+    def _request_stop(signum, _frame):
+        print(f"Received signal {signum}; stopping after the current poll.")
+        stop.set()
+
+    signal.signal(signal.SIGTERM, _request_stop)
+    signal.signal(signal.SIGINT, _request_stop)
+
+    # {mor_table_fqn: set of head snapshot ids that need no work}
+    settled: dict = {}
+    while not stop.is_set():
+        started = time.monotonic()
+        # Heads move outside this process; start every poll from fresh catalog metadata.
+        invalidate_table_cache()
+
+        moved = []
+        heads = {}
+        try:
+            for mor_table in list_mor_tables(catalog, db):
+                head = current_snapshot_id(mor_table)
+                heads[mor_table] = head
+                if head is not None and head not in settled.get(mor_table, set()):
+                    moved.append(mor_table)
+        except Exception as e:
+            print(f"Daemon poll failed: {e}")
+
+        if moved:
+            print(f"Daemon: {len(moved)} table(s) with new MOR snapshots.")
+            prefetch_table_metadata(moved)
+            successes, skipped, failures = compact_tables(order_tables(moved), parallelism=parallelism)
+            for t in successes:
+                try:
+                    head = _settled_head(t)
+                    settled[t] = {head} if head is not None else set()
+                except Exception as e:
+                    print(f"[{t}] Could not read settled head: {e}")
+                    settled.pop(t, None)
+            for t in skipped:
+                # Nothing was truncated, so the head we saw is still the one with no pending work.
+                settled.setdefault(t, set()).add(heads[t])
+            for t, _err in failures:
+                settled.pop(t, None)
+            print_summary(successes, skipped, failures)
+
+        stop.wait(max(0.0, poll_interval - (time.monotonic() - started)))
+
+
+def _catalog_config_key(writer: dict) -> str:
+    # Everything in the writer config feeds the SparkSession except the target database.
+    return json.dumps({k: v for k, v in writer.items() if k != "iceberg_db"}, sort_keys=True, default=str)
+
+
+_DEFAULT_CATALOG = CATALOG
+_DEFAULT_COW_BASE_LOCATION = COW_BASE_LOCATION
+
+
+def _run_batch_group(group_jobs: List[dict], parallelism: int):
+    """Compact one catalog config's jobs on a SparkSession built for that config, in this process."""
+    global spark, CATALOG, DB, COW_DB, COW_BASE_LOCATION
+
+    writer = group_jobs[0]["writer"]
+    invalidate_table_cache()
+    spark = build_spark_session_from_writer(writer, fair_scheduler=parallelism > 1)
+    CATALOG = writer.get("catalog_name") or _DEFAULT_CATALOG
+    print(f"Batch: catalog {CATALOG} ({writer.get('catalog_type')}) for jobs {[j['job_id'] for j in group_jobs]}")
+
+    successes, skipped, failures = [], [], []
+    for job in group_jobs:
+        for namespace in job["namespaces"]:
+            DB = namespace
+            COW_DB = BATCH_COW_DB_TEMPLATE.format(namespace=namespace, job_id=job["job_id"])
+            COW_BASE_LOCATION = f"{_DEFAULT_COW_BASE_LOCATION.rstrip('/')}/{CATALOG}/{COW_DB}"
+            print(f"[job {job['job_id']}] Compacting {CATALOG}.{DB} -> {CATALOG}.{COW_DB}")
+            try:
+                if COMPACTION_MODE != "inplace":
+                    ensure_namespace_exists(CATALOG, COW_DB)
+                mor_tables = list_mor_tables(CATALOG, DB)
+                prefetch_table_metadata(mor_tables)
+                mor_tables = order_tables(mor_tables)
+            except Exception as e:
+                failures.append((f"{CATALOG}.{DB}", str(e)))
+                print(f"[job {job['job_id']}] Namespace {CATALOG}.{DB} FAILED: {e}")
+                continue
+            s, k, f = compact_tables(mor_tables, parallelism=parallelism)
+            successes.extend(s)
+            skipped.extend(k)
+            failures.extend(f)
+    return successes, skipped, failures
+
+
+def _with_cli_option(argv: List[str], option: str, value: str) -> List[str]:
+    """argv with `option` set to value (replacing `option X` / `option=X`, or appending it)."""
+    out, i, found = [], 0, False
+    while i < len(argv):
+        arg = argv[i]
+        if arg == option:
+            out += [option, value]
+            i += 2
+            found = True
+            continue
+        if arg.startswith(option + "="):
+            out.append(f"{option}={value}")
+            found = True
+        else:
+            out.append(arg)
+        i += 1
+    return out if found else out + [option, value]
+
+
+# Spark settings of this (parent) application that must not carry over to a child's own application.
+_CHILD_EXCLUDED_CONF = ("spark.submit.deployMode", "spark.app.id", "spark.driver.host", "spark.driver.port")
+
+
+def _java_properties_escape(text: str) -> str:
+    return (
+        str(text).replace("\\", "\\\\").replace("\n", "\\n").replace("\r", "\\r")
+        .replace("=", "\\=").replace(":", "\\:")
+    )
+
+
+def _child_process_env(work_dir: str) -> dict:
+    """
+    Environment for a batch child: its own JVM (not this process's py4j gateway) with this process's Spark conf.
+    Under spark-submit, the conf (master, driver memory, --conf flags, spark-defaults.conf, ...) is held by
+    the gateway JVM spark-submit already started; it is read from there and passed on as a properties file,
+    which the child's own session settings (jars, catalog) override. Without spark-submit, the child
+    inherits PYSPARK_SUBMIT_ARGS unchanged. No JVM is started in this process.
+    """
+    env = {k: v for k, v in os.environ.items() if not k.startswith("PYSPARK_GATEWAY_")}
+    if "PYSPARK_GATEWAY_PORT" not in os.environ:
+        return env
+    from pyspark import SparkConf, SparkContext
+
+    # Connects to the running spark-submit gateway (PYSPARK_GATEWAY_PORT) rather than launching one.
+    SparkContext._ensure_initialized()
+    properties_path = os.path.join(work_dir, "spark-submit.properties")
+    with open(properties_path, "w", encoding="utf-8") as f:
+        for key, value in sorted(SparkConf().getAll()):
+            if key not in _CHILD_EXCLUDED_CONF:
+                f.write(f"{_java_properties_escape(key)}={_java_properties_escape(value)}\n")
+    env["PYSPARK_SUBMIT_ARGS"] = f"--properties-file {shlex.quote(properties_path)} pyspark-shell"
+    return env
+
+
+def _run_batch_group_in_child(group_jobs: List[dict]):
+    """Run one catalog config's jobs as `--batch` in a fresh process (and JVM); returns its summary."""
+    job_ids = [j["job_id"] for j in group_jobs]
+    with tempfile.TemporaryDirectory(prefix="olake-batch-") as tmp:
+        details_path = os.path.join(tmp, "destination_details.json")
+        summary_path = os.path.join(tmp, "summary.json")
+        records = [
+            {"job_id": j["job_id"], "namespaces": j["namespaces"], "destination": {"config": {"writer": j["writer"]}}}
+            for j in group_jobs
+        ]
+        with open(details_path, "w", encoding="utf-8") as f:
+            json.dump(records, f)
+        argv = _with_cli_option(sys.argv[1:], "--destination-details", details_path)
+        argv = _with_cli_option(argv, "--batch-summary-json", summary_path)
+        print(f"Batch: running jobs {job_ids} in a child process")
+        proc = subprocess.run([sys.executable, os.path.abspath(__file__)] + argv, env=_child_process_env(tmp))
+        if proc.returncode != 0 or not os.path.exists(summary_path):
+            return [], [], [(f"jobs {job_ids}", f"batch child process exited with status {proc.returncode}")]
+        with open(summary_path, "r", encoding="utf-8") as f:
+            summary = json.load(f)
+    return summary["successes"], summary["skipped"], [tuple(x) for x in summary["failures"]]
+
+
+def run_batch(jobs: List[dict], parallelism: int = 1):
+    """
+    Compact every (job, source namespace). Jobs are grouped by catalog config. A single group runs in
+    this process; with several, each group runs in its own child process, because the jars and AWS
+    environment a config needs only take effect when a JVM is launched.
+    Returns the combined (successes, skipped, failures).
+    """
+    groups: dict = {}
+    for job in jobs:
+        groups.setdefault(_catalog_config_key(job["writer"]), []).append(job)
+
+    if len(groups) == 1:
+        return _run_batch_group(jobs, parallelism)
+
+    successes, skipped, failures = [], [], []
+    for group_jobs in groups.values():
+        s, k, f = _run_batch_group_in_child(group_jobs)
+        successes.extend(s)
+        skipped.extend(k)
+        failures.extend(f)
+    return successes, skipped, failures
+
+
 # ------------------------------------------------------------------------------
 # Entry Point
 # ------------------------------------------------------------------------------
@@ -827,16 +3912,266 @@ if __name__ == "__main__":
         help="Path to destination_details.json generated by get_destination_details.sh",
     )
     parser.add_argument("--job-id", type=int, default=None, help="Optional job_id to select from destination_details.json")
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="Compact every job record and source namespace in destination_details.json (array format) in one process",
+    )
+    # Internal: a batch child process writes its summary here for the parent (see run_batch).
+    parser.add_argument("--batch-summary-json", default=None, help=argparse.SUPPRESS)
+    parser.add_argument(
+        "--batch-cow-db-template",
+        default=BATCH_COW_DB_TEMPLATE,
+        help="With --batch: COW namespace per job/namespace; {namespace} and {job_id} are substituted",
+    )
     parser.add_argument("--cow-db", default=COW_DB, help="Destination namespace/database for COW tables/state")
     parser.add_argument("--catalog-name", default=None, help="Override catalog name (otherwise taken from destination config)")
+    parser.add_argument(
+        "--mode",
+        choices=["cow", "inplace", "changelog"],
+        default=COMPACTION_MODE,
+        help=(
+            "cow: maintain a separate COW copy per table; inplace: apply delete files inside the MOR table itself; "
+            "changelog: maintain the COW copy from MOR net changes without truncating the MOR table"
+        ),
+    )
+    parser.add_argument(
+        "--inplace-delete-file-threshold",
+        type=int,
+        default=INPLACE_DELETE_FILE_THRESHOLD,
+        help="In-place mode: rewrite data files with at least this many delete files applied",
+    )
+    parser.add_argument(
+        "--merge-strategy",
+        choices=["merge", "overwrite", "rebuild", "auto"],
+        default=MERGE_STRATEGY,
+        help="How deltas are written to COW; auto picks from delta vs COW record counts in snapshot summaries",
+    )
+    parser.add_argument(
+        "--partition-scoped-merge",
+        action="store_true",
+        help="Restrict the MERGE target to the COW partitions touched by the delta (partition columns must be immutable per key)",
+    )
+    parser.add_argument(
+        "--coalesce-boundaries",
+        action="store_true",
+        help="Apply several pending truncate boundaries in one MERGE (latest version per key), published under the newest boundary",
+    )
+    parser.add_argument(
+        "--maintenance",
+        action="store_true",
+        help="After publishing, run rewrite_data_files / expire_snapshots / remove_orphan_files on the COW table when thresholds are crossed",
+    )
+    parser.add_argument(
+        "--maintenance-target-file-size-bytes",
+        type=int,
+        default=MAINTENANCE_TARGET_FILE_SIZE_BYTES,
+        help="Target file size for maintenance rewrite_data_files",
+    )
+    parser.add_argument(
+        "--maintenance-max-data-files",
+        type=int,
+        default=MAINTENANCE_MAX_DATA_FILES,
+        help="Rewrite data files once the COW table has at least this many",
+    )
+    parser.add_argument(
+        "--maintenance-min-avg-file-size-bytes",
+        type=int,
+        default=MAINTENANCE_MIN_AVG_FILE_SIZE_BYTES,
+        help="Rewrite data files once the average COW data file is smaller than this",
+    )
+    parser.add_argument(
+        "--maintenance-max-snapshots",
+        type=int,
+        default=MAINTENANCE_MAX_SNAPSHOTS,
+        help="Expire snapshots once the COW table has more than this many",
+    )
+    parser.add_argument(
+        "--maintenance-min-files-for-size",
+        type=int,
+        default=MAINTENANCE_MIN_FILES_FOR_SIZE,
+        help="Only apply the average file size rule once the COW table has at least this many data files",
+    )
+    parser.add_argument(
+        "--maintenance-retain-snapshots",
+        type=int,
+        default=MAINTENANCE_RETAIN_SNAPSHOTS,
+        help="Newest COW snapshots always kept by maintenance expire_snapshots",
+    )
+    parser.add_argument(
+        "--maintenance-orphan-interval-hours",
+        type=float,
+        default=MAINTENANCE_ORPHAN_INTERVAL_HOURS,
+        help="Minimum hours between remove_orphan_files runs per COW table",
+    )
+    parser.add_argument(
+        "--sorted-layout",
+        action="store_true",
+        help=f"Create/maintain COW tables with a write sort order and Parquet bloom filter on {PRIMARY_KEY}",
+    )
+    parser.add_argument(
+        "--cow-buckets",
+        type=int,
+        default=COW_BUCKETS,
+        help=f"Bucket COW tables by bucket(N, {PRIMARY_KEY}) and merge via storage-partitioned join; 0 disables. Changing N re-buckets existing tables",
+    )
+    parser.add_argument(
+        "--auto-tune",
+        action="store_true",
+        help="Set shuffle partitions, AQE and (for overwrite/rebuild) broadcast threshold per table from delta/COW sizes in snapshot summaries",
+    )
+    parser.add_argument(
+        "--tune-target-partition-bytes",
+        type=int,
+        default=TUNE_TARGET_PARTITION_BYTES,
+        help="With --auto-tune: target bytes per shuffle partition",
+    )
+    parser.add_argument(
+        "--tune-broadcast-max-bytes",
+        type=int,
+        default=TUNE_BROADCAST_MAX_BYTES,
+        help="With --auto-tune: broadcast deltas up to this many bytes in overwrite/rebuild writes (not MERGE)",
+    )
+    parser.add_argument(
+        "--retry-attempts",
+        type=int,
+        default=RETRY_MAX_ATTEMPTS,
+        help="Attempts per commit (TRUNCATE, MERGE, publish) on conflicts and transient errors",
+    )
+    parser.add_argument(
+        "--retry-base-delay",
+        type=float,
+        default=RETRY_BASE_DELAY_SECONDS,
+        help="Base delay in seconds for exponential backoff (with full jitter) between commit retries",
+    )
+    parser.add_argument(
+        "--audit",
+        action="store_true",
+        help="Audit each staged commit (summary row counts + key/row hash aggregate vs the delta) and block publishing on mismatch",
+    )
+    parser.add_argument(
+        "--merge-mode",
+        choices=["full", "pruned"],
+        default=MERGE_MODE,
+        help="full: plain MERGE on the primary key; pruned: restrict the COW side to the delta's keys first",
+    )
+    parser.add_argument(
+        "--pruned-merge-max-keys",
+        type=int,
+        default=PRUNED_MERGE_MAX_KEYS,
+        help="Max delta keys pushed as an IN-list in pruned mode (larger deltas use a key range)",
+    )
+    parser.add_argument(
+        "--jars-bundle-dir",
+        default=JARS_BUNDLE_DIR,
+        help="Directory of pre-resolved dependency bundles; when set, spark.jars points at the bundle instead of spark.jars.packages",
+    )
+    parser.add_argument(
+        "--resolve-bundle",
+        action="store_true",
+        help="Resolve the dependency bundle for this catalog through Ivy into --jars-bundle-dir and exit",
+    )
+    parser.add_argument("--maven-repo", default=MAVEN_REPO, help="Maven repository used by --resolve-bundle")
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="Only estimate each table's pending work from snapshot summaries and print it (no TRUNCATE/MERGE)",
+    )
+    parser.add_argument(
+        "--metrics-dir",
+        default=METRICS_DIR,
+        help=f"Directory for per-table metrics ({METRICS_JSONL_FILE} and Prometheus textfile {METRICS_PROM_FILE})",
+    )
+    parser.add_argument(
+        "--checkpoint-index",
+        default=CHECKPOINT_INDEX_PATH,
+        help="SQLite file caching each COW table's last published checkpoint (verified against the COW head on read)",
+    )
+    parser.add_argument(
+        "--profile-dir",
+        default=PROFILE_DIR,
+        help="Write per-table MERGE/CTAS profiles (physical plan, stage durations, shuffle, spill, task skew) as JSON here",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Keep one SparkSession alive and compact tables whenever their MOR head snapshot moves",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=POLL_INTERVAL_SECONDS,
+        help="Seconds between polls in --daemon mode",
+    )
+    parser.add_argument(
+        "--prefetch-parallelism",
+        type=int,
+        default=PREFETCH_PARALLELISM,
+        help="Concurrent catalog requests when prefetching table metadata before compaction; 0 disables",
+    )
+    parser.add_argument(
+        "--parallelism",
+        type=int,
+        default=PARALLELISM,
+        help="Number of tables to compact concurrently (each in its own FAIR scheduler pool). Default: 1 (sequential)",
+    )
     args = parser.parse_args()
 
-    # Source DB is expected to be hardcoded in this file.
-    if not DB or DB.strip() == "" or DB.strip() == "<YOUR_SOURCE_DB>":
+    # Source DB is expected to be hardcoded in this file (batch mode reads namespaces from the config file).
+    if not args.batch and (not DB or DB.strip() == "" or DB.strip() == "<YOUR_SOURCE_DB>"):
         raise ValueError("Please set DB = '<YOUR_SOURCE_DB>' at the top of fail_test.py before running.")
 
     # Update globals from args
     COW_DB = args.cow_db
+    PARALLELISM = max(1, args.parallelism)
+    PREFETCH_PARALLELISM = max(0, args.prefetch_parallelism)
+    POLL_INTERVAL_SECONDS = args.poll_interval
+    METRICS_DIR = args.metrics_dir
+    CHECKPOINT_INDEX_PATH = args.checkpoint_index
+    PROFILE_DIR = args.profile_dir
+    if PROFILE_DIR:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+    if METRICS_DIR:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+    COMPACTION_MODE = args.mode
+    INPLACE_DELETE_FILE_THRESHOLD = args.inplace_delete_file_threshold
+    MERGE_MODE = args.merge_mode
+    MERGE_STRATEGY = args.merge_strategy
+    PARTITION_SCOPED_MERGE = args.partition_scoped_merge
+    COALESCE_BOUNDARIES = args.coalesce_boundaries
+    COW_SORTED_LAYOUT = args.sorted_layout
+    COW_BUCKETS = max(0, args.cow_buckets)
+    AUTO_TUNE = args.auto_tune
+    AUDIT_ENABLED = args.audit
+    RETRY_MAX_ATTEMPTS = max(1, args.retry_attempts)
+    RETRY_BASE_DELAY_SECONDS = max(0.0, args.retry_base_delay)
+    TUNE_TARGET_PARTITION_BYTES = max(1, args.tune_target_partition_bytes)
+    TUNE_BROADCAST_MAX_BYTES = args.tune_broadcast_max_bytes
+    MAINTENANCE_ENABLED = args.maintenance
+    MAINTENANCE_TARGET_FILE_SIZE_BYTES = args.maintenance_target_file_size_bytes
+    MAINTENANCE_MAX_DATA_FILES = args.maintenance_max_data_files
+    MAINTENANCE_MIN_AVG_FILE_SIZE_BYTES = args.maintenance_min_avg_file_size_bytes
+    MAINTENANCE_MIN_FILES_FOR_SIZE = args.maintenance_min_files_for_size
+    MAINTENANCE_MAX_SNAPSHOTS = args.maintenance_max_snapshots
+    MAINTENANCE_RETAIN_SNAPSHOTS = args.maintenance_retain_snapshots
+    MAINTENANCE_ORPHAN_INTERVAL_HOURS = args.maintenance_orphan_interval_hours
+    PRUNED_MERGE_MAX_KEYS = args.pruned_merge_max_keys
+    BATCH_COW_DB_TEMPLATE = args.batch_cow_db_template
+    JARS_BUNDLE_DIR = args.jars_bundle_dir
+
+    if args.batch:
+        if args.daemon or args.plan or args.resolve_bundle or args.job_id is not None:
+            raise ValueError("--batch cannot be combined with --daemon, --plan, --resolve-bundle or --job-id")
+        batch_jobs = load_batch_jobs(args.destination_details)
+        if args.catalog_name:
+            for job in batch_jobs:
+                job["writer"]["catalog_name"] = args.catalog_name
+        successes, skipped, failures = run_batch(batch_jobs, parallelism=PARALLELISM)
+        print_summary(successes, skipped, failures)
+        if args.batch_summary_json:
+            with open(args.batch_summary_json, "w", encoding="utf-8") as f:
+                json.dump({"successes": successes, "skipped": skipped, "failures": failures}, f)
+        raise SystemExit(0)
 
     writer = load_destination_writer_config(args.destination_details, job_id=args.job_id)
     if args.catalog_name:
@@ -846,35 +4181,33 @@ if __name__ == "__main__":
     CATALOG = writer.get("catalog_name") or CATALOG
     _recompute_derived_names()
 
+    if args.resolve_bundle:
+        if not JARS_BUNDLE_DIR:
+            raise ValueError("--resolve-bundle requires --jars-bundle-dir")
+        resolve_dependency_bundle(writer, JARS_BUNDLE_DIR, repo=args.maven_repo)
+        raise SystemExit(0)
+
     # Create Spark session with the right Iceberg/S3 config
-    spark = build_spark_session_from_writer(writer)
+    spark = build_spark_session_from_writer(writer, fair_scheduler=PARALLELISM > 1)
 
     # Ensure destination namespace exists before creating state/COW tables
-    ensure_namespace_exists(CATALOG, COW_DB)
-
-    # Always compact all MOR tables in the source namespace/database.
-    all_tables = list_tables_in_db(CATALOG, DB)
-    mor_tables = [
-        f"{CATALOG}.{DB}.{t}"
-        for t in all_tables
-        if not t.endswith("_cow")
-    ]
-
-    successes = []
-    failures = []
-
-    for mor_table in mor_tables:
-        try:
-            run_compaction_cycle_for_table(mor_table)
-            successes.append(mor_table)
-        except Exception as e:
-            failures.append((mor_table, str(e)))
-            print(f"[{mor_table}] FAILED: {e}")
-
-    print("---- Compaction Summary ----")
-    print(f"Successful tables: {len(successes)}")
-    for t in successes:
-        print(f"  - {t}")
-    print(f"Failed tables: {len(failures)}")
-    for t, err in failures:
-        print(f"  - {t}: {err}")
\ No newline at end of file
+    if COMPACTION_MODE != "inplace":
+        ensure_namespace_exists(CATALOG, COW_DB)
+
+    if args.daemon:
+        run_daemon(CATALOG, DB, POLL_INTERVAL_SECONDS, parallelism=PARALLELISM)
+        raise SystemExit(0)
+
+    mor_tables = list_mor_tables(CATALOG, DB)
+    prefetch_table_metadata(mor_tables)
+
+    if args.plan:
+        if COMPACTION_MODE == "inplace":
+            raise ValueError("--plan is only supported with --mode cow or changelog")
+        print_plan(plan_tables(mor_tables))
+        raise SystemExit(0)
+    # Schedule largest-first so one big table does not start last and stretch the run.
+    mor_tables = order_tables(mor_tables)
+
+    successes, skipped, failures = compact_tables(mor_tables, parallelism=PARALLELISM)
+    print_summary(successes, skipped, failures)
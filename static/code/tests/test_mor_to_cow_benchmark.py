@@ -0,0 +1,29 @@
+import importlib.util
+import os
+
+import pytest
+
+# The benchmark imports pyspark at module level; these tests only check the SQL it generates.
+pytest.importorskip("pyspark")
+
+
+@pytest.fixture(scope="module")
+def bench():
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "mor_to_cow_benchmark.py")
+    spec = importlib.util.spec_from_file_location("mor_to_cow_benchmark", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_rows_sql_is_deterministic(bench):
+    sql = bench._rows_sql("SELECT id FROM range(10)", "u", 2, 7)
+    assert sql == bench._rows_sql("SELECT id FROM range(10)", "u", 2, 7)
+    lowered = sql.lower()
+    for nondeterministic in ("rand(", "randn(", "uuid(", "current_timestamp", "now("):
+        assert nondeterministic not in lowered
+
+
+def test_rows_sql_later_versions_get_later_timestamps(bench):
+    assert "1700000000 + 1 * 86400" in bench._rows_sql("SELECT id FROM range(1)", "c", 1, 0)
+    assert "1700000000 + 3 * 86400" in bench._rows_sql("SELECT id FROM range(1)", "c", 3, 0)
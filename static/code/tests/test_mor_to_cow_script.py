@@ -0,0 +1,681 @@
+import datetime
+import importlib.util
+import json
+import os
+
+import pytest
+
+# The script imports pyspark at module level. Tests run its helpers and cycle logic against FakeSession,
+# which records the SQL it is given instead of starting Spark.
+pytest.importorskip("pyspark")
+
+
+@pytest.fixture(scope="module")
+def script():
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "mor_to_cow_script.py")
+    spec = importlib.util.spec_from_file_location("mor_to_cow_script", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class _FakeResult:
+    def __init__(self, rows=()):
+        self._rows = list(rows)
+
+    def collect(self):
+        return self._rows
+
+
+class _FakeConf:
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    def set(self, key, value):
+        self.values[key] = value
+
+    def unset(self, key):
+        self.values.pop(key, None)
+
+
+class _FakeCatalog:
+    def __init__(self):
+        self.dropped_views = []
+
+    def dropTempView(self, name):
+        self.dropped_views.append(name)
+
+
+class FakeFrame:
+    """Stand-in for a DataFrame: records the transformations applied to it."""
+
+    def __init__(self, ops=(), columns=()):
+        self.ops = list(ops)
+        self.columns = list(columns)
+
+    def _then(self, *op):
+        return FakeFrame(self.ops + [op], self.columns)
+
+    def filter(self, condition):
+        return self._then("filter", condition)
+
+    def drop(self, *cols):
+        return self._then("drop", cols)
+
+    def select(self, *cols):
+        return self._then("select", cols)
+
+    def join(self, other, on, how):
+        return self._then("join", on, how, tuple(other.ops))
+
+
+class _FakeReader:
+    def __init__(self):
+        self.parquet_paths = []
+        self.columns = []
+
+    def parquet(self, *paths):
+        self.parquet_paths.extend(paths)
+        return FakeFrame([("parquet", paths)], self.columns)
+
+
+class FakeSession:
+    """
+    Stand-in for the SparkSession: records every SQL statement (whitespace-collapsed) and answers it with
+    the rows registered for the first marker it contains. `SET spark.wap.id=...` updates conf like Spark.
+    """
+
+    def __init__(self, results=None):
+        self.statements = []
+        self.results = results or {}
+        self.conf = _FakeConf()
+        self.catalog = _FakeCatalog()
+        self.read = _FakeReader()
+
+    def sql(self, query):
+        statement = " ".join(query.split())
+        self.statements.append(statement)
+        if statement.startswith("SET spark.wap.id="):
+            value = statement[len("SET spark.wap.id="):]
+            if value:
+                self.conf.set("spark.wap.id", value)
+            else:
+                self.conf.unset("spark.wap.id")
+        for marker, rows in self.results.items():
+            if marker in statement:
+                return _FakeResult(rows() if callable(rows) else rows)
+        return _FakeResult()
+
+    def table(self, name):
+        return FakeFrame([("table", name)])
+
+    def ran(self, fragment):
+        return [s for s in self.statements if fragment in s]
+
+
+@pytest.fixture
+def fake_spark(script, monkeypatch):
+    session = FakeSession()
+    monkeypatch.setattr(script, "spark", session)
+    script.invalidate_table_cache()
+    yield session
+    script.invalidate_table_cache()
+
+
+def _snap(sid, committed_at):
+    return {"snapshot_id": sid, "committed_at": committed_at}
+
+
+def test_snapshots_newest_first_orders_by_commit_time(script):
+    t0 = datetime.datetime(2024, 1, 1)
+    index = {
+        1: _snap(1, t0),
+        2: _snap(2, t0 + datetime.timedelta(minutes=2)),
+        3: _snap(3, t0 + datetime.timedelta(minutes=1)),
+    }
+    assert [s["snapshot_id"] for s in script._snapshots_newest_first(index)] == [2, 3, 1]
+
+
+def test_snapshots_newest_first_puts_missing_timestamps_last(script):
+    t0 = datetime.datetime(2024, 1, 1)
+    index = {
+        1: _snap(1, None),
+        2: _snap(2, t0),
+        3: _snap(3, float("nan")),  # stands in for pandas NaT, which also compares unequal to itself
+        4: _snap(4, t0 + datetime.timedelta(seconds=1)),
+    }
+    ordered = [s["snapshot_id"] for s in script._snapshots_newest_first(index)]
+    assert ordered[:2] == [4, 2]
+    assert sorted(ordered[2:]) == [1, 3]
+
+
+def test_maven_jar_url(script):
+    url, file_name = script._maven_jar_url(
+        "org.apache.iceberg:iceberg-aws-bundle:1.5.2", "https://repo1.maven.org/maven2/"
+    )
+    assert file_name == "iceberg-aws-bundle-1.5.2.jar"
+    assert url == (
+        "https://repo1.maven.org/maven2/org/apache/iceberg/iceberg-aws-bundle/1.5.2/iceberg-aws-bundle-1.5.2.jar"
+    )
+
+
+@pytest.mark.parametrize(
+    "transform, expected",
+    [
+        ("region", "s.region"),
+        ("days(updated_at)", "cat.system.days(s.updated_at)"),
+        ("bucket(16, id)", "cat.system.bucket(16, s.id)"),
+        ("truncate(4, name)", "cat.system.truncate(4, s.name)"),
+        ("bucket(id, 16)", "cat.system.bucket(16, s.id)"),
+        ("day(updated_at)", "cat.system.days(s.updated_at)"),
+    ],
+)
+def test_partition_sql_expr(script, transform, expected):
+    assert script._partition_sql_expr(transform, "s", "cat") == expected
+
+
+@pytest.mark.parametrize("transform", ["bucket(16)", "truncate(name, width)", "void(id)"])
+def test_partition_sql_expr_rejects_unknown_transforms(script, transform):
+    with pytest.raises(ValueError):
+        script._partition_sql_expr(transform, "s", "cat")
+
+
+def _cow_history(script, monkeypatch, snaps, head):
+    """Serve the COW table's snapshot index and main head from memory."""
+    index = {snap["snapshot_id"]: snap for snap in snaps}
+    monkeypatch.setattr(script, "snapshot_index", lambda _t: index)
+    monkeypatch.setattr(script, "build_snapshot_index", lambda _t: index)
+    monkeypatch.setattr(script, "current_snapshot_id", lambda _t: head)
+    return index
+
+
+def _wap_snap(sid, parent, summary):
+    return {"snapshot_id": sid, "parent_id": parent, "committed_at": None, "operation": "append", "summary": summary}
+
+
+def test_publish_skips_wap_ids_on_main_lineage(script, monkeypatch, fake_spark):
+    # 3 was cherry-picked from the staged snapshot 2, so main carries WAP ID 7 as published-wap-id.
+    _cow_history(script, monkeypatch, [
+        _wap_snap(1, None, {"wap.id": "5"}),
+        _wap_snap(2, 1, {"wap.id": "7"}),
+        _wap_snap(3, 1, {"published-wap-id": "7"}),
+    ], head=3)
+    script.publish_wap_changes("c.db.t_cow", "c", "7")
+    assert not fake_spark.ran("publish_changes")
+
+
+@pytest.mark.parametrize("error", [
+    "ValidationException: Cannot cherry-pick snapshot 2: not append, dynamic overwrite, or fast-forward",
+    "ValidationException: Cannot cherry-pick replace partitions with changed partition: region=eu",
+])
+def test_publish_rejection_expires_staged_snapshot(script, monkeypatch, fake_spark, tmp_path, error):
+    monkeypatch.setattr(script, "CHECKPOINT_INDEX_PATH", str(tmp_path / "checkpoints.sqlite"))
+    script.write_checkpoint_index("c.db.t_cow", "5", 1)
+    script.mark_checkpoint_pending("c.db.t_cow", "7")
+    _cow_history(script, monkeypatch, [_wap_snap(1, None, {"wap.id": "5"}), _wap_snap(2, 0, {"wap.id": "7"})], head=1)
+
+    def reject():
+        raise RuntimeError(error)
+
+    fake_spark.results["publish_changes"] = reject
+    with pytest.raises(RuntimeError, match="cannot be published"):
+        script.publish_wap_changes("c.db.t_cow", "c", "7")
+    expire = fake_spark.ran("expire_snapshots")
+    assert len(expire) == 1 and "snapshot_ids => array(2)" in expire[0]
+    assert script.read_checkpoint_index("c.db.t_cow")["pending_wap_id"] is None
+
+
+def test_publish_keeps_staged_snapshot_on_transient_errors(script, monkeypatch, fake_spark):
+    monkeypatch.setattr(script, "RETRY_MAX_ATTEMPTS", 2)
+    monkeypatch.setattr(script.time, "sleep", lambda _s: None)
+    _cow_history(script, monkeypatch, [_wap_snap(1, None, {"wap.id": "5"}), _wap_snap(2, 1, {"wap.id": "7"})], head=1)
+
+    def unavailable():
+        raise RuntimeError("ServiceUnavailableException: 503")
+
+    fake_spark.results["publish_changes"] = unavailable
+    with pytest.raises(RuntimeError, match="ServiceUnavailable"):
+        script.publish_wap_changes("c.db.t_cow", "c", "7")
+    assert len(fake_spark.ran("publish_changes")) == 2
+    assert not fake_spark.ran("expire_snapshots")
+
+
+def test_rebuild_not_based_on_main_is_expired(script, monkeypatch, fake_spark):
+    _cow_history(script, monkeypatch, [
+        _wap_snap(1, None, {"wap.id": "5"}),
+        _wap_snap(2, 1, {}),
+        _wap_snap(3, 1, {"wap.id": "7"}),
+    ], head=2)
+    monkeypatch.setattr(script, "_staged_snapshot", lambda _t, _w: _wap_snap(3, 1, {"wap.id": "7"}))
+    fake_spark.conf.set("spark.wap.id", "7")
+    with pytest.raises(RuntimeError, match="cannot be published"):
+        script._check_rebuild_fast_forwards("c.db.t_cow")
+    assert "snapshot_ids => array(3)" in fake_spark.ran("expire_snapshots")[0]
+
+
+def _mor_snap(sid, parent, minute, operation="append"):
+    return {
+        "snapshot_id": sid,
+        "parent_id": parent,
+        "committed_at": datetime.datetime(2024, 1, 1, 0, minute),
+        "operation": operation,
+        "summary": {"total-records": "10"},
+    }
+
+
+def _run_cow_cycle_recording_boundaries(script, monkeypatch, fake_spark, snaps):
+    """Run one cow-mode cycle over the given MOR history; return the per-boundary and coalesced applies."""
+    index = {snap["snapshot_id"]: snap for snap in snaps}
+    monkeypatch.setattr(script, "COALESCE_BOUNDARIES", True)
+    monkeypatch.setattr(script, "table_exists", lambda _t: True)
+    monkeypatch.setattr(script, "enable_wap_for_table", lambda _t: None)
+    monkeypatch.setattr(script, "get_wap_id_from_table", lambda _t, _c: "10")
+    monkeypatch.setattr(script, "publish_wap_changes", lambda *_a: None)
+    monkeypatch.setattr(script, "_mor_is_idle", lambda *_a: False)
+    monkeypatch.setattr(script, "snapshot_index", lambda _t: index)
+    monkeypatch.setattr(script, "_cow_has_any_snapshots", lambda _t: True)
+    monkeypatch.setattr(script, "maybe_run_cow_maintenance", lambda _t: None)
+    monkeypatch.setattr(script, "_is_truncate_boundary_snapshot", lambda snap, _p: snap["operation"] == "delete")
+    single, coalesced = [], []
+    monkeypatch.setattr(
+        script, "_apply_truncate_boundary", lambda **kw: single.append((kw["boundary_snap"]["snapshot_id"], kw["parent_snap"]))
+    )
+    monkeypatch.setattr(
+        script, "_apply_coalesced_boundaries",
+        lambda _m, _c, _n, boundaries: coalesced.append([t["snapshot_id"] for t, _ in boundaries]),
+    )
+    assert script.run_compaction_cycle_for_table("c.db.t") == script.CYCLE_COMPACTED
+    assert fake_spark.ran("TRUNCATE TABLE c.db.t")
+    return single, coalesced
+
+
+def test_coalesces_pending_boundaries(script, monkeypatch, fake_spark):
+    single, coalesced = _run_cow_cycle_recording_boundaries(script, monkeypatch, fake_spark, [
+        _mor_snap(10, 9, 0, "delete"),
+        _mor_snap(11, 10, 1),
+        _mor_snap(12, 11, 2, "delete"),
+        _mor_snap(13, 12, 3),
+        _mor_snap(14, 13, 4, "delete"),
+    ])
+    assert coalesced == [[12, 14]]
+    assert single == []
+
+
+def test_coalescing_falls_back_when_a_parent_is_missing(script, monkeypatch, fake_spark):
+    # Snapshot 11 (parent of boundary 12) was expired; coalescing would move the checkpoint past it unmerged.
+    single, coalesced = _run_cow_cycle_recording_boundaries(script, monkeypatch, fake_spark, [
+        _mor_snap(12, 11, 2, "delete"),
+        _mor_snap(13, 12, 3),
+        _mor_snap(14, 13, 4, "delete"),
+    ])
+    assert coalesced == []
+    assert [(t, parent is None) for t, parent in single] == [(12, True), (14, False)]
+
+
+def test_apply_coalesced_boundaries_requires_every_parent(script):
+    boundaries = [(_mor_snap(12, 11, 2, "delete"), None), (_mor_snap(14, 13, 4, "delete"), _mor_snap(13, 12, 3))]
+    with pytest.raises(ValueError, match=r"\[12\]"):
+        script._apply_coalesced_boundaries("c.db.t", "c.db.t_cow", "c", boundaries)
+
+
+def test_apply_coalesced_boundaries_publishes_under_newest_boundary(script, monkeypatch, fake_spark):
+    merged, published, recorded = [], [], []
+    monkeypatch.setattr(script, "_coalesced_delta_view", lambda _t, ids: merged.append(ids) or ("v", None))
+    monkeypatch.setattr(script, "merge_source_into_cow", lambda *_a, **kw: None)
+    monkeypatch.setattr(script, "publish_wap_changes", lambda _t, _c, wap_id: published.append(wap_id))
+    monkeypatch.setattr(script, "record_checkpoint", lambda _t, wap_id, parent, records: recorded.append((wap_id, parent, records)))
+    monkeypatch.setattr(script, "_record_commit_volume", lambda _t: None)
+    boundaries = [
+        (_mor_snap(12, 11, 2, "delete"), _mor_snap(11, 10, 1)),
+        (_mor_snap(14, 13, 4, "delete"), _mor_snap(13, 12, 3)),
+    ]
+    script._apply_coalesced_boundaries("c.db.t", "c.db.t_cow", "c", boundaries)
+    assert merged == [[11, 13]]
+    assert published == ["14"]
+    assert recorded == [(14, 13, 20)]
+    assert fake_spark.conf.get("spark.wap.id") is None
+    assert fake_spark.catalog.dropped_views == ["v"]
+
+
+def _batch_job(job_id, namespaces):
+    return {"job_id": job_id, "writer": {"catalog_name": "cat", "catalog_type": "rest"}, "namespaces": namespaces}
+
+
+def test_batch_groups_store_cow_tables_per_catalog_and_namespace(script, monkeypatch):
+    monkeypatch.setattr(script, "_DEFAULT_COW_BASE_LOCATION", "s3://bucket/cow/")
+    monkeypatch.setattr(script, "build_spark_session_from_writer", lambda _w, fair_scheduler=False: None)
+    monkeypatch.setattr(script, "ensure_namespace_exists", lambda _c, _n: None)
+    monkeypatch.setattr(script, "list_mor_tables", lambda c, db: [f"{c}.{db}.users"])
+    monkeypatch.setattr(script, "prefetch_table_metadata", lambda _t: None)
+    monkeypatch.setattr(script, "order_tables", lambda tables: tables)
+    for name in ("spark", "CATALOG", "DB", "COW_DB", "COW_BASE_LOCATION"):
+        monkeypatch.setattr(script, name, getattr(script, name))
+    targets = []
+
+    def compact(tables, parallelism=1):
+        targets.extend(script.cow_table_and_location_for(t) for t in tables)
+        return tables, [], []
+
+    monkeypatch.setattr(script, "compact_tables", compact)
+    script._run_batch_group([_batch_job(1, ["pg_public", "pg_sales"])], parallelism=1)
+    assert targets == [
+        ("cat.pg_public_cow.users_cow", "s3://bucket/cow/cat/pg_public_cow/users_cow"),
+        ("cat.pg_sales_cow.users_cow", "s3://bucket/cow/cat/pg_sales_cow/users_cow"),
+    ]
+
+
+def test_load_batch_jobs_rejects_non_object_records(script, tmp_path):
+    path = tmp_path / "destination_details.json"
+    path.write_text(json.dumps([{"job_id": 1, "destination": {"config": {"writer": {}}}}, "oops"]))
+    with pytest.raises(ValueError, match="record 1 must be a JSON object"):
+        script.load_batch_jobs(str(path))
+
+
+def test_child_env_without_spark_submit_starts_no_jvm(script, monkeypatch, tmp_path):
+    from pyspark import SparkContext
+
+    def no_jvm():
+        raise AssertionError("a JVM must not be started in the batch parent")
+
+    monkeypatch.setattr(SparkContext, "_ensure_initialized", no_jvm)
+    monkeypatch.delenv("PYSPARK_GATEWAY_PORT", raising=False)
+    monkeypatch.setenv("PYSPARK_GATEWAY_SECRET", "s")
+    monkeypatch.setenv("PYSPARK_SUBMIT_ARGS", "--master local[2] --driver-memory 4g pyspark-shell")
+    env = script._child_process_env(str(tmp_path))
+    assert "PYSPARK_GATEWAY_SECRET" not in env
+    assert env["PYSPARK_SUBMIT_ARGS"] == "--master local[2] --driver-memory 4g pyspark-shell"
+
+
+def test_child_env_forwards_spark_submit_conf(script, monkeypatch, tmp_path):
+    import pyspark
+
+    class Conf:
+        def getAll(self):
+            return [
+                ("spark.master", "yarn"),
+                ("spark.driver.memory", "8g"),
+                ("spark.submit.deployMode", "cluster"),
+                ("spark.executor.extraJavaOptions", "-Da=b"),
+            ]
+
+    monkeypatch.setattr(pyspark.SparkContext, "_ensure_initialized", lambda: None)
+    monkeypatch.setattr(pyspark, "SparkConf", Conf)
+    monkeypatch.setenv("PYSPARK_GATEWAY_PORT", "12345")
+    env = script._child_process_env(str(tmp_path))
+    assert "PYSPARK_GATEWAY_PORT" not in env
+    properties = tmp_path / "spark-submit.properties"
+    assert env["PYSPARK_SUBMIT_ARGS"] == f"--properties-file {properties} pyspark-shell"
+    assert properties.read_text().splitlines() == [
+        "spark.driver.memory=8g",
+        "spark.executor.extraJavaOptions=-Da\\=b",
+        "spark.master=yarn",
+    ]
+
+
+@pytest.mark.parametrize(
+    "message, kind",
+    [
+        ("org.apache.iceberg.exceptions.CommitStateUnknownException: unknown", "unknown_state"),
+        ("CommitFailedException: Found conflicting files", "conflict"),
+        ("S3Exception: SlowDown (Service: S3, Status Code: 503)", "transient"),
+        ("java.net.SocketTimeoutException: Read timed out", "transient"),
+        ("AnalysisException: Table or view not found", "fatal"),
+        ("CommitFailedException: Requirement failed: branch main has changed: expected id 1 != 2", "conflict"),
+        # Scala require() failures during planning/analysis are not commit conflicts.
+        ("java.lang.IllegalArgumentException: requirement failed: Join keys must match", "fatal"),
+    ],
+)
+def test_classify_commit_error(script, message, kind):
+    assert script.classify_commit_error(RuntimeError(message)) == kind
+
+
+def test_with_retries_retries_conflicts_only(script, monkeypatch):
+    monkeypatch.setattr(script, "RETRY_MAX_ATTEMPTS", 3)
+    monkeypatch.setattr(script.time, "sleep", lambda _s: None)
+
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise RuntimeError("CommitFailedException: Found conflicting files")
+        return "ok"
+
+    assert script.with_retries("test", flaky) == "ok"
+    assert len(calls) == 3
+
+    fatal_calls = []
+
+    def fatal():
+        fatal_calls.append(1)
+        raise RuntimeError("AnalysisException: Table or view not found")
+
+    with pytest.raises(RuntimeError):
+        script.with_retries("test", fatal)
+    assert len(fatal_calls) == 1
+
+
+def test_checkpoint_index_round_trip(script, monkeypatch, tmp_path):
+    monkeypatch.setattr(script, "CHECKPOINT_INDEX_PATH", None)
+    assert script.read_checkpoint_index("c.db.t_cow") is None
+
+    monkeypatch.setattr(script, "CHECKPOINT_INDEX_PATH", str(tmp_path / "checkpoints.sqlite"))
+    assert script.read_checkpoint_index("c.db.t_cow") is None
+
+    script.mark_checkpoint_pending("c.db.t_cow", 42)
+    entry = script.read_checkpoint_index("c.db.t_cow")
+    assert entry["pending_wap_id"] == "42"
+    assert entry["wap_id"] is None
+
+    script.write_checkpoint_index("c.db.t_cow", "42", 1001, mor_parent_snapshot_id=41, delta_records=7)
+    entry = script.read_checkpoint_index("c.db.t_cow")
+    assert entry["wap_id"] == "42"
+    assert entry["cow_snapshot_id"] == 1001
+    assert entry["mor_parent_snapshot_id"] == 41
+    assert entry["delta_records"] == 7
+    assert entry["pending_wap_id"] is None
+
+    script.mark_checkpoint_pending("c.db.t_cow", "changelog-50")
+    entry = script.read_checkpoint_index("c.db.t_cow")
+    assert entry["wap_id"] == "42"
+    assert entry["pending_wap_id"] == "changelog-50"
+
+
+def test_checkpoint_from_wap_id(script):
+    assert script.checkpoint_from_wap_id(None) is None
+    assert script.checkpoint_from_wap_id("123") == 123
+    assert script.checkpoint_from_wap_id(script.changelog_wap_id(456)) == 456
+    assert script.checkpoint_from_wap_id("not-a-checkpoint") is None
+
+
+def test_changelog_cycle_reads_net_changes_from_changelog_view(script, monkeypatch, fake_spark):
+    def create_changelog_view():
+        # Iceberg computes update images when identifier columns are given, and rejects them with net changes.
+        statement = fake_spark.statements[-1]
+        if "identifier_columns" in statement and "compute_updates => false" not in statement:
+            raise RuntimeError("IllegalArgumentException: Not support net changes with update images")
+        return []
+
+    def no_fallback(*_a, **_kw):
+        raise AssertionError("fell back to the snapshot diff")
+
+    fake_spark.results["create_changelog_view"] = create_changelog_view
+    index = {
+        10: _mor_snap(10, 9, 0),
+        11: _mor_snap(11, 10, 1),
+        12: _mor_snap(12, 11, 2),
+    }
+    index[11]["summary"] = {"added-records": "5", "added-data-files": "1", "total-records": "15"}
+    index[12]["summary"] = {"added-records": "2", "added-data-files": "1", "total-records": "17"}
+    merged, published, recorded = [], [], []
+    monkeypatch.setattr(script, "get_wap_id_from_table", lambda _t, _c: script.changelog_wap_id(10))
+    monkeypatch.setattr(script, "publish_wap_changes", lambda _t, _c, wap_id: published.append(wap_id))
+    monkeypatch.setattr(script, "_mor_is_idle", lambda *_a: False)
+    monkeypatch.setattr(script, "current_snapshot_id", lambda _t: 12)
+    monkeypatch.setattr(script, "snapshot_index", lambda _t: index)
+    monkeypatch.setattr(script, "_cow_has_any_snapshots", lambda _t: True)
+    monkeypatch.setattr(script, "_snapshot_diff_changes", no_fallback)
+    monkeypatch.setattr(
+        script, "_merge_changes_into_cow", lambda _m, _c, upserts, deleted, _d: merged.append((upserts, deleted))
+    )
+    monkeypatch.setattr(script, "record_checkpoint", lambda _t, wap_id, parent, records: recorded.append((wap_id, parent, records)))
+    monkeypatch.setattr(script, "_record_commit_volume", lambda _t: None)
+    monkeypatch.setattr(script, "maybe_run_cow_maintenance", lambda _t: None)
+
+    assert script.run_changelog_cycle_for_table("c.db.t") == script.CYCLE_COMPACTED
+
+    call = fake_spark.ran("create_changelog_view")[0]
+    assert "'start-snapshot-id', '10', 'end-snapshot-id', '12'" in call
+    assert "net_changes => true" in call
+    view = "olake_changelog_c_db_t"
+    (upserts, deleted), = merged
+    assert upserts.ops == [("table", view), ("filter", "_change_type = 'INSERT'"), ("drop", script._CHANGELOG_META_COLUMNS)]
+    assert deleted.ops[:3] == [("table", view), ("filter", "_change_type = 'DELETE'"), ("select", ("_olake_id",))]
+    assert deleted.ops[3][:3] == ("join", "_olake_id", "left_anti")
+    assert published == ["changelog-10", "changelog-12"]
+    assert recorded == [("changelog-12", 12, 7)]
+    assert fake_spark.catalog.dropped_views == [view]
+
+
+@pytest.mark.parametrize(
+    "path, expected",
+    [
+        ("s3://bucket/t/data/eq-1.parquet", "s3a://bucket/t/data/eq-1.parquet"),
+        ("S3N://bucket/eq.parquet", "s3a://bucket/eq.parquet"),
+        ("s3a://bucket/eq.parquet", "s3a://bucket/eq.parquet"),
+        ("file:///tmp/wh/eq.parquet", "file:///tmp/wh/eq.parquet"),
+        ("/tmp/wh/eq.parquet", "/tmp/wh/eq.parquet"),
+    ],
+)
+def test_hadoop_path_maps_fileio_schemes(script, path, expected):
+    assert script._hadoop_path(path) == expected
+
+
+def test_hadoop_path_rejects_unknown_schemes(script):
+    with pytest.raises(ValueError, match="unsupported scheme 'oss'"):
+        script._hadoop_path("oss://bucket/eq.parquet")
+
+
+def test_equality_delete_keys_read_through_s3a(script, fake_spark):
+    fake_spark.read.columns = ["_olake_id"]
+    keys = script._read_equality_delete_keys("c.db.t", ["s3://bucket/t/eq-1.parquet"])
+    assert fake_spark.read.parquet_paths == ["s3a://bucket/t/eq-1.parquet"]
+    assert keys.ops[-1] == ("select", ("_olake_id",))
+
+
+def test_position_deletes_read_from_metadata_table_at_adding_snapshot(script):
+    sql = " ".join(script._position_deletes_sql("c.db.t", {12: ["s3://b/pd-2.parquet"], 11: ["s3://b/pd-1.parquet"]}).split())
+    assert sql == (
+        "SELECT file_path, pos FROM c.db.t.position_deletes VERSION AS OF 11 WHERE delete_file_path IN ('s3://b/pd-1.parquet') "
+        "UNION ALL "
+        "SELECT file_path, pos FROM c.db.t.position_deletes VERSION AS OF 12 WHERE delete_file_path IN ('s3://b/pd-2.parquet')"
+    )
+
+
+def _audit_setup(script, monkeypatch, fake_spark, tmp_path, staged_hash):
+    from pyspark.sql.types import LongType, StringType, StructField, StructType
+
+    monkeypatch.setattr(script, "AUDIT_ENABLED", True)
+    monkeypatch.setattr(script, "CHECKPOINT_INDEX_PATH", str(tmp_path / "checkpoints.sqlite"))
+    script.write_checkpoint_index("c.db.t_cow", "5", 1)
+    script.mark_checkpoint_pending("c.db.t_cow", "7")
+    fake_spark.conf.set("spark.wap.id", "7")
+    staged = _wap_snap(3, 1, {"wap.id": "7", "added-records": "2", "total-records": "12"})
+    _cow_history(script, monkeypatch, [_wap_snap(1, None, {"wap.id": "5", "total-records": "10"}), staged], head=1)
+    monkeypatch.setattr(script, "_staged_snapshot", lambda _t, _w: staged)
+    monkeypatch.setattr(script, "_fetch_snapshot_with_summary", lambda _t, _sid: {"summary": {"total-records": "10"}})
+    monkeypatch.setattr(script, "_staged_added_data_files", lambda _t, _sid: ["s3://b/cow/f-1.parquet"])
+    fake_spark.results["LEFT SEMI JOIN (SELECT _olake_id"] = [{"rows": 2, "row_hash": staged_hash}]
+    schema = StructType([StructField("_olake_id", StringType()), StructField("v", LongType())])
+    return schema, {"rows": 2, "keys": 2, "row_hash": 123}
+
+
+def test_audit_passes_matching_staged_commit(script, monkeypatch, fake_spark, tmp_path):
+    schema, profile = _audit_setup(script, monkeypatch, fake_spark, tmp_path, staged_hash=123)
+    script.audit_staged_commit("c.db.t_cow", "SELECT * FROM delta", schema, profile=profile)
+    assert not fake_spark.ran("expire_snapshots")
+    # The COW side only reads the files the staged commit added.
+    assert fake_spark.ran("VERSION AS OF 3 WHERE _file IN ('s3://b/cow/f-1.parquet')")
+
+
+def test_audit_rejection_expires_only_the_staged_snapshot(script, monkeypatch, fake_spark, tmp_path):
+    schema, profile = _audit_setup(script, monkeypatch, fake_spark, tmp_path, staged_hash=456)
+    with pytest.raises(RuntimeError, match="Audit failed .* snapshot 3 not published"):
+        script.audit_staged_commit("c.db.t_cow", "SELECT * FROM delta", schema, profile=profile)
+    expire = fake_spark.ran("expire_snapshots")
+    assert len(expire) == 1
+    assert "older_than => TIMESTAMP_MILLIS(0), retain_last => 1, snapshot_ids => array(3)" in expire[0]
+    entry = script.read_checkpoint_index("c.db.t_cow")
+    assert entry["pending_wap_id"] is None
+    assert entry["wap_id"] == "5"
+
+
+def test_audit_rejection_of_only_baseline_drops_table(script, monkeypatch, fake_spark, tmp_path):
+    schema, profile = _audit_setup(script, monkeypatch, fake_spark, tmp_path, staged_hash=456)
+    _cow_history(script, monkeypatch, [_wap_snap(3, None, {"wap.id": "7"})], head=None)
+    with pytest.raises(RuntimeError, match="COW table dropped"):
+        script._reject_staged_snapshot("c.db.t_cow", "7", {"snapshot_id": 3, "parent_id": None}, ["bad"])
+    assert fake_spark.ran("DROP TABLE IF EXISTS c.db.t_cow PURGE")
+    assert not fake_spark.ran("expire_snapshots")
+
+
+@pytest.mark.parametrize("cow_exists", [True, False])
+def test_failed_boundary_unsets_wap_id(script, monkeypatch, fake_spark, cow_exists):
+    def rejected(*_a, **_kw):
+        raise RuntimeError("Audit failed for c.db.t_cow")
+
+    published = []
+    monkeypatch.setattr(script, "table_exists", lambda _t: cow_exists)
+    monkeypatch.setattr(script, "_cow_has_any_snapshots", lambda _t: cow_exists)
+    monkeypatch.setattr(script, "merge_snapshot_into_cow", rejected)
+    monkeypatch.setattr(script, "_ensure_cow_table_from_snapshot", rejected)
+    monkeypatch.setattr(script, "publish_wap_changes", lambda *a: published.append(a))
+    with pytest.raises(RuntimeError, match="Audit failed"):
+        script._apply_truncate_boundary(
+            "c.db.t", "c.db.t_cow", "s3://b/cow/t_cow", "c", _mor_snap(12, 11, 2, "delete"), _mor_snap(11, 10, 1)
+        )
+    assert fake_spark.ran("SET spark.wap.id=12")
+    assert fake_spark.conf.get("spark.wap.id") is None
+    assert published == []
+
+
+def test_clear_checkpoint_pending_keeps_published_checkpoint(script, monkeypatch, tmp_path):
+    monkeypatch.setattr(script, "CHECKPOINT_INDEX_PATH", str(tmp_path / "checkpoints.sqlite"))
+    script.write_checkpoint_index("c.db.t_cow", "42", 1001)
+    script.mark_checkpoint_pending("c.db.t_cow", "43")
+
+    script.clear_checkpoint_pending("c.db.t_cow")
+    entry = script.read_checkpoint_index("c.db.t_cow")
+    assert entry["pending_wap_id"] is None
+    assert entry["wap_id"] == "42"
+    assert entry["cow_snapshot_id"] == 1001
+
+
+def _inplace_setup(script, monkeypatch, fake_spark, remaining):
+    monkeypatch.setattr(script, "current_snapshot_id", lambda _t: 10)
+    monkeypatch.setattr(
+        script, "_fetch_snapshot_with_summary", lambda _t, sid: {"snapshot_id": sid, "summary": {"total-delete-files": "3"}}
+    )
+    fake_spark.results["COUNT(*) AS c"] = [{"c": remaining}]
+
+
+def test_inplace_fails_when_start_delete_files_remain(script, monkeypatch, fake_spark):
+    _inplace_setup(script, monkeypatch, fake_spark, remaining=2)
+    monkeypatch.setattr(script, "INPLACE_DELETE_FILE_THRESHOLD", 1)
+    with pytest.raises(RuntimeError, match="live at snapshot 10"):
+        script.run_inplace_cycle_for_table("c.db.t")
+    # Only delete files that were live when the rewrite started are compared.
+    assert fake_spark.ran("entries VERSION AS OF 10")
+
+
+def test_inplace_ignores_new_deletes_and_respects_threshold(script, monkeypatch, fake_spark):
+    _inplace_setup(script, monkeypatch, fake_spark, remaining=0)
+    monkeypatch.setattr(script, "INPLACE_DELETE_FILE_THRESHOLD", 1)
+    assert script.run_inplace_cycle_for_table("c.db.t") == script.CYCLE_COMPACTED
+
+    _inplace_setup(script, monkeypatch, fake_spark, remaining=2)
+    monkeypatch.setattr(script, "INPLACE_DELETE_FILE_THRESHOLD", 3)
+    assert script.run_inplace_cycle_for_table("c.db.t") == script.CYCLE_COMPACTED